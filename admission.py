@@ -0,0 +1,354 @@
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+
+from metrics import get_metrics
+from llm_client import LLM_MAX_CONCURRENCY
+from circuit_breaker import CircuitOpenError
+
+# Admission control defaults, overridable through ADMISSION_* in the .env file
+ADMISSION_QUEUE_SIZE = 64  # model calls waiting for a slot before new ones get a 429
+ADMISSION_MAX_WAIT = 30.0  # seconds a call may wait for a slot
+ADMISSION_USER_RATE = 20.0  # model calls per minute per user; 0 for no limit
+ADMISSION_USER_BURST = 10
+# Per client address, which sessions behind the same address (or a client
+# that drops its session cookie) share; 0 for no limit
+ADMISSION_ADDRESS_RATE = 120.0
+ADMISSION_ADDRESS_BURST = 30
+MAX_BUCKETS = 10000  # users and addresses whose buckets are kept, least recently seen evicted
+
+# Priority classes, most urgent first: interactive chat turns, page
+# generations a user is waiting on, then batch and pre-generation jobs
+PRIORITIES = ('chat', 'generation', 'batch')
+
+REASONS = {
+    'rate_limited': "Too many requests; slow down",
+    'queue_full': "The server is busy",
+    'timeout': "Timed out waiting for the AI service"
+}
+
+
+class AdmissionRejected(Exception):
+    code = 429
+    # Only the rejected caller gets it, not others sharing its single flight
+    shared = False
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"{REASONS[reason]}, please retry in {retry_after:.0f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    # `rate` tokens per second up to `burst`; each model call takes one
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        # 0 when a token was taken, else seconds until one is available
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+class _Ticket:
+    def __init__(self, user_id, address, priority):
+        self.user_id = user_id
+        self.address = address
+        # Fair queueing is per address when there is one: a new session id
+        # doesn't get a client a new place in line
+        self.lane = address if address is not None else user_id
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        # Set when the ticket gets a slot, or is pushed out of the queue
+        # with `rejection`
+        self.granted = threading.Event()
+        self.rejection = None
+
+
+class AdmissionController:
+    """Decides which model call runs next, and which are turned away.
+
+    At most `concurrency` calls hold a slot at a time. Calls beyond that
+    wait in a queue of at most `queue_size`, where a freed slot goes to
+    the most urgent priority class and, within it, to client addresses
+    (or users, for calls without one) in turn, so a client with many queued
+    calls doesn't delay everyone else's. When the queue is full, a more
+    urgent call pushes out the newest call of a less urgent class. Each
+    user has a token bucket of `user_rate` calls per minute with bursts of
+    `user_burst`, and each address one of `address_rate` and
+    `address_burst`, so minting new sessions doesn't reset the limit. A
+    call that is over either rate, finds the queue full of calls at least
+    as urgent or waits longer than `max_wait` is rejected at once with
+    AdmissionRejected instead of tying up a worker.
+    """
+
+    def __init__(self, concurrency=LLM_MAX_CONCURRENCY, queue_size=ADMISSION_QUEUE_SIZE,
+                 max_wait=ADMISSION_MAX_WAIT, user_rate=ADMISSION_USER_RATE, user_burst=ADMISSION_USER_BURST,
+                 address_rate=ADMISSION_ADDRESS_RATE, address_burst=ADMISSION_ADDRESS_BURST, enabled=True):
+        self.concurrency = max(1, concurrency)
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.user_rate = user_rate
+        self.user_burst = max(1, user_burst)
+        self.address_rate = address_rate
+        self.address_burst = max(1, address_burst)
+        self.enabled = enabled
+        self._in_flight = 0
+        self._queued = 0
+        # Per priority class, each lane's waiting tickets in arrival order
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self._buckets = OrderedDict()
+        self._hold = 1.0  # moving average of seconds a slot is held, for Retry-After
+        self._lock = threading.Lock()
+
+    def _bucket_keys(self, user_id, address):
+        keys = []
+        if user_id is not None and self.user_rate > 0:
+            keys.append(('user', user_id))
+        if address is not None and self.address_rate > 0:
+            keys.append(('address', address))
+        return keys
+
+    def _take_token(self, user_id, address, now):
+        # 0 when the user's and the address's buckets both had a token, else
+        # seconds until they will; nothing is taken then
+        taken = []
+        for key in self._bucket_keys(user_id, address):
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                rate, burst = (self.user_rate, self.user_burst) if key[0] == 'user' else \
+                    (self.address_rate, self.address_burst)
+                bucket = TokenBucket(rate / 60, burst, now)
+            self._buckets[key] = bucket
+            wait = bucket.take(now)
+            if wait:
+                for other in taken:
+                    other.refund()
+                return wait
+            taken.append(bucket)
+        while len(self._buckets) > MAX_BUCKETS:
+            self._buckets.popitem(last=False)
+        return 0.0
+
+    def _reject(self, reason, priority, retry_after):
+        get_metrics().inc('admission_rejected_total', reason=reason, priority=priority)
+        return AdmissionRejected(reason, max(1.0, retry_after))
+
+    def _drain_time(self):
+        # Roughly how long the calls already queued take to get a slot
+        return (self._queued + 1) * self._hold / self.concurrency
+
+    def _update_gauges(self):
+        metrics = get_metrics()
+        metrics.set_gauge('admission_in_flight', self._in_flight)
+        for priority, lanes in self._queues.items():
+            metrics.set_gauge('admission_queue_depth', sum(len(tickets) for tickets in lanes.values()),
+                              priority=priority)
+
+    def acquire(self, user_id, priority, address=None):
+        # Blocks until the call may go ahead and returns the function that
+        # frees its slot, or raises AdmissionRejected. `user_id` and
+        # `address` None are the app's own work, which has no rate limit.
+        if priority not in self._queues:
+            raise ValueError(f"Unknown priority {priority!r}")
+        with self._lock:
+            wait = self._take_token(user_id, address, time.monotonic())
+            if wait:
+                raise self._reject('rate_limited', priority, wait)
+            if self._in_flight < self.concurrency and not self._queued:
+                self._in_flight += 1
+                self._update_gauges()
+                get_metrics().observe('admission_wait_seconds', 0.0, priority=priority)
+                return self._releaser(user_id, address)
+            if self._queued >= self.queue_size:
+                # A full queue makes room for more urgent calls by dropping
+                # the last ticket of a less urgent class
+                dropped = self._drop_less_urgent(priority)
+                if dropped is None:
+                    self._refund(user_id, address)
+                    raise self._reject('queue_full', priority, self._drain_time())
+                self._refund(dropped.user_id, dropped.address)
+                dropped.rejection = self._reject('queue_full', dropped.priority, self._drain_time())
+                dropped.granted.set()
+            ticket = _Ticket(user_id, address, priority)
+            self._queues[priority].setdefault(ticket.lane, deque()).append(ticket)
+            self._queued += 1
+            self._update_gauges()
+
+        if not ticket.granted.wait(self.max_wait):
+            with self._lock:
+                # The slot may have been handed over just as the wait ran out
+                if not ticket.granted.is_set():
+                    tickets = self._queues[priority][ticket.lane]
+                    tickets.remove(ticket)
+                    if not tickets:
+                        del self._queues[priority][ticket.lane]
+                    self._queued -= 1
+                    self._update_gauges()
+                    raise self._reject('timeout', priority, self._drain_time())
+        if ticket.rejection is not None:
+            raise ticket.rejection
+        get_metrics().observe('admission_wait_seconds', time.monotonic() - ticket.enqueued, priority=priority)
+        return self._releaser(user_id, address)
+
+    def _refund(self, user_id, address):
+        for key in self._bucket_keys(user_id, address):
+            if key in self._buckets:
+                self._buckets[key].refund()
+
+    def _drop_less_urgent(self, priority):
+        # Takes the newest ticket of the last lane in line in the least
+        # urgent class below `priority` out of the queue
+        for lower in reversed(PRIORITIES[PRIORITIES.index(priority) + 1:]):
+            lanes = self._queues[lower]
+            if lanes:
+                lane = next(reversed(lanes))
+                tickets = lanes[lane]
+                ticket = tickets.pop()
+                if not tickets:
+                    del lanes[lane]
+                self._queued -= 1
+                return ticket
+        return None
+
+    def _releaser(self, user_id, address):
+        started = time.monotonic()
+        released = []
+
+        def release(refund=False):
+            # `refund` gives the tokens back, for a call that never reached
+            # the model
+            if not released:
+                released.append(True)
+                if refund:
+                    with self._lock:
+                        self._refund(user_id, address)
+                self._release(time.monotonic() - started)
+        return release
+
+    def _release(self, held):
+        with self._lock:
+            self._hold += 0.2 * (held - self._hold)
+            ticket = self._next_ticket()
+            if ticket is None:
+                self._in_flight -= 1
+            else:
+                # The slot passes straight to the next call
+                ticket.granted.set()
+            self._update_gauges()
+
+    def _next_ticket(self):
+        # Oldest ticket of the first lane in line in the most urgent class;
+        # that lane then goes to the back of the line
+        for lanes in self._queues.values():
+            if lanes:
+                lane, tickets = next(iter(lanes.items()))
+                ticket = tickets.popleft()
+                if tickets:
+                    lanes.move_to_end(lane)
+                else:
+                    del lanes[lane]
+                self._queued -= 1
+                return ticket
+        return None
+
+    def wrap(self, model, user_id, priority, address=None):
+        # The model as seen by one user's requests of one priority class
+        if not self.enabled:
+            return model
+        return AdmittedModel(model, self, user_id, priority, address)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': self._in_flight,
+                'concurrency': self.concurrency,
+                'queued': {priority: sum(len(tickets) for tickets in lanes.values())
+                           for priority, lanes in self._queues.items()},
+                'queue_size': self.queue_size,
+                'buckets': len(self._buckets)
+            }
+
+
+class AdmittedModel:
+    """A model whose calls each wait for admission first.
+
+    Other attributes are the wrapped model's, so it can be passed wherever
+    the model is. A streamed response keeps its slot until it has been
+    read to the end or closed. While the model's circuit breaker is open,
+    calls skip admission and fail at once, so callers serve stale content
+    instead of a 429 and no tokens are spent.
+    """
+
+    def __init__(self, model, controller, user_id, priority, address=None):
+        self.model = model
+        self.controller = controller
+        self.user_id = user_id
+        self.priority = priority
+        self.address = address
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def generate_content(self, prompt, stream=False):
+        breaker = getattr(self.model, 'breaker', None)
+        if breaker is not None and breaker.is_open:
+            return self.model.generate_content(prompt, stream=stream)
+        release = self.controller.acquire(self.user_id, self.priority, self.address)
+        try:
+            response = self.model.generate_content(prompt, stream=stream)
+        except CircuitOpenError:
+            # The breaker opened while this call waited for its slot
+            release(refund=True)
+            raise
+        except BaseException:
+            release()
+            raise
+        if not stream:
+            release()
+            return response
+
+        def chunks():
+            try:
+                yield
+                yield from response
+            finally:
+                release()
+        # Started now, so closing or dropping it releases the slot even if
+        # it is never read
+        held = chunks()
+        next(held)
+        return held
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission():
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = AdmissionController(
+                concurrency=int(os.getenv('ADMISSION_CONCURRENCY',
+                                          os.getenv('LLM_MAX_CONCURRENCY', LLM_MAX_CONCURRENCY))),
+                queue_size=int(os.getenv('ADMISSION_QUEUE_SIZE', ADMISSION_QUEUE_SIZE)),
+                max_wait=float(os.getenv('ADMISSION_MAX_WAIT', ADMISSION_MAX_WAIT)),
+                user_rate=float(os.getenv('ADMISSION_USER_RATE', ADMISSION_USER_RATE)),
+                user_burst=int(os.getenv('ADMISSION_USER_BURST', ADMISSION_USER_BURST)),
+                address_rate=float(os.getenv('ADMISSION_ADDRESS_RATE', ADMISSION_ADDRESS_RATE)),
+                address_burst=int(os.getenv('ADMISSION_ADDRESS_BURST', ADMISSION_ADDRESS_BURST)),
+                enabled=os.getenv('ADMISSION', '1') == '1'
+            )
+        return _controller
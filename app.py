@@ -1,13 +1,23 @@
 import os
-import google.generativeai as genai
 from dotenv import load_dotenv
 from colorama import init, Fore, Style
 import time
-import pandas as pd
-import numpy as np
 from datetime import datetime
 import sys
 import json
+import threading
+from response_cache import cached_generate, get_cache, model_name_of
+from circuit_breaker import CircuitOpenError
+from history_store import get_store, make_event, DEFAULT_USER
+from study_stats import StudyStatistics
+from study_analytics import get_analytics
+from llm_client import get_client
+from chat_memory import ChatMemory
+from semantic_cache import get_semantic_cache
+from prompts import study_material_prompt, chat_prompt, get_template
+from practice_tests import get_test_store, grade, top_up_bank
+from mastery import get_mastery_store
+from metrics import get_metrics
 
 # Initialize colorama for colored output
 init()
@@ -18,21 +28,41 @@ try:
     
     # Get API key and verify it exists
     api_key = os.getenv('GEMINI_API_KEY')
-    if not api_key:
+    if not api_key and os.getenv('LLM_BACKEND') != 'fake':
         print(f"{Fore.RED}Error: GEMINI_API_KEY not found in .env file{Style.RESET_ALL}")
         sys.exit(1)
         
-    # Configure Gemini API
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-1.5-pro')
+    # Configure Gemini API through the shared client (concurrency cap, deadlines, retries)
+    model = get_client()
     
-    # Test API connection
-    try:
-        response = model.generate_content("Test connection")
-        print(f"{Fore.GREEN}Successfully connected to Gemini API{Style.RESET_ALL}")
-    except Exception as e:
-        print(f"{Fore.RED}Error connecting to Gemini API: {str(e)}{Style.RESET_ALL}")
-        sys.exit(1)
+    # Test API connection. 'sync' blocks startup until the check passes,
+    # 'async' runs it in the background and reports a failure in the header,
+    # 'off' skips it and lets the first real request surface any problem.
+    connection_check = os.getenv('STARTUP_CONNECTION_CHECK', 'async')
+    connection_error = None
+    
+    def check_connection():
+        global connection_error
+        try:
+            model.generate_content("Test connection")
+        except Exception as e:
+            connection_error = str(e)
+    
+    if connection_check == 'sync':
+        check_connection()
+        if connection_error and model.breaker is None:
+            print(f"{Fore.RED}Error connecting to Gemini API: {connection_error}{Style.RESET_ALL}")
+            sys.exit(1)
+        if connection_error:
+            # Start in degraded mode on previously generated content; the
+            # breaker's probes reconnect once the API answers again
+            print(f"{Fore.YELLOW}Could not connect to Gemini API, continuing offline: "
+                  f"{connection_error}{Style.RESET_ALL}")
+            model.breaker.trip(connection_error)
+        else:
+            print(f"{Fore.GREEN}Successfully connected to Gemini API{Style.RESET_ALL}")
+    elif connection_check == 'async':
+        threading.Thread(target=check_connection, daemon=True).start()
 except Exception as e:
     print(f"{Fore.RED}Initialization Error: {str(e)}{Style.RESET_ALL}")
     sys.exit(1)
@@ -45,18 +75,28 @@ SUBJECTS = {
     'History': ['World History', 'American History', 'Ancient History', 'Modern History']
 }
 
-# Initialize study history DataFrame
-try:
-    study_history = pd.DataFrame(columns=['timestamp', 'subject', 'topic', 'difficulty', 'activity_type', 'duration'])
-    
-    # Try to load existing study history if available
-    if os.path.exists('study_history.csv'):
-        study_history = pd.read_csv('study_history.csv')
-        study_history['timestamp'] = pd.to_datetime(study_history['timestamp'])
-        print(f"{Fore.GREEN}Loaded existing study history.{Style.RESET_ALL}")
-except Exception as e:
-    print(f"{Fore.RED}Error initializing DataFrame: {str(e)}{Style.RESET_ALL}")
-    sys.exit(1)
+# Study history is an append-only event log shared with the web app;
+# statistics are maintained incrementally as events are read from it
+history_store = get_store()
+study_stats = StudyStatistics(history_store)
+
+# CLI sessions belong to the local user; with the SQLite history the
+# statistics view shows only them, not what web users studied
+analytics = get_analytics()
+
+# Skill ratings from graded tests, shared with the web app; the CLI rates
+# the local user
+mastery = get_mastery_store()
+
+def record_session(subject, topic, difficulty, activity_type, duration, score=None):
+    history_store.append(make_event(subject, topic, difficulty, activity_type, duration, score=score))
+
+def print_stale_notice(content):
+    # Fallback content served while the model is unavailable carries its age
+    created = getattr(content, 'created', None)
+    if created:
+        print(f"\n{Fore.YELLOW}The AI service is unavailable, showing content generated on "
+              f"{datetime.fromtimestamp(created):%Y-%m-%d %H:%M}{Style.RESET_ALL}")
 
 def clear_screen():
     os.system('cls' if os.name == 'nt' else 'clear')
@@ -66,6 +106,11 @@ def print_header():
     print(f"{Fore.CYAN}╔════════════════════════════════════════╗")
     print(f"║           AI Study Buddy v1.0           ║")
     print(f"╚════════════════════════════════════════╝{Style.RESET_ALL}\n")
+    if model.breaker is not None and model.breaker.is_open:
+        print(f"{Fore.YELLOW}Offline mode: the AI service is unavailable, so previously generated content "
+              f"is shown where there is some{Style.RESET_ALL}\n")
+    elif connection_error:
+        print(f"{Fore.RED}Warning: could not connect to Gemini API: {connection_error}{Style.RESET_ALL}\n")
 
 def print_menu():
     print(f"{Fore.YELLOW}Main Menu:{Style.RESET_ALL}")
@@ -74,7 +119,8 @@ def print_menu():
     print("3. Chat with AI")
     print("4. View Study Statistics")
     print("5. Save Study History")
-    print("6. Exit")
+    print("6. View Performance Metrics")
+    print("7. Exit")
     print()
 
 def select_subject():
@@ -106,86 +152,90 @@ def select_topic(subject):
         except ValueError:
             print(f"{Fore.RED}Please enter a valid number.{Style.RESET_ALL}")
 
-def select_difficulty():
+def select_difficulty(subject, topic):
     difficulties = ['Beginner', 'Intermediate', 'Advanced']
+    recommended = mastery.recommend(DEFAULT_USER, subject, topic)
     print(f"\n{Fore.YELLOW}Select Difficulty:{Style.RESET_ALL}")
     for i, diff in enumerate(difficulties, 1):
         print(f"{i}. {diff}")
+    print(f"{len(difficulties) + 1}. Auto ({recommended}, based on your test results)")
     
     while True:
         try:
             choice = int(input("\nSelect difficulty number: "))
             if 1 <= choice <= len(difficulties):
                 return difficulties[choice-1]
+            if choice == len(difficulties) + 1:
+                return recommended
             print(f"{Fore.RED}Invalid choice. Please try again.{Style.RESET_ALL}")
         except ValueError:
             print(f"{Fore.RED}Please enter a valid number.{Style.RESET_ALL}")
 
 def generate_study_material(subject, topic, difficulty):
     print(f"\n{Fore.CYAN}Generating study materials...{Style.RESET_ALL}")
-    prompt = f"""You are an expert tutor in {subject}. Create comprehensive study material for {topic} at {difficulty} level.
-
-    Include the following sections:
-    1. Key Concepts: Explain the fundamental principles and theories
-    2. Important Formulas/Theorems: List and explain all relevant formulas or theorems
-    3. Step-by-Step Examples: Provide 3 detailed examples with full explanations
-    4. Practice Problems: Create 5 practice problems with varying difficulty
-    5. Common Mistakes: Highlight common misconceptions and how to avoid them
-    6. Study Tips: Provide specific strategies for mastering this topic
-    
-    Format the response in a clear, structured way with headings and bullet points where appropriate."""
+    prompt = study_material_prompt(subject, topic, difficulty, output_format='text')
     
     start_time = time.time()
-    response = model.generate_content(prompt)
+    content = cached_generate(model, prompt)
     duration = time.time() - start_time
     
     # Record study session
-    study_history.loc[len(study_history)] = {
-        'timestamp': datetime.now(),
-        'subject': subject,
-        'topic': topic,
-        'difficulty': difficulty,
-        'activity_type': 'Study Materials',
-        'duration': duration
-    }
+    record_session(subject, topic, difficulty, 'Study Materials', duration)
     
-    return response.text
+    return content
 
-def generate_practice_test(subject, topic, num_questions=5):
+def generate_practice_test(subject, topic, difficulty=None, num_questions=5):
+    # Returns a test id and its questions, drawn from the question bank
+    # shared with the web app; the model is only asked while the bank is
+    # short of several tests' worth
     print(f"\n{Fore.CYAN}Creating practice test...{Style.RESET_ALL}")
-    prompt = f"""You are an expert exam creator for {subject}. Create a {num_questions}-question practice test for {topic}.
-
-    For each question:
-    1. Write a clear, concise question
-    2. Provide 4 multiple choice options (A, B, C, D)
-    3. Indicate the correct answer
-    4. Provide a detailed explanation of why the answer is correct
-    5. Explain why the other options are incorrect
-    
-    Format each question as follows:
-    Question 1: [Question text]
-    A) [Option A]
-    B) [Option B]
-    C) [Option C]
-    D) [Option D]
-    Correct Answer: [Letter]
-    Explanation: [Detailed explanation]"""
+    difficulty = mastery.resolve(DEFAULT_USER, subject, topic, difficulty)
     
     start_time = time.time()
-    response = model.generate_content(prompt)
+    store = get_test_store()
+    print_stale_notice(top_up_bank(store, model, subject, topic, difficulty, num_questions))
+    candidates = store.sample(subject, topic, num_questions * 4, difficulty)
+    questions = mastery.pick_questions(DEFAULT_USER, subject, topic, candidates, num_questions)
+    test_id, questions = store.create_test(subject, topic, questions, difficulty)
     duration = time.time() - start_time
     
     # Record study session
-    study_history.loc[len(study_history)] = {
-        'timestamp': datetime.now(),
-        'subject': subject,
-        'topic': topic,
-        'difficulty': 'N/A',
-        'activity_type': 'Practice Test',
-        'duration': duration
-    }
+    record_session(subject, topic, difficulty, 'Practice Test', duration)
     
-    return response.text
+    return test_id, questions
+
+def take_practice_test(test_id, questions):
+    # Ask each question, grade the answers and update the skill rating
+    start_time = time.time()
+    answers = {}
+    for number, question in enumerate(questions, 1):
+        print(f"\n{Fore.YELLOW}Question {number}: {question['question']}{Style.RESET_ALL}")
+        for letter, option in question['options'].items():
+            print(f"{letter}) {option}")
+        while True:
+            answer = input("\nYour answer (A-D, Enter to skip): ").strip().upper()
+            if answer in ('', 'A', 'B', 'C', 'D'):
+                break
+            print(f"{Fore.RED}Please enter A, B, C or D.{Style.RESET_ALL}")
+        if answer:
+            answers[question['id']] = answer
+    
+    test = get_test_store().take_test(test_id)
+    result = grade(test['answer_key'], answers)
+    for number, graded in enumerate(result['results'], 1):
+        color = Fore.GREEN if graded['is_correct'] else Fore.RED
+        print(f"\n{color}Question {number}: {'Correct' if graded['is_correct'] else 'Incorrect'} "
+              f"(answer: {graded['correct_answer']}){Style.RESET_ALL}")
+        print(graded['explanation'])
+    print(f"\n{Fore.CYAN}Score: {result['score']}/{result['total']} ({result['percentage']:.1f}%){Style.RESET_ALL}")
+    
+    record_session(test['subject'], test['topic'], test['difficulty'], 'Practice Test Result', time.time() - start_time,
+                   score=result['percentage'])
+    skill = mastery.record_answers(DEFAULT_USER, test['subject'], test['topic'],
+                                   [(key['hash'], key['difficulty'], graded['is_correct'])
+                                    for key, graded in zip(test['answer_key'].values(), result['results'])])
+    print(f"Skill rating: {skill['rating']:.0f} - recommended next level: {skill['difficulty']}")
+    return result
 
 def chat_with_ai(subject, topic, difficulty):
     print(f"\n{Fore.CYAN}Chat with AI (Type 'exit' to return to main menu){Style.RESET_ALL}")
@@ -193,79 +243,132 @@ def chat_with_ai(subject, topic, difficulty):
     
     start_time = time.time()
     chat_count = 0
+    memory = ChatMemory()
+    semantic_cache = get_semantic_cache()
+    context = (get_template('chat', 'text').version, model_name_of(model), subject, topic, difficulty)
     
     while True:
         user_input = input("\nYour question: ")
         if user_input.lower() == 'exit':
             break
             
-        prompt = f"""You are an expert tutor in {subject}, specifically knowledgeable about {topic} at {difficulty} level.
-        
-        User Question: {user_input}
+        # Include earlier turns, trimmed to a fixed token budget
+        history = memory.context()
+        prompt = chat_prompt(subject, topic, difficulty, user_input, history, output_format='text')
         
-        Provide a helpful, educational response that:
-        1. Directly addresses the user's question
-        2. Uses appropriate examples and analogies
-        3. Breaks down complex concepts into simpler parts
-        4. Encourages deeper understanding
-        5. Suggests related topics for further study
+        # A first question close to one answered before is answered from
+        # the semantic cache; follow-ups depend on the conversation
+        cached = None if history else semantic_cache.lookup(context, user_input)
+        if cached is not None:
+            print(f"\n{Fore.GREEN}AI: {cached}{Style.RESET_ALL}")
+            memory.add_turn(user_input, cached)
+            chat_count += 1
+            continue
         
-        Keep your response focused and concise while being thorough."""
+        try:
+            response = model.generate_content(prompt, stream=True)
+        except CircuitOpenError as e:
+            # Model calls are suspended: fall back to a similar earlier
+            # answer or the topic's study material, if there is one
+            fallback = (semantic_cache.fallback(context, user_input)
+                        or get_cache().fallback(study_material_prompt(subject, topic, difficulty,
+                                                                      output_format='text').fallback_key))
+            if fallback is None:
+                print(f"\n{Fore.RED}{e}{Style.RESET_ALL}")
+            else:
+                print(f"\n{Fore.YELLOW}The AI service is unavailable, showing an earlier answer{Style.RESET_ALL}")
+                print(f"{Fore.GREEN}AI: {fallback}{Style.RESET_ALL}")
+            continue
+        except Exception as e:
+            # A timeout or API error; the question can be asked again
+            print(f"\n{Fore.RED}Error: {e}{Style.RESET_ALL}")
+            continue
         
-        response = model.generate_content(prompt)
-        print(f"\n{Fore.GREEN}AI: {response.text}{Style.RESET_ALL}")
+        # Print the answer as it streams in instead of waiting for all of it
+        print(f"\n{Fore.GREEN}AI: ", end='', flush=True)
+        answer = []
+        try:
+            for chunk in response:
+                print(chunk.text, end='', flush=True)
+                answer.append(chunk.text)
+        except Exception as e:
+            # Cut off partway; the partial answer isn't remembered
+            print(f"\n{Fore.RED}Error: {e}", end='')
+            continue
+        finally:
+            print(Style.RESET_ALL)
+        memory.add_turn(user_input, ''.join(answer))
+        if not history:
+            semantic_cache.add(context, user_input, ''.join(answer))
         chat_count += 1
     
     duration = time.time() - start_time
     
     # Record study session
-    study_history.loc[len(study_history)] = {
-        'timestamp': datetime.now(),
-        'subject': subject,
-        'topic': topic,
-        'difficulty': difficulty,
-        'activity_type': f'Chat Session ({chat_count} messages)',
-        'duration': duration
-    }
+    record_session(subject, topic, difficulty, f'Chat Session ({chat_count} messages)', duration)
 
 def view_statistics():
-    if len(study_history) == 0:
+    stats = analytics.summary(DEFAULT_USER) if analytics else study_stats.snapshot()
+    if stats['sessions'] == 0:
         print(f"\n{Fore.YELLOW}No study sessions recorded yet.{Style.RESET_ALL}")
         return
     
     print(f"\n{Fore.CYAN}Study Statistics:{Style.RESET_ALL}")
     
     # Total study time
-    total_time = study_history['duration'].sum()
+    total_time = stats['total_time']
     hours = int(total_time // 3600)
     minutes = int((total_time % 3600) // 60)
     seconds = int(total_time % 60)
     print(f"\nTotal Study Time: {hours} hours, {minutes} minutes, {seconds} seconds")
     
     # Subject distribution
-    subject_stats = study_history['subject'].value_counts()
+    subject_stats = stats['subject_stats']
     print(f"\nSubject Distribution:")
     for subject, count in subject_stats.items():
         print(f"{subject}: {count} sessions")
     
     # Activity type distribution
-    activity_stats = study_history['activity_type'].value_counts()
+    activity_stats = stats['activity_stats']
     print(f"\nActivity Distribution:")
     for activity, count in activity_stats.items():
         print(f"{activity}: {count} sessions")
     
     # Recent activity
     print(f"\nRecent Activity:")
-    recent = study_history.sort_values('timestamp', ascending=False).head(5)
-    for _, row in recent.iterrows():
+    for row in stats['recent_activity']:
         print(f"{row['timestamp']}: {row['activity_type']} - {row['subject']} ({row['topic']})")
     
     input("\nPress Enter to continue...")
 
+def view_metrics():
+    metrics = get_metrics()
+    latencies = metrics.latency_summary()
+    if not latencies:
+        print(f"\n{Fore.YELLOW}No model calls recorded yet.{Style.RESET_ALL}")
+        return
+    
+    print(f"\n{Fore.CYAN}Performance Metrics (this session):{Style.RESET_ALL}")
+    
+    # Latency percentiles per call type
+    print(f"\nLatency:")
+    for name, labels, count, p50, p95, p99, worst in latencies:
+        label_text = ', '.join(f"{key}={value}" for key, value in labels.items())
+        print(f"{name} ({label_text}): {count} calls, p50 {p50 * 1000:.0f} ms, "
+              f"p95 {p95 * 1000:.0f} ms, p99 {p99 * 1000:.0f} ms, max {worst * 1000:.0f} ms")
+    
+    # Call outcomes, token counts and cache lookups
+    print(f"\nCounters:")
+    for name, labels, value in metrics.counter_summary():
+        label_text = ', '.join(f"{key}={value}" for key, value in labels.items())
+        print(f"{name} ({label_text}): {value}")
+    
+    input("\nPress Enter to continue...")
+
 def save_study_history():
     try:
-        study_history.to_csv('study_history.csv', index=False)
-        print(f"\n{Fore.GREEN}Study history saved successfully to 'study_history.csv'{Style.RESET_ALL}")
+        history_store.flush()
+        print(f"\n{Fore.GREEN}Study history saved successfully to '{history_store.path}'{Style.RESET_ALL}")
     except Exception as e:
         print(f"\n{Fore.RED}Error saving study history: {str(e)}{Style.RESET_ALL}")
     
@@ -276,27 +379,39 @@ def main():
         print_header()
         print_menu()
         
-        choice = input("Enter your choice (1-6): ")
+        choice = input("Enter your choice (1-7): ")
         
         if choice == '1':
             subject = select_subject()
             topic = select_topic(subject)
-            difficulty = select_difficulty()
-            material = generate_study_material(subject, topic, difficulty)
-            print(f"\n{Fore.GREEN}{material}{Style.RESET_ALL}")
+            difficulty = select_difficulty(subject, topic)
+            try:
+                material = generate_study_material(subject, topic, difficulty)
+            except Exception as e:
+                # The breaker is open, or the call timed out or failed
+                print(f"\n{Fore.RED}Error: {e}{Style.RESET_ALL}")
+            else:
+                print_stale_notice(material)
+                print(f"\n{Fore.GREEN}{material}{Style.RESET_ALL}")
             input("\nPress Enter to continue...")
             
         elif choice == '2':
             subject = select_subject()
             topic = select_topic(subject)
-            test = generate_practice_test(subject, topic)
-            print(f"\n{Fore.GREEN}{test}{Style.RESET_ALL}")
+            difficulty = select_difficulty(subject, topic)
+            try:
+                test_id, questions = generate_practice_test(subject, topic, difficulty)
+            except Exception as e:
+                # The breaker is open, or the call timed out or failed
+                print(f"\n{Fore.RED}Error: {e}{Style.RESET_ALL}")
+            else:
+                take_practice_test(test_id, questions)
             input("\nPress Enter to continue...")
             
         elif choice == '3':
             subject = select_subject()
             topic = select_topic(subject)
-            difficulty = select_difficulty()
+            difficulty = select_difficulty(subject, topic)
             chat_with_ai(subject, topic, difficulty)
             
         elif choice == '4':
@@ -306,9 +421,11 @@ def main():
             save_study_history()
             
         elif choice == '6':
+            view_metrics()
+            
+        elif choice == '7':
             # Auto-save before exiting
-            if len(study_history) > 0:
-                save_study_history()
+            history_store.flush()
             print(f"\n{Fore.CYAN}Thank you for using AI Study Buddy!{Style.RESET_ALL}")
             break
             
@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from response_cache import cached_generate, get_cache, cache_key, model_name_of
+from pregenerate import RateLimiter
+from admission import AdmissionRejected
+from metrics import Histogram, get_metrics
+
+# Batch defaults, overridable through BATCH_* in the .env file
+BATCH_WORKERS = 4
+BATCH_RATE = 30  # model calls per minute
+
+KINDS = ['study_material', 'practice_test']
+
+
+def parse_job(data):
+    # Validate one job dict; practice tests without a difficulty are made
+    # at the level the question bank assumes for unlabelled questions
+    if not isinstance(data, dict):
+        raise ValueError("Job must be a JSON object")
+    job = {name: str(data.get(name) or '').strip() for name in ('subject', 'topic', 'difficulty', 'kind')}
+    if job['kind'] not in KINDS:
+        raise ValueError(f"Unknown kind {job['kind']!r}, expected one of {', '.join(KINDS)}")
+    if not job['subject'] or not job['topic']:
+        raise ValueError("Job needs a subject and a topic")
+    if job['kind'] == 'study_material' and not job['difficulty']:
+        raise ValueError("Study material jobs need a difficulty")
+    return job
+
+
+def job_id(job):
+    return '/'.join([job['kind'], job['subject'], job['topic'], job['difficulty']])
+
+
+def read_jobs(path):
+    # One JSON job per line; blank lines are skipped
+    jobs = []
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                jobs.append(parse_job(json.loads(line)))
+            except ValueError as e:
+                raise ValueError(f"{path}:{number}: {e}")
+    return jobs
+
+
+def catalogue_jobs(subjects, difficulties):
+    # Every study material and practice test the apps can ask for
+    jobs = []
+    for subject, topics in subjects.items():
+        for topic in topics:
+            for difficulty in difficulties:
+                for kind in KINDS:
+                    jobs.append({'subject': subject, 'topic': topic, 'difficulty': difficulty, 'kind': kind})
+    return jobs
+
+
+def completed_job_ids(path):
+    # Ids of jobs that already succeeded in an earlier run's output
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by an interrupted run
+            if isinstance(result, dict) and result.get('status') == 'ok':
+                done.add(result.get('id'))
+    return done
+
+
+class BatchRun:
+    """Generates a list of jobs on a bounded worker pool.
+
+    `prompt_for(job)` returns the prompt for a job and an optional
+    validator, which also turns the response into the exported result.
+    Jobs go through cached_generate, so anything already in the response
+    cache is exported without a model call; only cache misses wait on the
+    calls-per-minute budget, which runs sharing a `limiter` draw from
+    together. A job turned away by admission control waits out its
+    Retry-After and tries again rather than failing. run() yields one result dict per job as it completes, and
+    report() summarizes throughput.
+    """
+
+    def __init__(self, model, prompt_for, workers=BATCH_WORKERS, rate_per_minute=BATCH_RATE, cache=None,
+                 limiter=None):
+        self.model = model
+        self.prompt_for = prompt_for
+        self.workers = workers
+        self.rate = limiter or RateLimiter(rate_per_minute)
+        self.cache = cache or get_cache()
+        self.latency = Histogram()
+        self.counts = {'total': 0, 'skipped': 0, 'ok': 0, 'failed': 0}
+        self.started = None
+        self.finished = None
+
+    def _generate(self, prompt, validate):
+        while True:
+            try:
+                # Stale fallback content would be exported as a success and
+                # never retried, and may not even be the same question set
+                return cached_generate(self.model, prompt, self.cache, validate=validate, fallback=False)
+            except AdmissionRejected as e:
+                if self.finished is not None:
+                    raise  # the run was stopped
+                time.sleep(e.retry_after)
+
+    def _run_one(self, job):
+        start = time.perf_counter()
+        result = {'id': job_id(job), 'job': job}
+        try:
+            prompt, validate = self.prompt_for(job)
+            if self.cache.age(cache_key(prompt, model_name_of(self.model))) is None:
+                self.rate.wait()
+            text = self._generate(prompt, validate)
+            result.update(status='ok', result=validate(text) if validate else text)
+        except Exception as e:
+            result.update(status='error', error=str(e))
+        result['seconds'] = round(time.perf_counter() - start, 3)
+        return result
+
+    def run(self, jobs, skip=()):
+        pending = [job for job in jobs if job_id(job) not in skip]
+        self.counts.update(total=len(jobs), skipped=len(jobs) - len(pending))
+        self.started = time.time()
+        self.finished = None
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='batch')
+        try:
+            futures = [pool.submit(self._run_one, job) for job in pending]
+            for future in as_completed(futures):
+                result = future.result()
+                self.counts['ok' if result['status'] == 'ok' else 'failed'] += 1
+                self.latency.record(result['seconds'])
+                get_metrics().observe('batch_job_duration_seconds', result['seconds'],
+                                      kind=result['job']['kind'], status=result['status'])
+                yield result
+        finally:
+            # Stop queued jobs if the consumer goes away early
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.finished = time.time()
+
+    def report(self):
+        elapsed = ((self.finished or time.time()) - self.started) if self.started else 0.0
+        completed = self.counts['ok'] + self.counts['failed']
+        return dict(self.counts,
+                    elapsed=round(elapsed, 3),
+                    jobs_per_minute=round(completed / elapsed * 60, 1) if elapsed else 0.0,
+                    p50_seconds=round(self.latency.percentile(0.5), 3),
+                    p95_seconds=round(self.latency.percentile(0.95), 3))
+
+
+def run_from_env(model, prompt_for, limiter=None):
+    return BatchRun(
+        model, prompt_for,
+        workers=int(os.getenv('BATCH_WORKERS', BATCH_WORKERS)),
+        rate_per_minute=float(os.getenv('BATCH_RATE', BATCH_RATE)),
+        limiter=limiter
+    )
+
+
+if __name__ == '__main__':
+    usage = ("Usage: python batch.py run jobs.jsonl results.jsonl\n"
+             "       python batch.py catalogue > jobs.jsonl")
+    if len(sys.argv) < 2 or sys.argv[1] not in ('run', 'catalogue'):
+        print(usage)
+        sys.exit(1)
+
+    import web_app
+
+    if sys.argv[1] == 'catalogue':
+        for job in catalogue_jobs(web_app.SUBJECTS, web_app.DIFFICULTIES):
+            print(json.dumps(job))
+        sys.exit(0)
+
+    if len(sys.argv) < 4:
+        print(usage)
+        sys.exit(1)
+    jobs_path, output_path = sys.argv[2], sys.argv[3]
+    try:
+        jobs = read_jobs(jobs_path)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    # Results are appended, so rerunning with the same output file resumes
+    # where the last run stopped and retries jobs that failed
+    batch = run_from_env(web_app.model, web_app.batch_prompt)
+    with open(output_path, 'a', encoding='utf-8') as output:
+        for result in batch.run(jobs, skip=completed_job_ids(output_path)):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            report = batch.report()
+            sys.stderr.write(f"\r{report['ok'] + report['failed']}/{report['total'] - report['skipped']} done "
+                             f"({report['failed']} failed)")
+    report = batch.report()
+    print(f"\n{report['ok']} generated, {report['failed']} failed, {report['skipped']} already done "
+          f"in {report['elapsed']:.1f}s ({report['jobs_per_minute']} jobs/min, "
+          f"p50 {report['p50_seconds']:.2f}s, p95 {report['p95_seconds']:.2f}s)", file=sys.stderr)
+    sys.exit(1 if report['failed'] else 0)
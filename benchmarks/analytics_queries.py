@@ -0,0 +1,88 @@
+# Fills a scratch SQLite history with millions of events spread over many
+# users and times each per-user analytics query, failing when the slowest
+# one exceeds the budget.
+# Usage: python benchmarks/analytics_queries.py [events] [users] [budget_ms]
+import os
+import sys
+import time
+import random
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history_store import SqliteHistoryStore, make_event
+from study_analytics import StudyAnalytics
+
+EVENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+USERS = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+BUDGET_MS = float(sys.argv[3]) if len(sys.argv) > 3 else 50.0
+SAMPLES = 50
+
+SUBJECTS = {
+    'Mathematics': ['Algebra', 'Calculus', 'Geometry', 'Statistics'],
+    'Science': ['Physics', 'Chemistry', 'Biology', 'Earth Science'],
+    'Languages': ['English', 'Spanish', 'French', 'German'],
+    'History': ['World History', 'American History', 'Ancient History', 'Modern History']
+}
+ACTIVITIES = ['Study Materials', 'Practice Test', 'Chat', 'Practice Test Result']
+
+
+def fill(store, rng):
+    # A year of events; user ids are skewed so a few users have long histories
+    start = datetime.now() - timedelta(days=365)
+    batch = []
+    for i in range(EVENTS):
+        subject = rng.choice(list(SUBJECTS))
+        activity = rng.choice(ACTIVITIES)
+        batch.append(make_event(subject, rng.choice(SUBJECTS[subject]), 'Beginner', activity, rng.uniform(10, 900),
+                                timestamp=start + timedelta(seconds=rng.uniform(0, 365 * 86400)),
+                                user_id=f"user-{int(USERS * rng.random() ** 2)}",
+                                score=rng.uniform(0, 100) if activity == 'Practice Test Result' else None))
+        if len(batch) == 10000:
+            store._write(batch)
+            batch = []
+    store._write(batch)
+
+
+def main():
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SqliteHistoryStore(os.path.join(tmp, 'history.db'))
+        start = time.perf_counter()
+        fill(store, rng)
+        print(f"Inserted {EVENTS} events for {USERS} users in {time.perf_counter() - start:.1f}s")
+        analytics = StudyAnalytics(store)
+
+        queries = {
+            'summary': analytics.summary,
+            'study_time (day, 30d)': lambda user: analytics.study_time(user, 'day', 30),
+            'study_time (week, 365d)': lambda user: analytics.study_time(user, 'week', 365),
+            'streaks': analytics.streaks,
+            'topic_trends': analytics.topic_trends,
+            'topic_trends (subject)': lambda user: analytics.topic_trends(user, 'Mathematics'),
+            'score_history': analytics.score_history,
+        }
+        # The busiest user is the worst case; the rest are sampled at random
+        users = ['user-0'] + [f"user-{rng.randrange(USERS)}" for _ in range(SAMPLES - 1)]
+        heaviest = analytics.summary('user-0')['sessions']
+        print(f"Busiest user has {heaviest} events\n")
+
+        failed = False
+        for name, query in queries.items():
+            timings = []
+            for user in users:
+                start = time.perf_counter()
+                query(user)
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            worst = timings[-1]
+            print(f"{name:<26} p50 {timings[len(timings) // 2]:6.2f} ms  max {worst:6.2f} ms")
+            if worst > BUDGET_MS:
+                print(f"  FAIL: over the {BUDGET_MS:.0f} ms budget")
+                failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
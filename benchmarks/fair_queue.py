@@ -0,0 +1,103 @@
+# Runs one user spamming chat with a new session for every call, a few users chatting at a normal pace and
+# bulk generation jobs against the fake model, first behind a plain FIFO
+# semaphore, then with fair scheduling, then with per-user rate limits too,
+# and reports latency and rejections for each kind of caller.
+# Usage: python benchmarks/fair_queue.py [seconds_per_run]
+import os
+import sys
+import time
+import uuid
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_client import FakeModel
+from admission import AdmissionController, AdmissionRejected
+
+DURATION = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+CONCURRENCY = 4  # model calls at once
+MODEL_LATENCY = 0.1
+SPAM_THREADS = 12  # concurrent requests from the spamming user
+USERS = 4  # users chatting normally
+THINK_TIME = 0.5  # seconds between a normal user's questions
+BULK_THREADS = 4
+
+
+class Fifo:
+    # The baseline: a semaphore, first come first served
+    def __init__(self):
+        self.semaphore = threading.Semaphore(CONCURRENCY)
+
+    def wrap(self, model, user_id, priority, address=None):
+        semaphore = self.semaphore
+
+        class Model:
+            def generate_content(self, prompt, stream=False):
+                with semaphore:
+                    return model.generate_content(prompt)
+        return Model()
+
+
+def percentile(ordered, quantile):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+
+def run(controller):
+    model = FakeModel(latency=MODEL_LATENCY)
+    results = {'spammer': [], 'users': [], 'bulk': []}
+    rejected = {name: 0 for name in results}
+    lock = threading.Lock()
+    deadline = time.time() + DURATION
+
+    def caller(kind, address, priority, pause=0.0, new_sessions=False):
+        user_id = address
+        while time.time() < deadline:
+            if new_sessions:
+                # Drops its session cookie, so every call is a new user
+                user_id = uuid.uuid4().hex
+            wrapped = controller.wrap(model, user_id, priority, address)
+            started = time.perf_counter()
+            try:
+                wrapped.generate_content(f"{kind} question")
+            except AdmissionRejected:
+                with lock:
+                    rejected[kind] += 1
+                # Retry soon; the spammer doesn't honor Retry-After
+                time.sleep(pause or 0.01)
+                continue
+            with lock:
+                results[kind].append(time.perf_counter() - started)
+            time.sleep(pause)
+
+    threads = [threading.Thread(target=caller, args=('spammer', '10.0.0.1', 'chat', 0.0, True))
+               for _ in range(SPAM_THREADS)]
+    threads += [threading.Thread(target=caller, args=('users', f'10.0.1.{n}', 'chat', THINK_TIME))
+                for n in range(USERS)]
+    threads += [threading.Thread(target=caller, args=('bulk', None, 'batch')) for _ in range(BULK_THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, rejected
+
+
+def main():
+    modes = [
+        ('fifo', Fifo()),
+        ('fair', AdmissionController(concurrency=CONCURRENCY, user_rate=0, address_rate=0)),
+        ('fair + rate limit', AdmissionController(concurrency=CONCURRENCY)),
+    ]
+    print(f"{DURATION:.0f}s per run, {CONCURRENCY} model slots, {MODEL_LATENCY * 1000:.0f} ms per call\n")
+    print(f"{'mode':<18} {'caller':<8} {'calls':>6} {'p50 ms':>8} {'p95 ms':>8} {'429s':>6}")
+    for name, controller in modes:
+        results, rejected = run(controller)
+        for kind, latencies in results.items():
+            latencies.sort()
+            print(f"{name:<18} {kind:<8} {len(latencies):>6} {percentile(latencies, 0.5) * 1000:>8.0f} "
+                  f"{percentile(latencies, 0.95) * 1000:>8.0f} {rejected[kind]:>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+# Measures append latency of the study history backends as the log grows.
+# Usage: python benchmarks/history_writes.py [events]
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history_store import BACKENDS, make_event
+
+EVENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+REPORT_EVERY = EVENTS // 10
+
+
+def run(backend):
+    with tempfile.TemporaryDirectory() as tmp:
+        store = BACKENDS[backend](os.path.join(tmp, 'history'), batch_size=1)
+        print(f"\n{backend}: {EVENTS} events")
+        window_start = time.perf_counter()
+        for i in range(1, EVENTS + 1):
+            store.append(make_event('Mathematics', 'Algebra', 'Beginner', 'Chat', 1.5))
+            if i % REPORT_EVERY == 0:
+                elapsed = time.perf_counter() - window_start
+                print(f"  rows {i - REPORT_EVERY:>8}-{i:<8} {elapsed / REPORT_EVERY * 1e6:8.1f} us/append")
+                window_start = time.perf_counter()
+
+
+if __name__ == '__main__':
+    for backend in BACKENDS:
+        run(backend)
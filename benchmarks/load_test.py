@@ -0,0 +1,105 @@
+# Starts the web app under gunicorn with 1, 2 and 4 sync workers against the
+# fake model and reports chat throughput for each, to check that it scales
+# with the worker count.
+# Usage: python benchmarks/load_test.py [seconds_per_run] [concurrency]
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import threading
+import subprocess
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DURATION = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+CONCURRENCY = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+WORKERS = [1, 2, 4]
+MODEL_LATENCY = 0.2  # seconds per fake model call
+
+BODY = json.dumps({'question': 'What is a derivative?', 'subject': 'Mathematics',
+                   'topic': 'Calculus', 'difficulty': 'Beginner'}).encode('utf-8')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not start")
+
+
+def chat_request(base_url):
+    # The semantic cache is off in the server, so every request reaches the model
+    request = urllib.request.Request(f"{base_url}/chat", data=BODY, headers={
+        'Content-Type': 'application/json', 'X-Requested-With': 'XMLHttpRequest'})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        response.read()
+
+
+def run_load(base_url):
+    completed = [0]
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + DURATION
+
+    def client():
+        while time.time() < deadline:
+            try:
+                chat_request(base_url)
+                outcome = completed
+            except OSError:
+                outcome = errors
+            with lock:
+                outcome[0] += 1
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for _ in range(CONCURRENCY)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return completed[0] / (time.time() - start), errors[0]
+
+
+def main():
+    results = {}
+    # Run from a scratch directory so the benchmark doesn't touch local data
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, PYTHONPATH=ROOT, LLM_BACKEND='fake', FAKE_LLM_LATENCY=str(MODEL_LATENCY),
+                   APP_ENV='production', SECRET_KEY='load-test', STARTUP_CONNECTION_CHECK='off',
+                   SEMANTIC_CACHE='0', ADMISSION_ADDRESS_RATE='0')
+        for workers in WORKERS:
+            port = free_port()
+            server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b',
+                                       f'127.0.0.1:{port}', '--log-level', 'warning', 'wsgi:app'],
+                                      cwd=workdir, env=env)
+            try:
+                base_url = f"http://127.0.0.1:{port}"
+                wait_until_up(f"{base_url}/metrics")
+                throughput, errors = run_load(base_url)
+            finally:
+                server.terminate()
+                server.wait()
+            results[workers] = throughput
+            print(f"{workers} worker(s): {throughput:.1f} req/s, {errors} errors")
+
+    # With one request per worker at a time, the ideal is workers / latency
+    for workers, throughput in results.items():
+        ideal = workers / MODEL_LATENCY
+        print(f"{workers} worker(s): {throughput / ideal:.0%} of the ideal {ideal:.0f} req/s, "
+              f"{throughput / results[WORKERS[0]]:.2f}x one worker")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# Renders every prompt the apps send for the whole catalogue and compares
+# estimated input tokens per request with the copy-pasted f-string prompts
+# the template registry replaced.
+# Usage: python benchmarks/prompt_tokens.py
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_memory import estimate_tokens
+from prompts import TEMPLATES, study_material_prompt, practice_test_prompt, chat_prompt
+
+SUBJECTS = {
+    'Mathematics': ['Algebra', 'Calculus', 'Geometry', 'Statistics'],
+    'Science': ['Physics', 'Chemistry', 'Biology', 'Earth Science'],
+    'Languages': ['English', 'Spanish', 'French', 'German'],
+    'History': ['World History', 'American History', 'Ancient History', 'Modern History']
+}
+DIFFICULTIES = ['Beginner', 'Intermediate', 'Advanced']
+QUESTIONS = ['What is the most important idea here?', 'Can you give me an example?']
+HISTORY = "Summary: Discussed the basics.\nQ: What is the most important idea here?\nA: The key idea is..."
+
+
+# The prompts as they were written in web_app.py (html) and app.py (text)
+def legacy_study_material(subject, topic, difficulty, output_format):
+    if output_format == 'html':
+        return f"""You are an expert tutor in {subject}. Create comprehensive study material for {topic} at {difficulty} level.
+
+    Include the following sections:
+    1. Key Concepts: Explain the fundamental principles and theories
+    2. Important Formulas/Theorems: List and explain all relevant formulas or theorems
+    3. Step-by-Step Examples: Provide 3 detailed examples with full explanations
+    4. Practice Problems: Create 5 practice problems with varying difficulty
+    5. Common Mistakes: Highlight common misconceptions and how to avoid them
+    6. Study Tips: Provide specific strategies for mastering this topic
+
+    Format the response in HTML with appropriate headings and styling."""
+    return f"""You are an expert tutor in {subject}. Create comprehensive study material for {topic} at {difficulty} level.
+
+    Include the following sections:
+    1. Key Concepts: Explain the fundamental principles and theories
+    2. Important Formulas/Theorems: List and explain all relevant formulas or theorems
+    3. Step-by-Step Examples: Provide 3 detailed examples with full explanations
+    4. Practice Problems: Create 5 practice problems with varying difficulty
+    5. Common Mistakes: Highlight common misconceptions and how to avoid them
+    6. Study Tips: Provide specific strategies for mastering this topic
+
+    Format the response in a clear, structured way with headings and bullet points where appropriate."""
+
+
+def legacy_practice_test(subject, topic, difficulty):
+    return f"""You are an expert exam creator for {subject}. Create a 5-question practice test for {topic} at {difficulty} level.
+
+    For each question:
+    1. Write a clear, concise question
+    2. Provide 4 multiple choice options (A, B, C, D)
+    3. Indicate the correct answer
+    4. Provide a detailed explanation of why the answer is correct
+
+    Respond with JSON only, without markdown fences, in exactly this format:
+    {{"questions": [{{"question": "...", "options": {{"A": "...", "B": "...", "C": "...", "D": "..."}}, "answer": "A", "explanation": "..."}}]}}"""
+
+
+def legacy_chat(subject, topic, difficulty, question, history, output_format):
+    if output_format == 'html':
+        if history:
+            history = f"Conversation so far:\n{history}\n\n    "
+        return f"""You are an expert tutor in {subject}, specifically knowledgeable about {topic} at {difficulty} level.
+
+    {history}User Question: {question}
+
+    Provide a helpful, educational response that:
+    1. Directly addresses the user's question
+    2. Uses appropriate examples and analogies
+    3. Breaks down complex concepts into simpler parts
+    4. Encourages deeper understanding
+    5. Suggests related topics for further study
+
+    Format your response in HTML with appropriate styling. Use:
+    - <p> tags for paragraphs
+    - <ul> or <ol> for lists
+    - <code> for code snippets
+    - <strong> for important points
+    - <em> for emphasis
+    - <blockquote> for quotes or important notes
+
+    Make the response engaging and easy to read."""
+    if history:
+        history = f"Conversation so far:\n{history}\n\n        "
+    return f"""You are an expert tutor in {subject}, specifically knowledgeable about {topic} at {difficulty} level.
+
+        {history}User Question: {question}
+
+        Provide a helpful, educational response that:
+        1. Directly addresses the user's question
+        2. Uses appropriate examples and analogies
+        3. Breaks down complex concepts into simpler parts
+        4. Encourages deeper understanding
+        5. Suggests related topics for further study
+
+        Keep your response focused and concise while being thorough."""
+
+
+def requests():
+    # (template key, legacy prompt, new prompt) for every request in the catalogue
+    for subject, topics in SUBJECTS.items():
+        for topic in topics:
+            for difficulty in DIFFICULTIES:
+                for output_format in ('html', 'text'):
+                    yield (('study_material', output_format),
+                           legacy_study_material(subject, topic, difficulty, output_format),
+                           study_material_prompt(subject, topic, difficulty, output_format))
+                    for question in QUESTIONS:
+                        for history in ('', HISTORY):
+                            yield (('chat', output_format),
+                                   legacy_chat(subject, topic, difficulty, question, history, output_format),
+                                   chat_prompt(subject, topic, difficulty, question, history, output_format))
+                yield (('practice_test', 'json'), legacy_practice_test(subject, topic, difficulty),
+                       practice_test_prompt(subject, topic, difficulty))
+
+
+def main():
+    totals = {}
+    for key, before, after in requests():
+        counts = totals.setdefault(key, [0, 0, 0])
+        counts[0] += 1
+        counts[1] += estimate_tokens(before)
+        counts[2] += after.estimated_tokens
+
+    print(f"{'template':<32} {'static':>7} {'before':>7} {'after':>7} {'saved':>7}")
+    all_before = all_after = 0
+    for key, (requests_count, before, after) in totals.items():
+        template = TEMPLATES[key]
+        all_before += before
+        all_after += after
+        print(f"{template.version:<32} {template.estimated_static_tokens:>7} {before / requests_count:>7.0f} "
+              f"{after / requests_count:>7.0f} {1 - after / before:>7.0%}")
+    print(f"\nTokens per request are averaged over the catalogue; {1 - all_after / all_before:.0%} fewer "
+          f"input tokens overall ({all_before} -> {all_after})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# Checks which question pairs the semantic chat cache treats as the same
+# question, then times lookups in a full context. Exits non-zero when a pair
+# that must differ is matched, or a plain rephrasing is missed.
+# Usage: python benchmarks/semantic_matches.py
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from semantic_cache import SemanticCache  # noqa: E402
+
+CONTEXT = ('History', 'Modern', 'Beginner', 'fake')
+
+SAME = [
+    ('What is a derivative?', 'Can you explain what a derivative is?'),
+    ('What is a derivative?', 'Explain derivatives'),
+    ('What caused World War II?', 'what caused world war ii'),
+    ('Define photosynthesis', 'What does photosynthesis mean?'),
+]
+
+# Close in wording, different questions
+DIFFERENT = [
+    ('What caused World War I?', 'What caused World War II?'),
+    ('Compare the French vs American Revolution', 'Compare the French vs Russian Revolution'),
+    ('What is renewable energy?', 'What is nonrenewable energy?'),
+    ('What are the advantages of nuclear power?', 'What are the disadvantages of nuclear power?'),
+    ('Give an example of a reversible reaction', 'Give an example of an irreversible reaction'),
+    ('What is organic chemistry?', 'What is inorganic chemistry?'),
+    ('What is the derivative of x^2?', 'What is the derivative of x^3?'),
+]
+
+
+def check():
+    failures = []
+    for expected, pairs in ((True, SAME), (False, DIFFERENT)):
+        for cached, asked in pairs:
+            cache = SemanticCache()
+            cache.add(CONTEXT, cached, 'answer')
+            for name, answer in (('lookup', cache.lookup(CONTEXT, asked)),
+                                 ('fallback', cache.fallback(CONTEXT, asked))):
+                if (answer is not None) != expected:
+                    failures.append(f"{name}: {cached!r} {'missed' if expected else 'matched'} {asked!r}")
+    return failures
+
+
+def time_lookups(entries=256, lookups=2000):
+    cache = SemanticCache()
+    for n in range(entries):
+        cache.add(CONTEXT, f'What happened in year {n} of the topic {n % 17}?', 'answer')
+    started = time.perf_counter()
+    for n in range(lookups):
+        cache.lookup(CONTEXT, f'What happened in year {n % entries} of topic {n % 17}?')
+    return (time.perf_counter() - started) / lookups * 1000
+
+
+if __name__ == '__main__':
+    failures = check()
+    print(f"{len(SAME) + len(DIFFERENT)} pairs checked, {len(failures)} wrong")
+    for failure in failures:
+        print(f"  {failure}")
+    print(f"lookup: {time_lookups():.3f} ms in a context of 256 questions")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,55 @@
+# Measures import time of app.py and web_app.py in fresh interpreters and
+# fails when startup gets slower than the budget or pulls in heavy modules.
+# Usage: python benchmarks/startup.py [runs] [budget_seconds]
+import os
+import sys
+import json
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+BUDGET = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+
+# Modules that must only be imported on first use
+DEFERRED = ['pandas', 'numpy', 'google.generativeai']
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'loaded': [m for m in {deferred!r} if m in sys.modules]}}))
+"""
+
+
+def measure(module, workdir):
+    # No model call happens at import, so a placeholder key is enough
+    env = dict(os.environ, PYTHONPATH=ROOT, STARTUP_CONNECTION_CHECK='off')
+    env.setdefault('GEMINI_API_KEY', 'startup-benchmark')
+    output = subprocess.run([sys.executable, '-c', PROBE.format(module=module, deferred=DEFERRED)],
+                            cwd=workdir, env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    failed = False
+    # Run from a scratch directory so the benchmark doesn't touch local data
+    with tempfile.TemporaryDirectory() as workdir:
+        for module in ['app', 'web_app']:
+            runs = [measure(module, workdir) for _ in range(RUNS)]
+            median = statistics.median(run['seconds'] for run in runs)
+            loaded = sorted(set(m for run in runs for m in run['loaded']))
+            print(f"{module}: median import {median * 1000:.0f} ms over {RUNS} runs")
+            if median > BUDGET:
+                print(f"  FAIL: over the {BUDGET * 1000:.0f} ms budget")
+                failed = True
+            if loaded:
+                print(f"  FAIL: imported at startup: {', '.join(loaded)}")
+                failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
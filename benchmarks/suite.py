@@ -0,0 +1,310 @@
+# Runs scripted workloads against every web route and the CLI functions with
+# a seeded fake model instead of Gemini, and writes latency percentiles,
+# throughput, errors and memory per workload to JSON for comparing runs.
+# Usage: python benchmarks/suite.py run [results.json] [requests_per_workload]
+#        python benchmarks/suite.py compare old.json new.json
+import io
+import os
+import sys
+import json
+import time
+import hashlib
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from unittest import mock
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONCURRENCY = 8
+
+# Fake model profiles; latencies are lognormal around the median, like real API calls
+PROFILES = {
+    'default': dict(latency=0.05, jitter=0.3, distribution='lognormal', chunks=8, seed=1),
+    'flaky': dict(latency=0.05, jitter=0.3, distribution='lognormal', chunks=8, seed=2,
+                  failure_rate=0.2, error_code=503),
+    # Every call fails; its circuit breaker is open from the start
+    'outage': dict(latency=0.05, chunks=8, seed=3, failure_rate=1.0, error_code=503),
+}
+
+
+def fake_answer(prompt):
+    # Deterministic answers shaped like the real ones: a JSON test for test
+    # prompts, a few KB of HTML for everything else
+    seed = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:8]
+    if 'Respond with JSON' in prompt:
+        return json.dumps({'questions': [
+            {'question': f'Question {n} ({seed})?',
+             'options': {letter: f'Option {letter}' for letter in 'ABCD'},
+             'answer': 'ABCD'[n % 4], 'explanation': f'Explanation {n}.'}
+            for n in range(5)]})
+    sections = ''.join(f"<h2>Section {n}</h2>\n<p>{'Lorem ipsum dolor sit amet. ' * 20}</p>\n"
+                       f"<ul><li>Point one</li><li>Point two</li></ul>\n" for n in range(6))
+    return f"<div class=\"study\">\n<!-- {seed} -->\n{sections}</div>"
+
+
+def percentile(ordered, quantile):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+
+def rss_mb():
+    # Resident memory now, from /proc where available, else the peak
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        if resource is None:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Suite:
+    def __init__(self, requests):
+        self.requests = requests
+        self.results = []
+
+        # Imported here, after run() has set up the environment
+        import app
+        import web_app
+        from llm_client import LLMClient, FakeModel
+        from circuit_breaker import CircuitBreaker
+
+        self.app = app
+        self.web_app = web_app
+        self.models = {name: LLMClient(FakeModel(responder=fake_answer, **profile), backoff_base=0.01)
+                       for name, profile in PROFILES.items()}
+        self.models['outage'].breaker = CircuitBreaker()
+        self.models['outage'].breaker.trip('Outage workload')
+        self.flask_app = web_app.create_app()
+        # The templates sit next to web_app.py in this checkout
+        self.flask_app.template_folder = ROOT
+        self._local = threading.local()
+
+    def use_model(self, profile):
+        self.web_app.model = self.app.model = self.models[profile]
+
+    def client(self):
+        # One test client per thread, each with its own session
+        if not hasattr(self._local, 'client'):
+            self._local.client = self.flask_app.test_client()
+        return self._local.client
+
+    def measure(self, name, target, op, requests=None, concurrency=CONCURRENCY, profile='default'):
+        # Runs op(i) for each request index and records latency and failures;
+        # an op fails by raising or by returning an HTTP error status
+        self.use_model(profile)
+        requests = requests or self.requests
+        latencies = []
+        errors = []
+
+        def timed(i):
+            start = time.perf_counter()
+            try:
+                status = op(i)
+                failed = status is not None and status >= 400
+            except Exception:
+                failed = True
+            elapsed = time.perf_counter() - start
+            latencies.append(elapsed)
+            if failed:
+                errors.append(i)
+
+        calls_before = self.models[profile].backend.calls
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(timed, range(requests)))
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+        result = {
+            'name': name,
+            'target': target,
+            'profile': profile,
+            'requests': requests,
+            'concurrency': concurrency,
+            'errors': len(errors),
+            'model_calls': self.models[profile].backend.calls - calls_before,
+            'seconds': round(elapsed, 3),
+            'throughput': round(requests / elapsed, 2),
+            'p50': round(percentile(latencies, 0.50), 5),
+            'p95': round(percentile(latencies, 0.95), 5),
+            'p99': round(percentile(latencies, 0.99), 5),
+            'max': round(latencies[-1], 5),
+            'rss_mb': round(rss_mb() or 0, 1)
+        }
+        self.results.append(result)
+        print(f"{name:<28} {result['throughput']:>8.1f} req/s  p50 {result['p50'] * 1000:7.1f} ms  "
+              f"p95 {result['p95'] * 1000:7.1f} ms  p99 {result['p99'] * 1000:7.1f} ms  "
+              f"{result['errors']} errors  {result['model_calls']} model calls")
+        return result
+
+    def web_workloads(self):
+        web_app = self.web_app
+        form = {'subject': 'Mathematics', 'topic': 'Algebra', 'difficulty': 'Beginner'}
+
+        def post(path, data):
+            return self.client().post(path, data=data).status_code
+
+        def xhr(data):
+            response = self.client().post('/chat', json=dict(form, **data),
+                                          headers={'X-Requested-With': 'XMLHttpRequest'})
+            response.get_data()
+            return response.status_code
+
+        web_app.STREAM_RESPONSES = False
+        self.measure('study_material_cold', 'POST /study_material',
+                     lambda i: post('/study_material', dict(form, topic=f'Algebra {i}')))
+        self.measure('study_material_warm', 'POST /study_material', lambda i: post('/study_material', form))
+        self.measure('study_material_content', 'GET /study_material/content',
+                     lambda i: self.client().get('/study_material/content', query_string=form,
+                                                 headers={'Accept-Encoding': 'gzip, br'}).status_code)
+        etag = self.client().get('/study_material/content', query_string=form).headers['ETag']
+        self.measure('study_material_304', 'GET /study_material/content',
+                     lambda i: self.client().get('/study_material/content', query_string=form,
+                                                 headers={'If-None-Match': etag}).status_code)
+
+        def stream(i):
+            response = self.client().get('/study_material/stream', query_string=dict(form, topic=f'Stream {i}'))
+            if 'event: error' in response.get_data(as_text=True):
+                raise RuntimeError('Stream failed')
+            return response.status_code
+        self.measure('study_material_stream', 'GET /study_material/stream', stream)
+
+        self.measure('practice_test_cold', 'POST /practice_test',
+                     lambda i: post('/practice_test', {'subject': 'Science', 'topic': f'Physics {i}'}))
+        self.measure('practice_test_bank', 'POST /practice_test',
+                     lambda i: post('/practice_test', {'subject': 'Science', 'topic': 'Physics'}))
+
+        store = web_app.get_test_store()
+        questions = json.loads(fake_answer('Respond with JSON'))['questions']
+        tests = [store.create_test('Science', 'Physics', questions)[0] for _ in range(self.requests)]
+        answers = {f'q{n}': 'A' for n in range(1, 6)}
+        self.measure('submit_test', 'POST /submit_test',
+                     lambda i: self.client().post('/submit_test', json={'test_id': tests[i],
+                                                                        'answers': answers}).status_code)
+
+        def start_chat():
+            # A form POST gives each thread's session its own chat id
+            if not getattr(self._local, 'chatting', False):
+                self.client().post('/chat', data=form)
+                self._local.chatting = True
+
+        def chat(i, stream=False):
+            start_chat()
+            return xhr({'question': f'Question {i}?', 'stream': stream})
+        self.measure('chat', 'POST /chat', chat)
+        self.measure('chat_stream', 'POST /chat (stream)', lambda i: chat(i, stream=True))
+        self.measure('chat_flaky', 'POST /chat', chat, profile='flaky')
+
+        phrasings = ['What is a derivative?', 'Explain derivatives', 'what are derivatives', 'Derivatives?']
+
+        def rephrased(i):
+            # Each question opens a new chat, so the semantic cache applies
+            self.client().post('/chat', data=form)
+            self._local.chatting = False
+            return xhr({'question': phrasings[i % len(phrasings)]})
+        self.measure('chat_rephrased', 'POST /chat (semantic cache)', rephrased)
+        # Answered from the semantic cache or the cached study material
+        self.measure('chat_outage', 'POST /chat (breaker open)', chat, profile='outage')
+
+        self.measure('statistics', 'GET /statistics', lambda i: self.client().get('/statistics').status_code)
+
+    def cli_workloads(self):
+        app = self.app
+        requests = max(1, self.requests // 4)
+
+        def quietly(fn, inputs=()):
+            with redirect_stdout(io.StringIO()), mock.patch('builtins.input', side_effect=list(inputs)):
+                fn()
+
+        self.measure('cli_generate_study_material', 'app.generate_study_material',
+                     lambda i: quietly(lambda: app.generate_study_material('History', f'Rome {i}', 'Beginner')),
+                     requests=requests, concurrency=1)
+        self.measure('cli_generate_practice_test', 'app.generate_practice_test',
+                     lambda i: quietly(lambda: app.generate_practice_test('History', f'Greece {i}')),
+                     requests=requests, concurrency=1)
+        self.measure('cli_chat_with_ai', 'app.chat_with_ai (3 questions)',
+                     lambda i: quietly(lambda: app.chat_with_ai('History', 'Egypt', 'Beginner'),
+                                       [f'Question {i}.{n}?' for n in range(3)] + ['exit']),
+                     requests=requests, concurrency=1)
+        self.measure('cli_view_statistics', 'app.view_statistics',
+                     lambda i: quietly(app.view_statistics, ['']), requests=requests, concurrency=1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(output_path, requests):
+    # Scratch databases, the fake model and no background work at startup; no
+    # per-user rate limit either, since each thread is one very busy user
+    os.environ.update(LLM_BACKEND='fake', STARTUP_CONNECTION_CHECK='off', PREGENERATE='0',
+                      CHAT_STORE='memory', SECRET_KEY='benchmark', ADMISSION_USER_RATE='0',
+                      ADMISSION_ADDRESS_RATE='0')
+    sys.path.insert(0, ROOT)
+
+    started = datetime.now()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            suite = Suite(requests)
+            suite.web_workloads()
+            suite.cli_workloads()
+        finally:
+            os.chdir(ROOT)
+    report = {
+        'timestamp': started.isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'requests_per_workload': requests,
+        'profiles': PROFILES,
+        'workloads': suite.results
+    }
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {output_path}")
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = {w['name']: w for w in json.load(f)['workloads']}
+    with open(new_path) as f:
+        new = {w['name']: w for w in json.load(f)['workloads']}
+
+    def change(before, after):
+        return f"{(after - before) / before:+.0%}" if before else 'n/a'
+
+    print(f"{'workload':<28} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>8}")
+    for name in new:
+        if name in old:
+            a, b = old[name], new[name]
+            print(f"{name:<28} {change(a['p50'], b['p50']):>8} {change(a['p95'], b['p95']):>8} "
+                  f"{change(a['p99'], b['p99']):>8} {change(a['throughput'], b['throughput']):>8}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'run':
+        output_path = os.path.abspath(sys.argv[2] if len(sys.argv) > 2 else
+                                      f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json")
+        run(output_path, int(sys.argv[3]) if len(sys.argv) > 3 else 200)
+    elif len(sys.argv) == 4 and sys.argv[1] == 'compare':
+        compare(sys.argv[2], sys.argv[3])
+    else:
+        print("Usage: python benchmarks/suite.py run [results.json] [requests_per_workload]\n"
+              "       python benchmarks/suite.py compare old.json new.json")
+        sys.exit(1)
@@ -0,0 +1,219 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Chat memory defaults, overridable through CHAT_* in the .env file
+CHAT_HISTORY_TOKENS = 1500    # budget for the history included in each prompt
+CHAT_TURN_TOKENS = 300        # longest answer kept verbatim per turn
+CHAT_MAX_SESSIONS = 1000
+CHAT_IDLE_TIMEOUT = 30 * 60   # seconds before an idle session is evicted
+CHAT_DB = 'chat_sessions.db'
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text
+    return (len(text) + 3) // 4
+
+
+def plain_text(text):
+    # Answers are HTML in the web app; tags cost tokens and add nothing
+    return ' '.join(re.sub(r'<[^>]+>', ' ', text).split())
+
+
+def truncate_tokens(text, tokens):
+    limit = tokens * 4
+    return text if len(text) <= limit else text[:limit].rsplit(' ', 1)[0] + '...'
+
+
+def first_sentence(text):
+    match = re.match(r'(.+?[.!?])(\s|$)', text)
+    return match.group(1) if match else text
+
+
+class ChatMemory:
+    """Conversation history for one chat, kept within a token budget.
+
+    Recent turns are included verbatim. When they no longer fit in
+    `token_budget`, the oldest turns are folded into a running summary
+    (the question plus the first sentence of the answer), and the summary
+    itself is trimmed from the front, so prompt size stays bounded however
+    long the conversation runs.
+    """
+
+    def __init__(self, token_budget=CHAT_HISTORY_TOKENS, turn_tokens=CHAT_TURN_TOKENS):
+        self.token_budget = token_budget
+        self.turn_tokens = turn_tokens
+        self.summary = ''
+        self.turns = []
+        self.last_used = time.time()
+
+    def _turn_text(self, question, answer):
+        return f"Student: {question}\nTutor: {answer}"
+
+    def _tokens(self):
+        return estimate_tokens(self.summary) + sum(estimate_tokens(self._turn_text(q, a)) for q, a in self.turns)
+
+    def add_turn(self, question, answer):
+        self.turns.append((question, truncate_tokens(plain_text(answer), self.turn_tokens)))
+        self.last_used = time.time()
+        while len(self.turns) > 1 and self._tokens() > self.token_budget:
+            old_question, old_answer = self.turns.pop(0)
+            self.summary = f"{self.summary} Asked about: {old_question} ({first_sentence(old_answer)})".strip()
+        summary_budget = self.token_budget // 3
+        if estimate_tokens(self.summary) > summary_budget:
+            self.summary = '...' + self.summary[-summary_budget * 4:]
+
+    def context(self):
+        # History block to prepend to the next prompt, '' for a new chat
+        self.last_used = time.time()
+        parts = []
+        if self.summary:
+            parts.append(f"Earlier in this conversation: {self.summary}")
+        parts.extend(self._turn_text(q, a) for q, a in self.turns)
+        return '\n'.join(parts)
+
+    def to_dict(self):
+        return {'summary': self.summary, 'turns': self.turns}
+
+    @classmethod
+    def from_dict(cls, data, token_budget=CHAT_HISTORY_TOKENS):
+        memory = cls(token_budget)
+        memory.summary = data.get('summary', '')
+        memory.turns = [tuple(turn) for turn in data.get('turns', [])]
+        return memory
+
+
+class ChatSessionStore:
+    # Per-session chat memories, bounded in count and evicted when idle
+    def __init__(self, max_sessions=CHAT_MAX_SESSIONS, idle_timeout=CHAT_IDLE_TIMEOUT,
+                 token_budget=CHAT_HISTORY_TOKENS):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.token_budget = token_budget
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        cutoff = time.time() - self.idle_timeout
+        while self._sessions:
+            chat_id, memory = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and memory.last_used >= cutoff:
+                break
+            del self._sessions[chat_id]
+
+    def get(self, chat_id):
+        with self._lock:
+            memory = self._sessions.get(chat_id)
+            if memory is None:
+                memory = self._sessions[chat_id] = ChatMemory(self.token_budget)
+            self._sessions.move_to_end(chat_id)
+            memory.last_used = time.time()
+            self._evict()
+            return memory
+
+    def context(self, chat_id):
+        memory = self.get(chat_id)
+        with self._lock:
+            return memory.context()
+
+    def add_turn(self, chat_id, question, answer):
+        memory = self.get(chat_id)
+        with self._lock:
+            memory.add_turn(question, answer)
+
+    def drop(self, chat_id):
+        with self._lock:
+            self._sessions.pop(chat_id, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class SqliteChatSessionStore:
+    """Chat memories kept in SQLite, shared by every worker process.
+
+    Same interface as ChatSessionStore. Each turn loads the memory, updates
+    it and writes it back in one transaction, so a chat can move between
+    workers from one request to the next. Idle and excess sessions are
+    deleted on write, oldest first.
+    """
+
+    def __init__(self, path=CHAT_DB, max_sessions=CHAT_MAX_SESSIONS, idle_timeout=CHAT_IDLE_TIMEOUT,
+                 token_budget=CHAT_HISTORY_TOKENS):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.token_budget = token_budget
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS chats (
+                id TEXT PRIMARY KEY,
+                memory TEXT NOT NULL,
+                last_used REAL NOT NULL)""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS chats_last_used ON chats (last_used)")
+
+    def _load(self, chat_id):
+        row = self._conn.execute("SELECT memory, last_used FROM chats WHERE id = ?", (chat_id,)).fetchone()
+        if row is None or row[1] < time.time() - self.idle_timeout:
+            return ChatMemory(self.token_budget)
+        return ChatMemory.from_dict(json.loads(row[0]), self.token_budget)
+
+    def _evict(self):
+        self._conn.execute("DELETE FROM chats WHERE last_used < ?", (time.time() - self.idle_timeout,))
+        self._conn.execute("""DELETE FROM chats WHERE id IN (
+            SELECT id FROM chats ORDER BY last_used DESC LIMIT -1 OFFSET ?)""", (self.max_sessions,))
+
+    def get(self, chat_id):
+        with self._lock:
+            return self._load(chat_id)
+
+    def context(self, chat_id):
+        return self.get(chat_id).context()
+
+    def add_turn(self, chat_id, question, answer):
+        with self._lock, self._conn:
+            # BEGIN IMMEDIATE takes the write lock before reading, so turns
+            # added by two workers at once are not lost
+            self._conn.execute("BEGIN IMMEDIATE")
+            memory = self._load(chat_id)
+            memory.add_turn(question, answer)
+            self._conn.execute("INSERT OR REPLACE INTO chats VALUES (?, ?, ?)",
+                               (chat_id, json.dumps(memory.to_dict()), memory.last_used))
+            self._evict()
+
+    def drop(self, chat_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_chat_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            # In-process memory by default; CHAT_STORE=sqlite (the default with
+            # APP_ENV=production) shares sessions between worker processes
+            default = 'sqlite' if os.getenv('APP_ENV') == 'production' else 'memory'
+            options = dict(
+                max_sessions=int(os.getenv('CHAT_MAX_SESSIONS', CHAT_MAX_SESSIONS)),
+                idle_timeout=float(os.getenv('CHAT_IDLE_TIMEOUT', CHAT_IDLE_TIMEOUT)),
+                token_budget=int(os.getenv('CHAT_HISTORY_TOKENS', CHAT_HISTORY_TOKENS))
+            )
+            if os.getenv('CHAT_STORE', default) == 'sqlite':
+                _store = SqliteChatSessionStore(os.getenv('CHAT_DB', CHAT_DB), **options)
+            else:
+                _store = ChatSessionStore(**options)
+        return _store
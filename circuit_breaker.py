@@ -0,0 +1,136 @@
+import time
+import threading
+from collections import deque
+
+from metrics import get_metrics
+
+# Circuit breaker defaults, overridable through BREAKER_* in the .env file
+BREAKER_WINDOW = 60.0  # seconds of recent calls the rates are computed over
+BREAKER_MIN_CALLS = 5  # calls in the window before the breaker may trip
+BREAKER_FAILURE_RATE = 0.5  # share of failed or slow calls that trips it
+BREAKER_SLOW_CALL = 30.0  # seconds after which a successful call counts as slow
+BREAKER_PROBE_INTERVAL = 15.0  # seconds between probes while open
+
+STATES = {'closed': 0, 'open': 1}
+
+
+class CircuitOpenError(Exception):
+    code = 503
+
+    def __init__(self, retry_after):
+        super().__init__(f"Model calls are suspended after repeated failures; retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Stops calling the model while it is failing or too slow.
+
+    Outcomes of recent calls are kept for `window` seconds. Once there are
+    at least `min_calls` of them and `failure_rate` of them failed or took
+    longer than `slow_call`, the breaker opens: calls are rejected at once
+    with CircuitOpenError instead of queueing behind an upstream that
+    isn't answering, and callers serve fallback content. While open, a
+    background thread runs `probe` every `probe_interval` seconds and
+    closes the breaker on the first success.
+    """
+
+    def __init__(self, probe=None, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 failure_rate=BREAKER_FAILURE_RATE, slow_call=BREAKER_SLOW_CALL,
+                 probe_interval=BREAKER_PROBE_INTERVAL):
+        self.probe = probe
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.probe_interval = probe_interval
+        self.state = 'closed'
+        self.opened_at = None
+        self.last_error = None
+        self._calls = deque()  # (time, failed)
+        self._failed = 0
+        self._probing = False
+        self._lock = threading.Lock()
+        get_metrics().set_gauge('llm_circuit_state', STATES['closed'])
+
+    def _prune(self, now):
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._failed -= self._calls.popleft()[1]
+
+    def _transition(self, state):
+        self.state = state
+        metrics = get_metrics()
+        metrics.set_gauge('llm_circuit_state', STATES[state])
+        metrics.inc('llm_circuit_transitions_total', state=state)
+
+    def retry_after(self):
+        # Seconds until the next probe may close the breaker
+        if self.state == 'closed':
+            return 0.0
+        return max(1.0, self.opened_at + self.probe_interval - time.time())
+
+    def check(self):
+        # Raise if calls are currently suspended
+        if self.state == 'open':
+            get_metrics().inc('llm_circuit_rejected_total')
+            raise CircuitOpenError(self.retry_after())
+
+    @property
+    def is_open(self):
+        return self.state == 'open'
+
+    def record(self, ok, duration=0.0, error=None):
+        failed = not ok or duration > self.slow_call
+        now = time.time()
+        with self._lock:
+            self._calls.append((now, failed))
+            self._failed += failed
+            self._prune(now)
+            if failed:
+                self.last_error = str(error) if error else f"Call took {duration:.1f}s"
+            if (self.state == 'closed' and len(self._calls) >= self.min_calls
+                    and self._failed >= self.failure_rate * len(self._calls)):
+                self._open(now)
+
+    def trip(self, error=None):
+        # Open straight away, e.g. when a startup check already failed
+        with self._lock:
+            self.last_error = str(error) if error else self.last_error
+            if self.state == 'closed':
+                self._open(time.time())
+
+    def _open(self, now):
+        self.opened_at = now
+        self._transition('open')
+        if self.probe is not None and not self._probing:
+            self._probing = True
+            threading.Thread(target=self._probe_until_closed, name='llm-probe', daemon=True).start()
+
+    def _probe_until_closed(self):
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                self.probe()
+            except Exception as e:
+                with self._lock:
+                    self.opened_at = time.time()
+                    self.last_error = str(e)
+                get_metrics().inc('llm_circuit_probes_total', outcome='error')
+                continue
+            get_metrics().inc('llm_circuit_probes_total', outcome='ok')
+            with self._lock:
+                self._calls.clear()
+                self._failed = 0
+                self._probing = False
+                self._transition('closed')
+            return
+
+    def stats(self):
+        with self._lock:
+            self._prune(time.time())
+            return {
+                'state': self.state,
+                'calls': len(self._calls),
+                'failed': self._failed,
+                'retry_after': round(self.retry_after(), 1),
+                'last_error': self.last_error
+            }
@@ -0,0 +1,193 @@
+import os
+import re
+import gzip
+import html
+import hashlib
+import threading
+from collections import OrderedDict
+from html.parser import HTMLParser
+
+from metrics import get_metrics
+
+try:
+    import brotli
+except ImportError:
+    # Brotli is optional; without it fragments are only precompressed with gzip
+    brotli = None
+
+# Fragment cache defaults, overridable through FRAGMENT_* in the .env file
+FRAGMENT_CACHE_BYTES = 64 * 1024 * 1024
+
+# Tags the model may use in its answers; anything else is dropped, keeping its text
+ALLOWED_TAGS = {
+    'a', 'abbr', 'article', 'b', 'blockquote', 'br', 'caption', 'code', 'dd', 'del', 'div', 'dl', 'dt',
+    'em', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'i', 'ins', 'kbd', 'li', 'mark', 'ol', 'p',
+    'pre', 'q', 's', 'section', 'small', 'span', 'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'tfoot',
+    'th', 'thead', 'tr', 'u', 'ul'
+}
+VOID_TAGS = {'br', 'hr'}
+# Open tags that a new start tag closes implicitly, as browsers do
+IMPLIED_END = {'li': {'li'}, 'p': {'p'}, 'dt': {'dt', 'dd'}, 'dd': {'dt', 'dd'},
+               'tr': {'tr', 'td', 'th'}, 'td': {'td', 'th'}, 'th': {'td', 'th'}}
+# Tags dropped together with everything inside them
+DROPPED_TAGS = {'script', 'style', 'head', 'title', 'iframe', 'object', 'embed', 'noscript', 'template',
+                'svg', 'math', 'textarea', 'select'}
+ALLOWED_ATTRIBUTES = {'class', 'style', 'title', 'href', 'colspan', 'rowspan', 'start'}
+SAFE_URL = re.compile(r'^(https?:|mailto:|#)', re.IGNORECASE)
+UNSAFE_STYLE = re.compile(r'url\s*\(|expression\s*\(|javascript:', re.IGNORECASE)
+FENCE = re.compile(r'^\s*```[a-z]*\s*|\s*```\s*$', re.IGNORECASE)
+
+
+class _FragmentBuilder(HTMLParser):
+    # Re-emits allowed markup only, optionally collapsing whitespace
+    def __init__(self, minify):
+        super().__init__(convert_charrefs=True)
+        self.minify = minify
+        self.out = []
+        self.open_tags = []
+        self.dropping = 0
+        self.pre = 0
+
+    def _attributes(self, tag, attrs):
+        parts = []
+        for name, value in attrs:
+            value = value or ''
+            if name not in ALLOWED_ATTRIBUTES:
+                continue
+            if name == 'href' and (tag != 'a' or not SAFE_URL.match(value.strip())):
+                continue
+            if name == 'style' and UNSAFE_STYLE.search(value):
+                continue
+            parts.append(f' {name}="{html.escape(value, quote=True)}"')
+        return ''.join(parts)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROPPED_TAGS:
+            self.dropping += 1
+        if self.dropping or tag not in ALLOWED_TAGS:
+            return
+        while self.open_tags and self.open_tags[-1] in IMPLIED_END.get(tag, ()):
+            self.out.append(f'</{self.open_tags.pop()}>')
+        self.out.append(f'<{tag}{self._attributes(tag, attrs)}>')
+        if tag in VOID_TAGS:
+            return
+        self.open_tags.append(tag)
+        if tag == 'pre':
+            self.pre += 1
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag in DROPPED_TAGS:
+            self.dropping = max(0, self.dropping - 1)
+            return
+        if self.dropping or tag not in self.open_tags:
+            return
+        # Close anything left open inside this tag, so stray end tags can't
+        # reach outside the fragment
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            self.out.append(f'</{open_tag}>')
+            if open_tag == 'pre':
+                self.pre -= 1
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self.dropping:
+            return
+        if self.minify and not self.pre:
+            data = re.sub(r'\s+', ' ', data)
+        self.out.append(html.escape(data, quote=False))
+
+    def result(self):
+        self.close()
+        self.out.extend(f'</{tag}>' for tag in reversed(self.open_tags))
+        self.open_tags = []
+        return ''.join(self.out).strip()
+
+
+def sanitize_html(text, minify=True):
+    # Model HTML reduced to an allowlist of tags and attributes, without
+    # scripts, event handlers or javascript: links
+    builder = _FragmentBuilder(minify)
+    builder.feed(FENCE.sub('', text))
+    return builder.result()
+
+
+class Fragment:
+    # A sanitized, minified answer with its ETag and precompressed bodies
+    def __init__(self, text):
+        self.body = sanitize_html(text).encode('utf-8')
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+        self.encodings = {'gzip': gzip.compress(self.body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.encodings['br'] = brotli.compress(self.body, mode=brotli.MODE_TEXT)
+
+    @property
+    def html(self):
+        return self.body.decode('utf-8')
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(data) for data in self.encodings.values())
+
+    def encoded(self, accepted):
+        # Smallest precompressed body the client accepts, else the plain one
+        for encoding in ('br', 'gzip'):
+            if encoding in self.encodings and encoding in accepted:
+                return encoding, self.encodings[encoding]
+        return None, self.body
+
+
+class FragmentCache:
+    """Finished fragments, built once per distinct model response.
+
+    Responses are post-processed on first use and kept, keyed by a hash of
+    the raw response, in an LRU bounded by `max_bytes`. The ETag is a hash
+    of the processed HTML, so every worker process derives the same one for
+    the same response and conditional requests work whichever worker
+    serves them.
+    """
+
+    def __init__(self, max_bytes=FRAGMENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def process(self, text):
+        source = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        with self._lock:
+            fragment = self._fragments.get(source)
+            if fragment is not None:
+                self._fragments.move_to_end(source)
+        get_metrics().inc('fragment_cache_lookups_total', result='miss' if fragment is None else 'hit')
+        if fragment is not None:
+            return fragment
+        fragment = Fragment(text)
+        with self._lock:
+            if source not in self._fragments:
+                self._fragments[source] = fragment
+                self.total_bytes += fragment.size
+            while self.total_bytes > self.max_bytes and len(self._fragments) > 1:
+                _, evicted = self._fragments.popitem(last=False)
+                self.total_bytes -= evicted.size
+        return fragment
+
+    def __len__(self):
+        return len(self._fragments)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_fragment_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = FragmentCache(int(os.getenv('FRAGMENT_CACHE_BYTES', FRAGMENT_CACHE_BYTES)))
+        return _cache
@@ -0,0 +1,268 @@
+import os
+import sys
+import csv
+import json
+import atexit
+import sqlite3
+import threading
+from datetime import datetime
+
+# History defaults, overridable through HISTORY_* in the .env file
+HISTORY_BACKEND = 'sqlite'
+HISTORY_PATHS = {'sqlite': 'study_history.db', 'jsonl': 'study_history.jsonl'}
+HISTORY_BATCH_SIZE = 1
+HISTORY_FSYNC = False
+
+# Owner of CLI sessions and of events recorded before history was per user
+DEFAULT_USER = 'local'
+
+HISTORY_COLUMNS = ['timestamp', 'subject', 'topic', 'difficulty', 'activity_type', 'duration', 'user_id', 'score']
+
+
+def make_event(subject, topic, difficulty, activity_type, duration, timestamp=None, user_id=DEFAULT_USER, score=None):
+    return {
+        'timestamp': (timestamp or datetime.now()).isoformat(sep=' '),
+        'subject': subject,
+        'topic': topic,
+        'difficulty': difficulty,
+        'activity_type': activity_type,
+        'duration': float(duration or 0),
+        'user_id': user_id,
+        'score': score
+    }
+
+
+class HistoryStore:
+    """Append-only log of study events.
+
+    Writes are buffered and flushed every `batch_size` events (and at exit),
+    optionally followed by an fsync. Readers page through the log with
+    `read_since(cursor)`, which returns the events written after `cursor`
+    and the cursor to pass next time, so projections can catch up
+    incrementally instead of rereading the whole history.
+    """
+
+    def __init__(self, path, batch_size=HISTORY_BATCH_SIZE, fsync=HISTORY_FSYNC):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.fsync = fsync
+        self._buffer = []
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def append(self, event):
+        with self._lock:
+            self._buffer.append(event)
+            if len(self._buffer) >= self.batch_size:
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if self._buffer:
+            self._write(self._buffer)
+            self._buffer = []
+
+    def _write(self, events):
+        raise NotImplementedError
+
+    def read_since(self, cursor=0):
+        raise NotImplementedError
+
+    def read_all(self):
+        self.flush()
+        return self.read_since(0)[0]
+
+
+class JsonlHistoryStore(HistoryStore):
+    def _write(self, events):
+        data = ''.join(json.dumps(event) + '\n' for event in events).encode('utf-8')
+        # O_APPEND makes each batch a single atomic append, even with several
+        # worker processes writing to the same file
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+            if self.fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def read_since(self, cursor=0):
+        if not os.path.exists(self.path):
+            return [], cursor
+        events = []
+        with open(self.path, 'rb') as f:
+            f.seek(cursor)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Partially written line, pick it up on the next read
+                    break
+                events.append(json.loads(line))
+                cursor += len(line)
+        return events, cursor
+
+
+class SqliteHistoryStore(HistoryStore):
+    def __init__(self, path, batch_size=HISTORY_BATCH_SIZE, fsync=HISTORY_FSYNC):
+        super().__init__(path, batch_size, fsync)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA synchronous={'FULL' if fsync else 'NORMAL'}")
+        with self._conn:
+            # Take the write lock up front so two processes opening a log
+            # for the first time don't both upgrade it
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT NOT NULL,
+                subject TEXT,
+                topic TEXT,
+                difficulty TEXT,
+                activity_type TEXT,
+                duration REAL NOT NULL DEFAULT 0,
+                user_id TEXT NOT NULL DEFAULT 'local',
+                score REAL)""")
+            # Logs created before history was per user lack the last two
+            # columns; adding them with a default doesn't rewrite old rows
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(events)")]
+            if 'user_id' not in columns:
+                self._conn.execute(f"ALTER TABLE events ADD COLUMN user_id TEXT NOT NULL DEFAULT '{DEFAULT_USER}'")
+            if 'score' not in columns:
+                self._conn.execute("ALTER TABLE events ADD COLUMN score REAL")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS events_user_time ON events (user_id, timestamp)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS events_user_activity ON events (user_id, activity_type)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS events_user_scores ON events (user_id, timestamp) "
+                               "WHERE score IS NOT NULL")
+
+            # Per user, day and topic totals, kept up to date by _write, so
+            # the analytics queries in study_analytics.py read at most one
+            # row per day and topic however many events a user has
+            has_totals = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_totals'").fetchone()
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS daily_totals (
+                user_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                sessions INTEGER NOT NULL,
+                seconds REAL NOT NULL,
+                score_sum REAL NOT NULL,
+                scored INTEGER NOT NULL,
+                PRIMARY KEY (user_id, day, subject, topic)) WITHOUT ROWID""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS daily_totals_subject "
+                               "ON daily_totals (user_id, subject, topic)")
+            if not has_totals:
+                self._conn.execute(
+                    "INSERT INTO daily_totals SELECT user_id, substr(timestamp, 1, 10), COALESCE(subject, ''), "
+                    "COALESCE(topic, ''), COUNT(*), SUM(duration), COALESCE(SUM(score), 0), COUNT(score) "
+                    "FROM events GROUP BY 1, 2, 3, 4")
+
+    def _write(self, events):
+        events = [dict(event, user_id=event.get('user_id') or DEFAULT_USER, score=event.get('score'))
+                  for event in events]
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO events (timestamp, subject, topic, difficulty, activity_type, duration, user_id, score) "
+                "VALUES (:timestamp, :subject, :topic, :difficulty, :activity_type, :duration, :user_id, :score)",
+                events)
+            self._conn.executemany(
+                "INSERT INTO daily_totals VALUES (:user_id, substr(:timestamp, 1, 10), COALESCE(:subject, ''), "
+                "COALESCE(:topic, ''), 1, :duration, COALESCE(:score, 0), :score IS NOT NULL) "
+                "ON CONFLICT DO UPDATE SET sessions = sessions + 1, seconds = seconds + excluded.seconds, "
+                "score_sum = score_sum + excluded.score_sum, scored = scored + excluded.scored",
+                events)
+
+    def read_since(self, cursor=0):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, timestamp, subject, topic, difficulty, activity_type, duration, user_id, score "
+                "FROM events WHERE id > ? ORDER BY id", (cursor,)).fetchall()
+        events = [dict(zip(HISTORY_COLUMNS, row[1:])) for row in rows]
+        return events, rows[-1][0] if rows else cursor
+
+
+BACKENDS = {'sqlite': SqliteHistoryStore, 'jsonl': JsonlHistoryStore}
+
+
+class HistoryProjection:
+    """Read-side pandas DataFrame of the history, rebuilt lazily.
+
+    Nothing is loaded until `frame()` is first called; after that only the
+    events appended since the previous call are read and added.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._frame = None
+        self._cursor = 0
+        self._lock = threading.Lock()
+
+    def frame(self):
+        import pandas as pd
+
+        self.store.flush()
+        with self._lock:
+            events, self._cursor = self.store.read_since(self._cursor)
+            if self._frame is None or events:
+                new_rows = pd.DataFrame(events, columns=HISTORY_COLUMNS)
+                new_rows['timestamp'] = pd.to_datetime(new_rows['timestamp'])
+                if self._frame is None or len(self._frame) == 0:
+                    self._frame = new_rows
+                else:
+                    self._frame = pd.concat([self._frame, new_rows], ignore_index=True)
+            return self._frame
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            backend = os.getenv('HISTORY_BACKEND', HISTORY_BACKEND)
+            if backend not in BACKENDS:
+                raise ValueError(f"Unknown HISTORY_BACKEND '{backend}', expected one of: {', '.join(BACKENDS)}")
+            _store = BACKENDS[backend](
+                os.getenv('HISTORY_PATH', HISTORY_PATHS[backend]),
+                batch_size=int(os.getenv('HISTORY_BATCH_SIZE', HISTORY_BATCH_SIZE)),
+                fsync=os.getenv('HISTORY_FSYNC', '1' if HISTORY_FSYNC else '0') == '1'
+            )
+        return _store
+
+
+def migrate_csv(csv_path, store):
+    # Import rows from the old study_history.csv into the event store
+    count = 0
+    with open(csv_path, newline='') as f:
+        for row in csv.DictReader(f):
+            store.append({
+                'timestamp': row['timestamp'],
+                'subject': row['subject'],
+                'topic': row['topic'],
+                'difficulty': row['difficulty'],
+                'activity_type': row['activity_type'],
+                'duration': float(row['duration'] or 0)
+            })
+            count += 1
+    store.flush()
+    return count
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        print("Usage: python history_store.py migrate [study_history.csv]")
+        sys.exit(1)
+    csv_path = sys.argv[2] if len(sys.argv) > 2 else 'study_history.csv'
+    store = get_store()
+    if store.read_since(0)[0]:
+        print(f"{store.path} already contains events, refusing to migrate twice")
+        sys.exit(1)
+    count = migrate_csv(csv_path, store)
+    print(f"Migrated {count} events from {csv_path} to {store.path}")
@@ -0,0 +1,492 @@
+import os
+import math
+import time
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import get_metrics
+from chat_memory import estimate_tokens
+from circuit_breaker import CircuitBreaker, BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_FAILURE_RATE, \
+    BREAKER_SLOW_CALL, BREAKER_PROBE_INTERVAL
+
+# Client defaults, overridable through LLM_* in the .env file
+LLM_BACKEND = 'gemini'
+LLM_MODEL = 'gemini-1.5-pro'
+LLM_MAX_CONCURRENCY = 8
+LLM_TIMEOUT = 60.0
+LLM_MAX_RETRIES = 3
+LLM_BACKOFF_BASE = 0.5
+LLM_BACKOFF_MAX = 20.0
+
+# HTTP statuses worth retrying: rate limiting and transient server errors
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+PROBE_PROMPT = "Reply with OK."
+
+
+class LLMError(Exception):
+    pass
+
+
+class LLMTimeout(LLMError):
+    code = 504
+
+
+def status_of(error):
+    # google.api_core exceptions carry the HTTP status as an int `code`
+    code = getattr(error, 'code', None)
+    return code if isinstance(code, int) else None
+
+
+def retry_after_of(error):
+    # Seconds the server asked us to wait, if it said so
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is None:
+        headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+        retry_after = headers.get('Retry-After')
+    if retry_after is None:
+        for detail in getattr(error, 'details', None) or []:
+            delay = getattr(detail, 'retry_delay', None)
+            if delay is not None:
+                retry_after = delay.seconds + delay.nanos / 1e9
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class Completion:
+    def __init__(self, text):
+        self.text = text
+
+
+class StreamingCompletion:
+    """Iterable of response chunks, each with a `.text` like the SDK's."""
+
+    def __init__(self, first, chunks):
+        self._first = first
+        self._chunks = chunks
+        self._parts = []
+
+    def __iter__(self):
+        if self._first is not None:
+            self._parts.append(self._first)
+            yield Completion(self._first)
+            self._first = None
+        for chunk in self._chunks:
+            self._parts.append(chunk)
+            yield Completion(chunk)
+
+    @property
+    def text(self):
+        for _ in self:
+            pass
+        return ''.join(self._parts)
+
+
+class LLMClient:
+    """Shared client around a GenerativeModel-like backend.
+
+    The asyncio API (`generate_async`, `stream_async`) caps concurrent
+    upstream calls with a semaphore, applies a deadline to every call and
+    retries rate-limit and 5xx errors with jittered exponential backoff,
+    waiting at least as long as any Retry-After the server sent.
+
+    `generate_content` is a blocking facade with the same shape as the SDK
+    method, so existing code can use the client in place of the model. It
+    runs the coroutines on one background event loop shared by all
+    threads, so the concurrency cap holds across Flask worker threads.
+
+    Blocking backends run on the client's own pool of `max_concurrency`
+    threads. A call that misses its deadline can't be stopped, so its slot
+    is only freed once its thread has actually returned.
+
+    Instead of a backend, a `backend_factory` can be given; it is called on
+    the first model call, which keeps the SDK import off the startup path.
+
+    With a `breaker`, every attempt's outcome and latency is reported to
+    it, and while it is open calls fail at once with CircuitOpenError
+    rather than waiting out deadlines and retries.
+    """
+
+    def __init__(self, backend=None, max_concurrency=LLM_MAX_CONCURRENCY, timeout=LLM_TIMEOUT,
+                 max_retries=LLM_MAX_RETRIES, backoff_base=LLM_BACKOFF_BASE, backoff_max=LLM_BACKOFF_MAX,
+                 backend_factory=None, model_name=None, breaker=None):
+        self._backend = backend
+        self._backend_factory = backend_factory
+        self._backend_lock = threading.Lock()
+        self.model_name = model_name or getattr(backend, 'model_name', None) or LLM_MODEL
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self._semaphore = None
+        self._executor = None
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._backend_lock:
+                if self._backend is None:
+                    self._backend = self._backend_factory()
+        return self._backend
+
+    # Async API
+
+    def _get_semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def _in_thread(self, fn, calls):
+        # Runs a blocking backend call on the client's pool; `calls` keeps
+        # the latest one for _release_when_done
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='llm-call')
+        future = self._executor.submit(fn)
+        calls[:] = [future]
+        return asyncio.wrap_future(future)
+
+    def _release_when_done(self, semaphore, calls):
+        # Frees the slot now, or once the thread of a call that was given up
+        # on returns, so timed-out calls still count against the cap
+        if not calls:
+            semaphore.release()
+            return
+        loop = asyncio.get_running_loop()
+        calls[-1].add_done_callback(lambda _: loop.call_soon_threadsafe(semaphore.release))
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = retry_after_of(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _should_retry(self, attempt, error):
+        return attempt < self.max_retries and status_of(error) in RETRYABLE_STATUS
+
+    def _check_breaker(self):
+        if self.breaker is not None:
+            self.breaker.check()
+
+    def _report(self, attempt_started, error=None):
+        # Upstream failures and slow calls count against the breaker; errors
+        # caused by the request itself, like a 400, don't
+        if self.breaker is None:
+            return
+        if error is None:
+            self.breaker.record(True, time.perf_counter() - attempt_started)
+        elif (isinstance(error, (LLMTimeout, ConnectionError, OSError))
+              or status_of(error) in RETRYABLE_STATUS):
+            self.breaker.record(False, error=error)
+
+    async def _call(self, prompt, calls):
+        if hasattr(self.backend, 'generate_content_async'):
+            response = await self.backend.generate_content_async(prompt)
+            return response.text
+        return await self._in_thread(lambda: self.backend.generate_content(prompt).text, calls)
+
+    def _record(self, kind, started, outcome, prompt, text=''):
+        metrics = get_metrics()
+        metrics.observe('llm_request_duration_seconds', time.perf_counter() - started, kind=kind, outcome=outcome)
+        metrics.inc('llm_requests_total', kind=kind, outcome=outcome)
+        # Estimates, not tokenizer counts; template prompts come with theirs,
+        # the static part estimated once per template
+        metrics.inc('llm_prompt_tokens_estimated_total',
+                    getattr(prompt, 'estimated_tokens', None) or estimate_tokens(prompt), kind=kind)
+        if text:
+            metrics.inc('llm_response_tokens_estimated_total', estimate_tokens(text), kind=kind)
+
+    def _outcome(self, error):
+        if isinstance(error, LLMTimeout):
+            return 'timeout'
+        status = status_of(error)
+        return f'error_{status}' if status else 'error'
+
+    async def generate_async(self, prompt):
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            self._check_breaker()
+            self.calls += 1
+            attempt_started = None
+            try:
+                semaphore = self._get_semaphore()
+                await semaphore.acquire()
+                calls = []
+                try:
+                    attempt_started = time.perf_counter()
+                    try:
+                        text = await asyncio.wait_for(self._call(prompt, calls), self.timeout)
+                    except asyncio.TimeoutError:
+                        raise LLMTimeout(f"Model call exceeded {self.timeout}s deadline")
+                finally:
+                    self._release_when_done(semaphore, calls)
+                self._report(attempt_started)
+                self._record('generate', started, 'ok', prompt, text)
+                return text
+            except Exception as e:
+                if attempt_started is not None:
+                    self._report(attempt_started, e)
+                if not self._should_retry(attempt, e):
+                    self.failures += 1
+                    self._record('generate', started, self._outcome(e), prompt)
+                    raise
+                error = e
+            # Back off outside the semaphore so waiting doesn't hold a slot
+            self.retries += 1
+            await asyncio.sleep(self._backoff(attempt, error))
+            attempt += 1
+
+    async def _open_stream(self, prompt, calls):
+        if hasattr(self.backend, 'generate_content_async'):
+            response = await self.backend.generate_content_async(prompt, stream=True)
+            iterator = response.__aiter__()
+            return lambda: iterator.__anext__()
+        iterator = iter(await self._in_thread(lambda: self.backend.generate_content(prompt, stream=True), calls))
+
+        def next_chunk():
+            chunk = next(iterator, None)
+            if chunk is None:
+                raise StopAsyncIteration
+            return chunk
+        return lambda: self._in_thread(next_chunk, calls)
+
+    async def stream_async(self, prompt):
+        # Retries only happen before the first chunk; once text has been
+        # handed to the caller a failure is raised as is
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            self._check_breaker()
+            self.calls += 1
+            semaphore = self._get_semaphore()
+            await semaphore.acquire()
+            calls = []
+            attempt_started = time.perf_counter()
+            try:
+                next_chunk = await asyncio.wait_for(self._open_stream(prompt, calls), self.timeout)
+                first = await asyncio.wait_for(next_chunk(), self.timeout)
+                break
+            except StopAsyncIteration:
+                self._release_when_done(semaphore, calls)
+                self._report(attempt_started)
+                return
+            except Exception as e:
+                self._release_when_done(semaphore, calls)
+                if isinstance(e, asyncio.TimeoutError):
+                    e = LLMTimeout(f"Model call exceeded {self.timeout}s deadline")
+                self._report(attempt_started, e)
+                if not self._should_retry(attempt, e):
+                    self.failures += 1
+                    self._record('stream', started, self._outcome(e), prompt)
+                    raise e
+                self.retries += 1
+                await asyncio.sleep(self._backoff(attempt, e))
+                attempt += 1
+        get_metrics().observe('llm_time_to_first_token_seconds', time.perf_counter() - started)
+        # The breaker judges a stream by its time to first token
+        self._report(attempt_started)
+        parts = [first.text]
+        outcome = 'ok'
+        try:
+            yield first.text
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(next_chunk(), self.timeout)
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    self.failures += 1
+                    outcome = 'timeout'
+                    error = LLMTimeout(f"No chunk received within {self.timeout}s")
+                    self._report(attempt_started, error)
+                    raise error
+                parts.append(chunk.text)
+                yield chunk.text
+        except GeneratorExit:
+            outcome = 'cancelled'
+            raise
+        except Exception as e:
+            outcome = self._outcome(e)
+            raise
+        finally:
+            self._release_when_done(semaphore, calls)
+            self._record('stream', started, outcome, prompt, ''.join(parts))
+
+    # Sync facade
+
+    def _get_loop(self):
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='llm-client', daemon=True).start()
+            return self._loop
+
+    def run(self, coro):
+        # Build the backend in the calling thread rather than on the loop
+        self.backend
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop()).result()
+
+    def _iter_stream(self, prompt):
+        self.backend
+        loop = self._get_loop()
+        stream = self.stream_async(prompt)
+        try:
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(stream.__anext__(), loop).result()
+                except StopAsyncIteration:
+                    return
+        finally:
+            asyncio.run_coroutine_threadsafe(stream.aclose(), loop).result()
+
+    def generate_content(self, prompt, stream=False):
+        if not stream:
+            return Completion(self.run(self.generate_async(prompt)))
+        # Pull the first chunk now so connection errors surface at call time,
+        # like they do with the SDK
+        chunks = self._iter_stream(prompt)
+        return StreamingCompletion(next(chunks, None), chunks)
+
+    def probe(self):
+        # One small call straight to the backend, bypassing the breaker and
+        # retries; used to find out whether the model is back
+        return self.run(asyncio.wait_for(self._call(PROBE_PROMPT, []), self.timeout))
+
+    def stats(self):
+        stats = {'calls': self.calls, 'retries': self.retries, 'failures': self.failures}
+        if self.breaker is not None:
+            stats['breaker'] = self.breaker.stats()
+        return stats
+
+
+class FakeAPIError(Exception):
+    def __init__(self, code, message='Injected failure', retry_after=None):
+        super().__init__(f"{code} {message}")
+        self.code = code
+        self.retry_after = retry_after
+
+
+class FakeModel:
+    """Offline stand-in for genai.GenerativeModel.
+
+    Responds after a delay drawn from `distribution`: 'uniform' is
+    `latency` plus up to `jitter`, 'lognormal' has median `latency` and
+    sigma `jitter`, 'exponential' is `latency` plus an exponential tail
+    with mean `jitter`. Fails with `error_code` at `failure_rate`, and
+    streams the answer in `chunks` pieces, `chunk_delay` seconds apart
+    (by default the delay split evenly). `responder` builds the answer
+    text from the prompt; `seed` makes the delays and failures repeatable.
+    """
+
+    model_name = 'models/fake'
+    DISTRIBUTIONS = ('uniform', 'lognormal', 'exponential')
+
+    def __init__(self, latency=0.05, jitter=0.0, failure_rate=0.0, error_code=503,
+                 retry_after=None, chunks=4, responder=None, distribution='uniform', chunk_delay=None, seed=None):
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution {distribution!r}")
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        self.failure_rate = failure_rate
+        self.error_code = error_code
+        self.retry_after = retry_after
+        self.chunks = max(1, chunks)
+        self.chunk_delay = chunk_delay
+        self.responder = responder or (lambda prompt: f"<p>Fake response to: {' '.join(prompt.split())[:80]}</p>")
+        self.random = random.Random(seed)
+        self.calls = 0
+
+    def _delay(self):
+        if self.distribution == 'lognormal':
+            return self.latency * math.exp(self.random.normalvariate(0, self.jitter))
+        if self.distribution == 'exponential':
+            return self.latency + (self.random.expovariate(1 / self.jitter) if self.jitter else 0)
+        return self.latency + self.random.uniform(0, self.jitter)
+
+    def _maybe_fail(self):
+        if self.random.random() < self.failure_rate:
+            raise FakeAPIError(self.error_code, retry_after=self.retry_after)
+
+    def _split(self, text):
+        size = max(1, -(-len(text) // self.chunks))
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def generate_content(self, prompt, stream=False):
+        self.calls += 1
+        time.sleep(self._delay())
+        self._maybe_fail()
+        text = self.responder(prompt)
+        if not stream:
+            return Completion(text)
+
+        def chunks():
+            for part in self._split(text):
+                yield Completion(part)
+                time.sleep(self._delay() / self.chunks if self.chunk_delay is None else self.chunk_delay)
+        return chunks()
+
+
+def configured_model_name():
+    # The name the backend will report, without having to build it
+    if os.getenv('LLM_BACKEND', LLM_BACKEND) == 'fake':
+        return FakeModel.model_name
+    name = os.getenv('LLM_MODEL', LLM_MODEL)
+    return name if '/' in name else f'models/{name}'
+
+
+def create_backend():
+    if os.getenv('LLM_BACKEND', LLM_BACKEND) == 'fake':
+        seed = os.getenv('FAKE_LLM_SEED')
+        return FakeModel(latency=float(os.getenv('FAKE_LLM_LATENCY', 0.05)),
+                         jitter=float(os.getenv('FAKE_LLM_JITTER', 0.0)),
+                         distribution=os.getenv('FAKE_LLM_DISTRIBUTION', 'uniform'),
+                         failure_rate=float(os.getenv('FAKE_LLM_FAILURE_RATE', 0.0)),
+                         seed=int(seed) if seed else None)
+    import google.generativeai as genai
+
+    genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+    return genai.GenerativeModel(os.getenv('LLM_MODEL', LLM_MODEL))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            breaker = None
+            if os.getenv('BREAKER', '1') == '1':
+                breaker = CircuitBreaker(
+                    window=float(os.getenv('BREAKER_WINDOW', BREAKER_WINDOW)),
+                    min_calls=int(os.getenv('BREAKER_MIN_CALLS', BREAKER_MIN_CALLS)),
+                    failure_rate=float(os.getenv('BREAKER_FAILURE_RATE', BREAKER_FAILURE_RATE)),
+                    slow_call=float(os.getenv('BREAKER_SLOW_CALL', BREAKER_SLOW_CALL)),
+                    probe_interval=float(os.getenv('BREAKER_PROBE_INTERVAL', BREAKER_PROBE_INTERVAL))
+                )
+            _client = LLMClient(
+                backend_factory=create_backend,
+                model_name=configured_model_name(),
+                max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', LLM_MAX_CONCURRENCY)),
+                timeout=float(os.getenv('LLM_TIMEOUT', LLM_TIMEOUT)),
+                max_retries=int(os.getenv('LLM_MAX_RETRIES', LLM_MAX_RETRIES)),
+                backoff_base=float(os.getenv('LLM_BACKOFF_BASE', LLM_BACKOFF_BASE)),
+                backoff_max=float(os.getenv('LLM_BACKOFF_MAX', LLM_BACKOFF_MAX)),
+                breaker=breaker
+            )
+            if breaker is not None:
+                breaker.probe = _client.probe
+        return _client
@@ -0,0 +1,169 @@
+import os
+import math
+import time
+import sqlite3
+import threading
+
+# Mastery tracking defaults, overridable through MASTERY_* in the .env file
+MASTERY_DB = 'mastery.db'
+MASTERY_TARGET = 0.7  # chance of a correct answer that tests are pitched at
+
+INITIAL_RATING = 1000.0
+SKILL_K = 40  # rating points a learner moves per surprising answer
+QUESTION_K = 16  # questions settle more slowly, being answered by many learners
+# Starting rating of a question generated at each difficulty level
+DIFFICULTY_RATINGS = {'Beginner': 900.0, 'Intermediate': 1100.0, 'Advanced': 1300.0}
+AUTO = 'Auto'
+
+
+def expected_score(skill, rating):
+    # Elo: the chance a learner with `skill` answers a question of `rating` correctly
+    return 1 / (1 + 10 ** ((rating - skill) / 400))
+
+
+def target_rating(skill, target=MASTERY_TARGET):
+    # Question rating the learner answers correctly with probability `target`
+    return skill - 400 * math.log10(target / (1 - target))
+
+
+def difficulty_for(skill, target=MASTERY_TARGET):
+    # Level whose questions come closest to the target success rate
+    goal = target_rating(skill, target)
+    return min(DIFFICULTY_RATINGS, key=lambda level: abs(DIFFICULTY_RATINGS[level] - goal))
+
+
+class MasteryStore:
+    """Elo ratings for learners per subject/topic and for bank questions.
+
+    Every graded answer is a match between the learner's topic skill and
+    the question's rating: both move by K times how surprising the result
+    was, so an update is two primary-key lookups and writes per answer
+    however long the history gets. Each outcome is also logged with the
+    ratings it was played at. Difficulty and question picks aim for
+    `target`, the chance of a correct answer that keeps tests neither
+    trivial nor discouraging.
+    """
+
+    def __init__(self, path=MASTERY_DB, target=MASTERY_TARGET):
+        self.path = path
+        self.target = target
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS skills (
+                user_id TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                rating REAL NOT NULL,
+                answers INTEGER NOT NULL,
+                correct INTEGER NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (user_id, subject, topic)) WITHOUT ROWID""")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS question_ratings (
+                hash TEXT PRIMARY KEY,
+                rating REAL NOT NULL,
+                answers INTEGER NOT NULL) WITHOUT ROWID""")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS outcomes (
+                user_id TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                question_hash TEXT NOT NULL,
+                correct INTEGER NOT NULL,
+                skill REAL NOT NULL,
+                question_rating REAL NOT NULL,
+                timestamp REAL NOT NULL)""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS outcomes_user_question ON outcomes (user_id, question_hash)")
+
+    def _skill(self, user_id, subject, topic):
+        row = self._conn.execute("SELECT rating, answers, correct FROM skills WHERE user_id = ? AND subject = ? "
+                                 "AND topic = ?", (user_id, subject, topic)).fetchone()
+        return row or (INITIAL_RATING, 0, 0)
+
+    def skill(self, user_id, subject, topic):
+        with self._lock:
+            rating, answers, correct = self._skill(user_id, subject, topic)
+        return {'rating': round(rating, 1), 'answers': answers, 'correct': correct,
+                'difficulty': difficulty_for(rating, self.target)}
+
+    def recommend(self, user_id, subject, topic):
+        return self.skill(user_id, subject, topic)['difficulty']
+
+    def resolve(self, user_id, subject, topic, difficulty):
+        # The chosen level, or the recommended one for 'Auto' and no choice
+        if difficulty in DIFFICULTY_RATINGS:
+            return difficulty
+        return self.recommend(user_id, subject, topic)
+
+    def skills(self, user_id, subject=None):
+        # Every topic the user has answered questions on, strongest first
+        sql = "SELECT subject, topic, rating, answers, correct FROM skills WHERE user_id = ?"
+        params = (user_id,)
+        if subject:
+            sql += " AND subject = ?"
+            params += (subject,)
+        with self._lock:
+            rows = self._conn.execute(sql + " ORDER BY rating DESC", params).fetchall()
+        return [{'subject': row[0], 'topic': row[1], 'rating': round(row[2], 1), 'answers': row[3],
+                 'correct': row[4], 'difficulty': difficulty_for(row[2], self.target)} for row in rows]
+
+    def pick_questions(self, user_id, subject, topic, candidates, count):
+        # The `count` candidates rated closest to the user's target, skipping
+        # ones they already answered correctly while there are others.
+        # Candidates are question dicts with their bank 'hash' and 'difficulty'.
+        hashes = [question['hash'] for question in candidates]
+        marks = ','.join('?' * len(hashes))
+        with self._lock:
+            skill = self._skill(user_id, subject, topic)[0]
+            ratings = dict(self._conn.execute(
+                f"SELECT hash, rating FROM question_ratings WHERE hash IN ({marks})", hashes).fetchall())
+            mastered = {row[0] for row in self._conn.execute(
+                f"SELECT DISTINCT question_hash FROM outcomes WHERE user_id = ? AND correct = 1 "
+                f"AND question_hash IN ({marks})", [user_id] + hashes)}
+        goal = target_rating(skill, self.target)
+
+        def distance(question):
+            rating = ratings.get(question['hash'], DIFFICULTY_RATINGS.get(question.get('difficulty'), INITIAL_RATING))
+            return (question['hash'] in mastered, abs(rating - goal))
+        return sorted(candidates, key=distance)[:count]
+
+    def record_answers(self, user_id, subject, topic, answers):
+        # `answers` is a list of (question hash, difficulty, correct) from one
+        # graded test; returns the user's updated skill for the topic
+        now = time.time()
+        with self._lock, self._conn:
+            # BEGIN IMMEDIATE takes the write lock before reading, so tests
+            # graded by two workers at once both count
+            self._conn.execute("BEGIN IMMEDIATE")
+            skill, total, correct = self._skill(user_id, subject, topic)
+            for question_hash, difficulty, is_correct in answers:
+                row = self._conn.execute("SELECT rating, answers FROM question_ratings WHERE hash = ?",
+                                         (question_hash,)).fetchone()
+                rating, played = row or (DIFFICULTY_RATINGS.get(difficulty, INITIAL_RATING), 0)
+                surprise = (1.0 if is_correct else 0.0) - expected_score(skill, rating)
+                self._conn.execute("INSERT INTO outcomes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (user_id, subject, topic, question_hash, int(is_correct), skill, rating, now))
+                self._conn.execute("INSERT OR REPLACE INTO question_ratings VALUES (?, ?, ?)",
+                                   (question_hash, rating - QUESTION_K * surprise, played + 1))
+                skill += SKILL_K * surprise
+                total += 1
+                correct += int(is_correct)
+            self._conn.execute("INSERT OR REPLACE INTO skills VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (user_id, subject, topic, skill, total, correct, now))
+        return {'rating': round(skill, 1), 'answers': total, 'correct': correct,
+                'difficulty': difficulty_for(skill, self.target)}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_mastery_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = MasteryStore(
+                os.getenv('MASTERY_DB', MASTERY_DB),
+                target=float(os.getenv('MASTERY_TARGET', MASTERY_TARGET))
+            )
+        return _store
@@ -0,0 +1,159 @@
+import threading
+
+QUANTILES = [0.5, 0.9, 0.95, 0.99]
+
+
+class Histogram:
+    """Log-linear latency histogram in the style of HdrHistogram.
+
+    Values are recorded in microseconds. Below 64us every value has its own
+    bucket; above that each power of two is split into 32 buckets, so any
+    recorded value is reproduced within about 3% using a few hundred
+    counters at most, however many samples come in.
+    """
+
+    SUB_BUCKETS = 32
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def _index(cls, value):
+        if value < 2 * cls.SUB_BUCKETS:
+            return value
+        exponent = value.bit_length() - 6
+        return exponent * cls.SUB_BUCKETS + (value >> exponent)
+
+    @classmethod
+    def _value(cls, index):
+        # Midpoint of the range of values that map to `index`
+        if index < 2 * cls.SUB_BUCKETS:
+            return index
+        exponent = index // cls.SUB_BUCKETS - 1
+        mantissa = index - exponent * cls.SUB_BUCKETS
+        return ((mantissa << exponent) + ((mantissa + 1) << exponent) - 1) / 2
+
+    def record(self, seconds):
+        index = self._index(max(0, int(seconds * 1e6)))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, quantile):
+        if not self.count:
+            return 0.0
+        target = quantile * self.count
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._value(index) / 1e6, self.max)
+        return self.max
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Metrics:
+    # Process-wide counters, gauges and latency histograms
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.record(seconds)
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def render_prometheus(self):
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                header(name, 'counter')
+                lines.append(f"{name}{_labels(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                header(name, 'gauge')
+                lines.append(f"{name}{_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                header(name, 'summary')
+                for quantile in QUANTILES:
+                    lines.append(f"{name}{_labels(labels + (('quantile', quantile),))} "
+                                 f"{histogram.percentile(quantile):.6f}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram.sum:.6f}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def latency_summary(self):
+        # Rows of (name, labels, count, p50, p95, p99, max) for display
+        with self._lock:
+            return [(name, dict(labels), h.count, h.percentile(0.5), h.percentile(0.95),
+                     h.percentile(0.99), h.max)
+                    for (name, labels), h in sorted(self.histograms.items())]
+
+    def counter_summary(self):
+        with self._lock:
+            return [(name, dict(labels), value) for (name, labels), value in sorted(self.counters.items())]
+
+
+_metrics = Metrics()
+_metrics.describe('llm_request_duration_seconds', 'Wall time of model calls, including retries')
+_metrics.describe('llm_time_to_first_token_seconds', 'Time until the first streamed chunk arrived')
+_metrics.describe('llm_requests_total', 'Model calls by kind and outcome')
+_metrics.describe('llm_prompt_tokens_estimated_total',
+                  'Prompt tokens sent to the model, estimated at four characters per token')
+_metrics.describe('llm_response_tokens_estimated_total',
+                  'Response tokens received from the model, estimated at four characters per token')
+_metrics.describe('response_cache_lookups_total', 'Response cache lookups by result')
+_metrics.describe('http_request_duration_seconds', 'Flask request handling time by route')
+_metrics.describe('http_requests_total', 'Flask requests by route and status')
+_metrics.describe('batch_job_duration_seconds', 'Time to generate one batch export job')
+_metrics.describe('fragment_cache_lookups_total', 'Post-processed fragment lookups by result')
+_metrics.describe('fragment_responses_total', 'Fragment responses by status and content encoding')
+_metrics.describe('semantic_cache_lookups_total', 'Chat questions looked up in the semantic cache by result')
+_metrics.describe('llm_circuit_state', 'Model circuit breaker state: 0 closed, 1 open')
+_metrics.describe('llm_circuit_transitions_total', 'Model circuit breaker transitions by new state')
+_metrics.describe('llm_circuit_rejected_total', 'Model calls rejected while the circuit breaker was open')
+_metrics.describe('llm_circuit_probes_total', 'Probe calls made while the circuit breaker was open by outcome')
+_metrics.describe('stale_responses_total', 'Fallback content served while the model was unavailable by kind')
+_metrics.describe('admission_queue_depth', 'Model calls waiting for admission by priority')
+_metrics.describe('admission_in_flight', 'Admitted model calls holding a slot')
+_metrics.describe('admission_wait_seconds', 'Time model calls waited for admission by priority')
+_metrics.describe('admission_rejected_total', 'Model calls rejected with a 429 by reason and priority')
+
+
+def get_metrics():
+    return _metrics
@@ -0,0 +1,262 @@
+import os
+import re
+import json
+import uuid
+import random
+import hashlib
+import sqlite3
+import threading
+import time
+
+from response_cache import cached_generate
+from prompts import practice_test_prompt, TEST_QUESTIONS
+
+# Practice test defaults, overridable through PRACTICE_TEST_* in the .env file
+PRACTICE_TEST_DB = 'practice_tests.db'
+PRACTICE_TEST_KEEP = 7 * 24 * 3600  # how long answer keys of issued tests are kept
+
+OPTION_LETTERS = ['A', 'B', 'C', 'D']
+# Level of questions banked before tests had one; their prompt asked for none
+DEFAULT_DIFFICULTY = 'Intermediate'
+BANK_TESTS = 4  # tests' worth of questions banked per subject, topic and level
+MAX_QUESTION_SETS = 2 * BANK_TESTS  # sets generated before giving up on filling the bank
+
+
+class InvalidTestError(ValueError):
+    pass
+
+
+def parse_questions(text):
+    # Parse the model's JSON answer into validated question dicts. Invalid
+    # questions are dropped; a response with no valid question is an error.
+    match = re.search(r'\{.*\}|\[.*\]', text, re.DOTALL)
+    if not match:
+        raise InvalidTestError("Response does not contain JSON")
+    try:
+        data = json.loads(match.group(0))
+    except json.JSONDecodeError as e:
+        raise InvalidTestError(f"Response is not valid JSON: {e}")
+    items = data.get('questions', []) if isinstance(data, dict) else data
+
+    questions = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        options = item.get('options')
+        if isinstance(options, list) and len(options) == len(OPTION_LETTERS):
+            options = dict(zip(OPTION_LETTERS, options))
+        answer = str(item.get('answer', '')).strip().upper()[:1]
+        question = str(item.get('question', '')).strip()
+        if (not question or not isinstance(options, dict)
+                or sorted(options) != OPTION_LETTERS or answer not in OPTION_LETTERS):
+            continue
+        questions.append({
+            'question': question,
+            'options': {letter: str(options[letter]).strip() for letter in OPTION_LETTERS},
+            'answer': answer,
+            'explanation': str(item.get('explanation', '')).strip()
+        })
+    if not questions:
+        raise InvalidTestError("Response contains no valid questions")
+    return questions
+
+
+def question_hash(question):
+    return hashlib.sha256(' '.join(question['question'].lower().split()).encode('utf-8')).hexdigest()
+
+
+class PracticeTestStore:
+    """Question bank and server-side answer keys for practice tests.
+
+    Validated questions are kept per subject/topic and reused across tests,
+    so once a topic has enough of them a new test needs no model call.
+    Every issued test stores its answer key under a random test id;
+    grading looks answers up by question id and never trusts the client,
+    and a test can only be graded once.
+    Questions are banked per difficulty level, and answer keys keep each
+    question's hash so graded answers can be traced back to the bank.
+    """
+
+    def __init__(self, path=PRACTICE_TEST_DB, keep=PRACTICE_TEST_KEEP):
+        self.path = path
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS questions (
+                hash TEXT PRIMARY KEY,
+                subject TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created REAL NOT NULL,
+                difficulty TEXT NOT NULL DEFAULT 'Intermediate')""")
+            self._add_column('questions', "difficulty TEXT NOT NULL DEFAULT 'Intermediate'")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS questions_topic ON questions (subject, topic)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS questions_level ON questions (subject, topic, difficulty)")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS tests (
+                id TEXT PRIMARY KEY,
+                subject TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                answer_key TEXT NOT NULL,
+                created REAL NOT NULL,
+                difficulty TEXT NOT NULL DEFAULT 'Intermediate')""")
+            self._add_column('tests', "difficulty TEXT NOT NULL DEFAULT 'Intermediate'")
+            self._add_column('tests', "graded REAL")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS tests_created ON tests (created)")
+            # How many question sets each level has had generated, so the
+            # next prompt asks for a new one even when a set added fewer
+            # questions than asked for (invalid items, duplicates)
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS question_sets (
+                subject TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                difficulty TEXT NOT NULL,
+                generated INTEGER NOT NULL,
+                PRIMARY KEY (subject, topic, difficulty))""")
+
+    def _add_column(self, table, definition):
+        # Databases created before a column existed get it added in place
+        columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+        if definition.split()[0] not in columns:
+            self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {definition}")
+
+    def add_questions(self, subject, topic, questions, difficulty=DEFAULT_DIFFICULTY, question_set=None):
+        # `question_set` is the number of the generated set the questions
+        # came from, recorded for question_sets()
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO questions (hash, subject, topic, data, created, difficulty) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(question_hash(q), subject, topic, json.dumps(q), now, difficulty) for q in questions])
+            if question_set is not None:
+                self._conn.execute(
+                    "INSERT INTO question_sets VALUES (?, ?, ?, ?) ON CONFLICT (subject, topic, difficulty) "
+                    "DO UPDATE SET generated = MAX(generated, excluded.generated)",
+                    (subject, topic, difficulty or '', question_set + 1))
+
+    def question_sets(self, subject, topic, difficulty):
+        # Question sets generated so far for one level
+        with self._lock:
+            row = self._conn.execute("SELECT generated FROM question_sets WHERE subject = ? AND topic = ? "
+                                     "AND difficulty = ?", (subject, topic, difficulty or '')).fetchone()
+        return row[0] if row else 0
+
+    def bank_size(self, subject, topic, difficulty=None):
+        sql = "SELECT COUNT(*) FROM questions WHERE subject = ? AND topic = ?"
+        params = (subject, topic)
+        if difficulty:
+            sql += " AND difficulty = ?"
+            params += (difficulty,)
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()[0]
+
+    def sample(self, subject, topic, count, difficulty=None):
+        # Random banked questions, each with its 'hash' and 'difficulty'
+        sql = "SELECT hash, difficulty, data FROM questions WHERE subject = ? AND topic = ?"
+        params = (subject, topic)
+        if difficulty:
+            sql += " AND difficulty = ?"
+            params += (difficulty,)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [dict(json.loads(row[2]), hash=row[0], difficulty=row[1])
+                for row in random.sample(rows, min(count, len(rows)))]
+
+    def create_test(self, subject, topic, questions, difficulty=DEFAULT_DIFFICULTY):
+        # Returns the test id and the questions as shown to the user, with
+        # answers and explanations held back on the server
+        test_id = uuid.uuid4().hex
+        answer_key = {}
+        public = []
+        for number, question in enumerate(questions, 1):
+            question_id = f'q{number}'
+            answer_key[question_id] = {'answer': question['answer'], 'explanation': question['explanation'],
+                                       'hash': question.get('hash') or question_hash(question),
+                                       'difficulty': question.get('difficulty', difficulty)}
+            public.append({'id': question_id, 'question': question['question'], 'options': question['options']})
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM tests WHERE created < ?", (now - self.keep,))
+            self._conn.execute("INSERT INTO tests (id, subject, topic, answer_key, created, difficulty) "
+                               "VALUES (?, ?, ?, ?, ?, ?)",
+                               (test_id, subject, topic, json.dumps(answer_key), now, difficulty))
+        return test_id, public
+
+    def take_test(self, test_id):
+        # The test for grading, or None if it is unknown, expired or already
+        # graded. Claiming it is one UPDATE, so a test is graded once even
+        # when submitted twice at the same time.
+        with self._lock, self._conn:
+            claimed = self._conn.execute("UPDATE tests SET graded = ? WHERE id = ? AND graded IS NULL",
+                                         (time.time(), test_id)).rowcount
+        return self.get_test(test_id) if claimed else None
+
+    def get_test(self, test_id):
+        with self._lock:
+            row = self._conn.execute("SELECT subject, topic, answer_key, created, difficulty FROM tests "
+                                     "WHERE id = ?", (test_id,)).fetchone()
+        if row is None:
+            return None
+        return {'subject': row[0], 'topic': row[1], 'answer_key': json.loads(row[2]), 'created': row[3],
+                'difficulty': row[4]}
+
+
+def grade(answer_key, answers):
+    # One dict lookup per question; unanswered questions count as wrong
+    results = []
+    score = 0
+    for question_id, key in answer_key.items():
+        selected = answers.get(question_id)
+        is_correct = selected == key['answer']
+        if is_correct:
+            score += 1
+        results.append({
+            'question_id': question_id,
+            'selected_answer': selected,
+            'is_correct': is_correct,
+            'correct_answer': key['answer'],
+            'explanation': key['explanation']
+        })
+    total = len(answer_key)
+    return {
+        'score': score,
+        'total': total,
+        'percentage': (score / total) * 100 if total else 0.0,
+        'results': results
+    }
+
+
+def top_up_bank(store, model, subject, topic, difficulty, count=TEST_QUESTIONS):
+    # Generates one more question set while the bank holds fewer than
+    # BANK_TESTS tests' worth, so tests vary and there are questions to pick
+    # from. Returns the generated text, or None if nothing was generated.
+    banked = store.bank_size(subject, topic, difficulty)
+    # Banks filled before sets were counted start from their size
+    question_set = max(store.question_sets(subject, topic, difficulty), banked // count)
+    if banked >= count * BANK_TESTS or question_set >= MAX_QUESTION_SETS:
+        return None
+    prompt = practice_test_prompt(subject, topic, difficulty, count, question_set=question_set)
+    try:
+        content = cached_generate(model, prompt, validate=parse_questions)
+    except Exception:
+        if banked < count:
+            raise
+        return None  # enough for this test; try again next time
+    store.add_questions(subject, topic, parse_questions(content), difficulty, question_set)
+    return content
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_test_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = PracticeTestStore(
+                os.getenv('PRACTICE_TEST_DB', PRACTICE_TEST_DB),
+                keep=float(os.getenv('PRACTICE_TEST_KEEP', PRACTICE_TEST_KEEP))
+            )
+        return _store
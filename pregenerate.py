@@ -0,0 +1,180 @@
+import os
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on Windows; every process runs its own scheduler there
+    fcntl = None
+
+from response_cache import get_cache, cache_key, model_name_of
+from single_flight import get_single_flight, process_lock
+
+# Pre-generation defaults, overridable through PREGENERATE_* in the .env file
+PREGENERATE_WORKERS = 2
+PREGENERATE_RATE = 20                  # model calls per minute
+PREGENERATE_REFRESH_AFTER = 24 * 3600  # regenerate entries older than this
+PREGENERATE_INTERVAL = 3600            # seconds between scheduled runs
+PREGENERATE_LOCK = 'pregenerate.lock'  # held by the one process running the scheduler
+
+
+class RateLimiter:
+    # Spaces calls evenly so at most `per_minute` start in any minute
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(max(0, start - now))
+
+
+class PregenerationJob:
+    """Fills the response cache with content for a fixed list of prompts.
+
+    `jobs` is a list of (label, prompt) or (label, prompt, validate) tuples,
+    where `validate` rejects unusable responses before they are cached. Entries that are missing or
+    older than `refresh_after` are generated on a bounded worker pool under
+    a calls-per-minute budget; fresh entries are skipped. Routes keep using
+    cached_generate, so they serve pre-built content straight from the
+    cache and only generate live on a miss.
+    """
+
+    def __init__(self, model, jobs, cache=None, workers=PREGENERATE_WORKERS,
+                 rate_per_minute=PREGENERATE_RATE, refresh_after=PREGENERATE_REFRESH_AFTER):
+        self.model = model
+        self.jobs = jobs
+        self.cache = cache or get_cache()
+        self.workers = workers
+        self.rate = RateLimiter(rate_per_minute)
+        self.refresh_after = refresh_after
+        self._lock = threading.Lock()
+        self._scheduler = None
+        self._lock_file = None
+        self._progress = {'total': len(jobs), 'generated': 0, 'skipped': 0, 'failed': 0,
+                          'running': False, 'started': None, 'finished': None, 'errors': []}
+
+    def _update(self, **changes):
+        with self._lock:
+            for name, value in changes.items():
+                if name in ('generated', 'skipped', 'failed'):
+                    self._progress[name] += value
+                else:
+                    self._progress[name] = value
+
+    def _run_one(self, label, prompt, validate=None):
+        key = cache_key(prompt, model_name_of(self.model))
+        age = self.cache.age(key)
+        if age is not None and age < self.refresh_after:
+            self._update(skipped=1)
+            return
+        self.rate.wait()
+        try:
+            # Go through single-flight so users missing on the same key
+            # while it is being generated wait for this call
+            get_single_flight().do(key, lambda: self._generate(key, prompt, validate))
+            self._update(generated=1)
+        except Exception as e:
+            with self._lock:
+                self._progress['failed'] += 1
+                self._progress['errors'] = (self._progress['errors'] + [f"{label}: {e}"])[-10:]
+
+    def _generate(self, key, prompt, validate):
+        with process_lock(key):
+            # Another worker process may have refreshed the entry while we waited
+            age = self.cache.age(key)
+            if age is not None and age < self.refresh_after:
+                text = self.cache.get(key, count=False)
+                if text is not None:
+                    return text
+            text = self.model.generate_content(prompt).text
+            if validate is not None:
+                validate(text)
+            # Kept as fallback content too, for when the model is unavailable
+            self.cache.put(key, text, getattr(prompt, 'fallback_key', None))
+            return text
+
+    def run(self):
+        with self._lock:
+            if self._progress['running']:
+                return False
+            self._progress.update(total=len(self.jobs), generated=0, skipped=0, failed=0, errors=[],
+                                  running=True, started=time.time(), finished=None)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pregenerate') as pool:
+                list(pool.map(lambda job: self._run_one(*job), self.jobs))
+        finally:
+            self._update(running=False, finished=time.time())
+        return True
+
+    def progress(self):
+        with self._lock:
+            progress = dict(self._progress)
+        progress['completed'] = progress['generated'] + progress['skipped'] + progress['failed']
+        return progress
+
+    def _hold_scheduler_lock(self, lock_path):
+        # True once this process holds the lock file; it is kept open, and so
+        # held, until the process exits and another worker takes it over
+        if self._lock_file is not None or fcntl is None:
+            return True
+        f = open(lock_path, 'w')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._lock_file = f
+        return True
+
+    def start_scheduler(self, interval=PREGENERATE_INTERVAL, lock_path=PREGENERATE_LOCK):
+        # Runs the job now and then every `interval` seconds in the background.
+        # Only the worker process holding `lock_path` runs it; the others keep
+        # checking in case that process exits. Calling it again is a no-op.
+        with self._lock:
+            if self._scheduler is not None:
+                return self._scheduler
+
+            def loop():
+                while True:
+                    if self._hold_scheduler_lock(lock_path):
+                        self.run()
+                    time.sleep(interval)
+            self._scheduler = threading.Thread(target=loop, name='pregenerate-scheduler', daemon=True)
+            self._scheduler.start()
+            return self._scheduler
+
+
+def job_from_env(model, jobs):
+    return PregenerationJob(
+        model, jobs,
+        workers=int(os.getenv('PREGENERATE_WORKERS', PREGENERATE_WORKERS)),
+        rate_per_minute=float(os.getenv('PREGENERATE_RATE', PREGENERATE_RATE)),
+        refresh_after=float(os.getenv('PREGENERATE_REFRESH_AFTER', PREGENERATE_REFRESH_AFTER))
+    )
+
+
+if __name__ == '__main__':
+    # One-off run over the web app's catalogue, printing progress as it goes
+    import web_app
+
+    job = web_app.pregeneration
+    worker = threading.Thread(target=job.run)
+    worker.start()
+    while worker.is_alive():
+        worker.join(2)
+        progress = job.progress()
+        sys.stdout.write(f"\r{progress['completed']}/{progress['total']} done "
+                         f"({progress['generated']} generated, {progress['skipped']} fresh, "
+                         f"{progress['failed']} failed)")
+        sys.stdout.flush()
+    print()
+    for error in job.progress()['errors']:
+        print(f"  {error}")
@@ -0,0 +1,119 @@
+import re
+import string
+import hashlib
+
+from chat_memory import estimate_tokens
+
+TEST_QUESTIONS = 5
+
+# Closing instruction for each output format a template can be compiled for
+FORMATS = {
+    'html': "Format the response as HTML using headings, <p>, <ul>/<ol>, <code>, <strong>, <em> and "
+            "<blockquote>.",
+    'text': "Format the response as plain text with headings and bullet points.",
+    'json': "Respond with JSON only, without markdown fences, in exactly this format:\n"
+            '{{"questions": [{{"question": "...", "options": {{"A": "...", "B": "...", "C": "...", "D": "..."}}, '
+            '"answer": "A", "explanation": "..."}}]}}'
+}
+
+SOURCES = {
+    'study_material': """You are an expert {subject} tutor. Write study material on {topic} at {difficulty} level with these sections:
+1. Key Concepts: the fundamental principles and theories
+2. Formulas/Theorems: each relevant one, explained
+3. Examples: 3 step-by-step worked examples
+4. Practice Problems: 5 problems of varying difficulty
+5. Common Mistakes: misconceptions and how to avoid them
+6. Study Tips: strategies for mastering the topic
+{format}""",
+    'practice_test': """You are an expert {subject} exam writer. Write a {count}-question multiple choice practice test on {topic} at {difficulty} level. Each question has 4 options (A-D), one correct answer and an explanation of why it is correct.
+{variation}{format}""",
+    'chat': """You are an expert {subject} tutor for {topic} at {difficulty} level.
+{history}Question: {question}
+Answer it directly, with examples or analogies, breaking complex ideas into simple parts, and suggest related topics to study next.
+{format}""",
+}
+
+
+class Prompt(str):
+    # A rendered prompt, tagged with its template version and token estimate
+    # (estimate_tokens, not the model's tokenizer), and the key its response
+    # is kept under as fallback content
+    def __new__(cls, text, version, estimated_tokens, fallback_key=None):
+        prompt = super().__new__(cls, text)
+        prompt.version = version
+        prompt.estimated_tokens = estimated_tokens
+        prompt.fallback_key = fallback_key
+        return prompt
+
+
+class PromptTemplate:
+    """One prompt kind compiled for one output format.
+
+    The format instruction is baked in and the source is split into
+    literal parts and fields once, so rendering is a join and the static
+    part's tokens are only estimated at compile time. Estimated, not
+    counted: estimate_tokens' four characters per token, which saves a
+    count_tokens call to the API per template. The version is a
+    hash of the compiled source; it goes into response cache keys, so
+    editing a template retires the responses generated from the old one.
+    """
+
+    def __init__(self, kind, output_format, source):
+        self.kind = kind
+        self.format = output_format
+        # Trailing spaces and runs of blank lines cost tokens and say nothing
+        source = source.replace('{format}', FORMATS[output_format])
+        self.source = re.sub(r'\n{3,}', '\n\n', '\n'.join(line.rstrip() for line in source.strip().split('\n')))
+        self.version = f"{kind}.{output_format}@{hashlib.sha256(self.source.encode('utf-8')).hexdigest()[:10]}"
+        self.parts = [(literal, field) for literal, field, _, _ in string.Formatter().parse(self.source)]
+        self.fields = {field for _, field in self.parts if field}
+        self.estimated_static_tokens = estimate_tokens(''.join(literal for literal, _ in self.parts))
+
+    def render(self, **values):
+        missing = self.fields - set(values)
+        if missing:
+            raise KeyError(f"Prompt {self.version} needs {', '.join(sorted(missing))}")
+        values = {name: str(value) for name, value in values.items()}
+        text = ''.join(literal + (values[field] if field else '') for literal, field in self.parts)
+        # Answers to a specific question make no sense for another one, so
+        # only question-free prompts get a fallback key
+        fallback_key = None
+        if 'question' not in self.fields:
+            fallback_key = '/'.join([f'{self.kind}.{self.format}', values['subject'], values['topic'],
+                                     values['difficulty']])
+        return Prompt(text, self.version, self.estimated_static_tokens + sum(estimate_tokens(values[field])
+                                                                            for _, field in self.parts if field),
+                      fallback_key)
+
+
+# Every template compiled once at import, per output format it is used with
+TEMPLATES = {(kind, output_format): PromptTemplate(kind, output_format, SOURCES[kind])
+             for kind, formats in {'study_material': ('html', 'text'), 'practice_test': ('json',),
+                                   'chat': ('html', 'text')}.items()
+             for output_format in formats}
+
+
+def get_template(kind, output_format):
+    return TEMPLATES[(kind, output_format)]
+
+
+def study_material_prompt(subject, topic, difficulty, output_format='html'):
+    return get_template('study_material', output_format).render(subject=subject, topic=topic, difficulty=difficulty)
+
+
+def practice_test_prompt(subject, topic, difficulty, count=TEST_QUESTIONS, question_set=0):
+    # Later sets are asked for different questions, and being different
+    # prompts, aren't answered from the first set's cache entry
+    variation = ''
+    if question_set:
+        variation = (f"This is question set {question_set + 1}: cover different aspects of the topic than "
+                     f"earlier sets.\n")
+    return get_template('practice_test', 'json').render(subject=subject, topic=topic, difficulty=difficulty,
+                                                        count=count, variation=variation)
+
+
+def chat_prompt(subject, topic, difficulty, question, history='', output_format='html'):
+    if history:
+        history = f"Conversation so far:\n{history}\n\n"
+    return get_template('chat', output_format).render(subject=subject, topic=topic, difficulty=difficulty,
+                                                      question=question, history=history)
@@ -0,0 +1,301 @@
+import os
+import atexit
+import hashlib
+import sqlite3
+import threading
+import time
+
+from single_flight import get_single_flight, process_lock
+from admission import AdmissionRejected
+from metrics import get_metrics
+
+# Cache defaults, overridable through RESPONSE_CACHE_* in the .env file
+CACHE_PATH = 'response_cache.db'
+CACHE_TTL = 7 * 24 * 3600
+CACHE_MAX_ENTRIES = 500
+CACHE_MAX_BYTES = 50 * 1024 * 1024
+CACHE_VARIANTS = 1
+
+# Hit/miss counts are kept in memory and written after this many lookups
+COUNTER_FLUSH_EVERY = 100
+# A hit only rewrites last_access once it is this many seconds old
+ACCESS_RESOLUTION = 60
+
+DEFAULT_MODEL_NAME = 'gemini-1.5-pro'
+
+
+def normalize_prompt(prompt):
+    # Whitespace-only edits to a prompt shouldn't retire cached responses,
+    # so collapse all whitespace before hashing
+    return ' '.join(prompt.split())
+
+
+def cache_key(prompt, model_name=DEFAULT_MODEL_NAME):
+    digest = hashlib.sha256()
+    digest.update(model_name.encode('utf-8'))
+    digest.update(b'\0')
+    # Prompts rendered from a template carry its version, so editing the
+    # template changes every key made from it
+    version = getattr(prompt, 'version', None)
+    if version:
+        digest.update(version.encode('utf-8'))
+        digest.update(b'\0')
+    digest.update(normalize_prompt(prompt).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def model_name_of(model):
+    return getattr(model, 'model_name', None) or DEFAULT_MODEL_NAME
+
+
+class StaleResponse(str):
+    # Fallback text served while the model is unavailable; `created` is
+    # when it was generated
+    def __new__(cls, text, created):
+        response = super().__new__(cls, text)
+        response.created = created
+        return response
+
+
+class ResponseCache:
+    """Persistent SQLite-backed cache of model responses keyed by prompt hash.
+
+    Each key holds up to `variants` responses. Until a key has all of its
+    variants a lookup counts as a miss so a fresh response gets generated;
+    after that the least recently served variant is returned, which rotates
+    through them round-robin. With a single variant, a hit is a read only:
+    last_access is refreshed at most every ACCESS_RESOLUTION seconds and
+    the hit/miss counters are written in batches (and at exit).
+
+    Responses to template prompts with a fallback key (study material and
+    practice tests for one subject/topic/difficulty) are also kept as the
+    last good response for that key, outside the TTL and size limits and
+    whatever the template version, to be served stale when the model
+    can't be reached.
+    """
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES,
+                 max_bytes=CACHE_MAX_BYTES, variants=CACHE_VARIANTS):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.variants = max(1, variants)
+        self._lock = threading.Lock()
+        self._pending = {'hits': 0, 'misses': 0}
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                key TEXT NOT NULL,
+                variant INTEGER NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (key, variant))""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS fallbacks (
+                fallback_key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created REAL NOT NULL)""")
+            self._conn.execute("INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0)")
+        atexit.register(self.flush)
+
+    def _count(self, name):
+        self._pending[name] += 1
+        if sum(self._pending.values()) >= COUNTER_FLUSH_EVERY:
+            self._flush_counters()
+
+    def _flush_counters(self):
+        with self._conn:
+            for name, value in self._pending.items():
+                if value:
+                    self._conn.execute("UPDATE counters SET value = value + ? WHERE name = ?", (value, name))
+        self._pending = dict.fromkeys(self._pending, 0)
+
+    def flush(self):
+        with self._lock:
+            self._flush_counters()
+
+    def get(self, key, count=True):
+        now = time.time()
+        with self._lock:
+            # Expired variants are skipped here and deleted by the next put()
+            rows = self._conn.execute(
+                "SELECT variant, response, last_access FROM entries WHERE key = ? AND created >= ? "
+                "ORDER BY last_access",
+                (key, now - self.ttl if self.ttl > 0 else 0)).fetchall()
+            if len(rows) < self.variants:
+                if count:
+                    self._count('misses')
+                return None
+            variant, response, last_access = rows[0]
+            # Rotating through variants needs every serve recorded; otherwise
+            # last_access only orders eviction, and a coarse one will do
+            if self.variants > 1 or now - last_access >= ACCESS_RESOLUTION:
+                with self._conn:
+                    self._conn.execute("UPDATE entries SET last_access = ? WHERE key = ? AND variant = ?",
+                                       (now, key, variant))
+            if count:
+                self._count('hits')
+            return response
+
+    def put(self, key, response, fallback_key=None):
+        now = time.time()
+        with self._lock, self._conn:
+            if self.ttl > 0:
+                self._conn.execute("DELETE FROM entries WHERE key = ? AND created < ?", (key, now - self.ttl))
+            if fallback_key:
+                self._conn.execute("INSERT OR REPLACE INTO fallbacks VALUES (?, ?, ?)", (fallback_key, response, now))
+            used = [row[0] for row in self._conn.execute(
+                "SELECT variant FROM entries WHERE key = ? ORDER BY last_access", (key,))]
+            if len(used) < self.variants:
+                variant = next(i for i in range(self.variants) if i not in used)
+            else:
+                # All variant slots are taken, overwrite the stalest one
+                variant = used[0]
+            self._conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                               (key, variant, response, len(response.encode('utf-8')), now, now))
+            self._evict(now)
+
+    def _evict(self, now):
+        if self.ttl > 0:
+            self._conn.execute("DELETE FROM entries WHERE created < ?", (now - self.ttl,))
+        count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        if count <= self.max_entries and size <= self.max_bytes:
+            return
+        # Drop least recently used entries until both bounds are satisfied
+        for key, variant, entry_size in self._conn.execute(
+                "SELECT key, variant, size FROM entries ORDER BY last_access").fetchall():
+            if count <= self.max_entries and size <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM entries WHERE key = ? AND variant = ?", (key, variant))
+            count -= 1
+            size -= entry_size
+
+    def fallback(self, fallback_key):
+        # The last good response for the key as a StaleResponse, or None
+        with self._lock:
+            row = self._conn.execute("SELECT response, created FROM fallbacks WHERE fallback_key = ?",
+                                     (fallback_key,)).fetchone()
+        return StaleResponse(row[0], row[1]) if row else None
+
+    def age(self, key):
+        # Seconds since the oldest variant of `key` was stored, or None if the
+        # key doesn't have all of its variants yet
+        with self._lock:
+            count, created = self._conn.execute(
+                "SELECT COUNT(*), MIN(created) FROM entries WHERE key = ?", (key,)).fetchone()
+        return time.time() - created if count >= self.variants else None
+
+    def stats(self):
+        with self._lock:
+            self._flush_counters()
+            counters = dict(self._conn.execute("SELECT name, value FROM counters"))
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        lookups = counters['hits'] + counters['misses']
+        return {
+            'hits': counters['hits'],
+            'misses': counters['misses'],
+            'hit_rate': counters['hits'] / lookups if lookups else 0.0,
+            'entries': entries,
+            'bytes': size
+        }
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM entries")
+            self._conn.execute("UPDATE counters SET value = 0")
+            self._pending = dict.fromkeys(self._pending, 0)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            # Read settings here rather than at import time so values from
+            # load_dotenv() are picked up
+            _cache = ResponseCache(
+                path=os.getenv('RESPONSE_CACHE_PATH', CACHE_PATH),
+                ttl=float(os.getenv('RESPONSE_CACHE_TTL', CACHE_TTL)),
+                max_entries=int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', CACHE_MAX_ENTRIES)),
+                max_bytes=int(os.getenv('RESPONSE_CACHE_MAX_BYTES', CACHE_MAX_BYTES)),
+                variants=int(os.getenv('RESPONSE_CACHE_VARIANTS', CACHE_VARIANTS))
+            )
+        return _cache
+
+
+def cached_generate(model, prompt, cache=None, validate=None, fallback=True):
+    # `validate` is called on freshly generated text before it is cached;
+    # if it raises, the response is discarded instead of being cached
+    # If the model fails, the last good response for the prompt's fallback
+    # key is returned instead, as a StaleResponse, unless `fallback` is off
+    cache = cache or get_cache()
+    key = cache_key(prompt, model_name_of(model))
+    text = cache.get(key)
+    get_metrics().inc('response_cache_lookups_total', result='miss' if text is None else 'hit')
+    if text is None:
+        # Identical concurrent misses share one upstream call
+        try:
+            text = get_single_flight().do(key, lambda: _generate_once(model, prompt, key, cache, validate))
+        except AdmissionRejected:
+            # The model is fine, this caller has to wait its turn
+            raise
+        except Exception:
+            text = stale_fallback(prompt, cache) if fallback else None
+            if text is None:
+                raise
+    return text
+
+
+def stale_fallback(prompt, cache=None):
+    fallback_key = getattr(prompt, 'fallback_key', None)
+    text = (cache or get_cache()).fallback(fallback_key) if fallback_key else None
+    if text is not None:
+        get_metrics().inc('stale_responses_total', kind=fallback_key.split('/')[0])
+    return text
+
+
+def _generate_once(model, prompt, key, cache, validate):
+    with process_lock(key):
+        # Another worker process may have filled the entry while we waited
+        text = cache.get(key, count=False)
+        if text is None:
+            text = model.generate_content(prompt).text
+            if validate is not None:
+                validate(text)
+            cache.put(key, text, getattr(prompt, 'fallback_key', None))
+        return text
+
+
+def cached_generate_stream(model, prompt, cache=None):
+    # Yields response text chunks as they arrive. A cache hit is delivered as a
+    # single chunk; a miss is streamed from the model and cached once complete.
+    cache = cache or get_cache()
+    key = cache_key(prompt, model_name_of(model))
+    text = cache.get(key)
+    get_metrics().inc('response_cache_lookups_total', result='miss' if text is None else 'hit')
+    if text is not None:
+        yield text
+        return
+    yield from get_single_flight().do_stream(key, lambda: _stream_once(model, prompt, key, cache))
+
+
+def _stream_once(model, prompt, key, cache):
+    with process_lock(key):
+        text = cache.get(key, count=False)
+        if text is not None:
+            yield text
+            return
+        chunks = []
+        for chunk in model.generate_content(prompt, stream=True):
+            chunks.append(chunk.text)
+            yield chunk.text
+        cache.put(key, ''.join(chunks), getattr(prompt, 'fallback_key', None))
@@ -0,0 +1,261 @@
+import os
+import re
+import time
+import zlib
+import threading
+from collections import OrderedDict
+
+from metrics import get_metrics
+
+# Semantic cache defaults, overridable through SEMANTIC_CACHE_* in the .env file
+SEMANTIC_CACHE_THRESHOLD = 0.9  # cosine similarity a cached question needs to be reused
+SEMANTIC_CACHE_DIM = 1024
+SEMANTIC_CACHE_CONTEXT_SIZE = 256  # questions kept per subject/topic/difficulty
+SEMANTIC_CACHE_CONTEXTS = 128
+SEMANTIC_CACHE_TTL = 7 * 24 * 3600
+# Looser match accepted, regardless of age, while the model is unavailable
+SEMANTIC_CACHE_FALLBACK_THRESHOLD = 0.7
+
+TOKEN = re.compile(r"[a-z]+|\d+(?:\.\d+)?|[^\w\s?!.,;:'\"()]", re.IGNORECASE)
+POSSESSIVE = re.compile(r"['’]s\b")
+# Roman numerals up to 39, enough for wars, monarchs and popes
+ROMAN = re.compile(r"x{0,3}(?:ix|iv|v?i{0,3})")
+# Words that only phrase the question; "what is a derivative" and
+# "explain derivatives" both reduce to "derivative"
+FILLER = {
+    'a', 'about', 'an', 'and', 'are', 'be', 'can', 'could', 'define', 'definition', 'describe', 'do', 'does',
+    'explain', 'give', 'help', 'i', 'in', 'is', 'it', 'me', 'mean', 'meaning', 'meant', 'my', 'of', 'please',
+    'tell', 'the', 'to', 'understand', 'what', 'whats', 'would', 'you'
+}
+NGRAMS = (3, 4, 5)
+WORD_WEIGHT = 2.0
+CANDIDATES = 5  # nearest questions checked for a usable match
+
+
+def _stem(word):
+    # Just enough stemming to fold plurals together
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+
+def tokenize(question):
+    # Content words, and the literals (numbers, symbols, single letters and
+    # Roman numerals) that must match exactly: "derivative of x^2" is not
+    # "derivative of x^3", nor "World War I" "World War II"
+    words = []
+    literals = set()
+    tokens = TOKEN.findall(POSSESSIVE.sub('', question))
+    for position, original in enumerate(tokens):
+        token = original.lower()
+        if token == 'i':
+            # A numeral after a name ("World War I", "Henry I"), otherwise
+            # the pronoun ("Can I", "why do I")
+            previous = tokens[position - 1] if position else ''
+            if position > 1 and previous.isalpha() and previous[0].isupper():
+                literals.add(token)
+            continue
+        if token in FILLER:
+            continue
+        if not token.isalpha() or len(token) == 1 or ROMAN.fullmatch(token):
+            literals.add(token)
+        else:
+            words.append(_stem(token))
+    return words, tuple(sorted(literals))
+
+
+def match_key(words, literals):
+    # Questions only share an answer when they have the same content words
+    # and literals; one differing word ("renewable" and "nonrenewable",
+    # "French" and "Russian" Revolution) changes the question, however
+    # similar the vectors are
+    return tuple(sorted(set(words))), literals
+
+
+def embed(words, dim=SEMANTIC_CACHE_DIM):
+    # Signed feature hashing of whole words and their character n-grams,
+    # L2-normalized so a dot product is the cosine similarity. NumPy is
+    # imported on first use to keep it out of startup
+    import numpy as np
+
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in words:
+        features = [(f'w:{word}', WORD_WEIGHT)]
+        padded = f' {word} '
+        for n in NGRAMS:
+            features.extend((padded[i:i + n], 1.0) for i in range(len(padded) - n + 1))
+        for feature, weight in features:
+            h = zlib.crc32(feature.encode('utf-8'))
+            vector[h % dim] += weight if h & 0x80000000 else -weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+
+class _Partition:
+    # Questions of one context as rows of a matrix, with their answers
+    def __init__(self, dim, capacity):
+        import numpy as np
+
+        self.capacity = capacity
+        self.vectors = np.zeros((min(16, capacity), dim), dtype=np.float32)
+        # Hash of each row's match key, so rows that can't match are masked
+        # out of the similarity ranking in one vectorized comparison
+        self.keys = np.zeros(len(self.vectors), dtype=np.int64)
+        self.entries = []  # [match key, answer, created, last_used]
+
+    def nearest(self, vector, key):
+        import numpy as np
+
+        count = len(self.entries)
+        sims = self.vectors[:count] @ vector
+        sims[self.keys[:count] != hash(key)] = -1.0
+        order = np.argsort(-sims)[:CANDIDATES]
+        return [(int(i), float(sims[i])) for i in order]
+
+    def put(self, vector, entry, now, ttl):
+        import numpy as np
+
+        if len(self.entries) < self.capacity:
+            row = len(self.entries)
+            if row == len(self.vectors):
+                grown = np.zeros((min(2 * row, self.capacity), self.vectors.shape[1]), dtype=np.float32)
+                grown[:row] = self.vectors
+                self.vectors = grown
+                self.keys = np.resize(self.keys, len(grown))
+            self.entries.append(entry)
+        else:
+            # Full: reuse an expired row, else the least recently used one
+            row = min(range(len(self.entries)),
+                      key=lambda i: (self.entries[i][2] >= now - ttl, self.entries[i][3]))
+            self.entries[row] = entry
+        self.vectors[row] = vector
+        self.keys[row] = hash(entry[0])
+
+
+class SemanticCache:
+    """Chat answers reused for questions phrased differently.
+
+    Questions are embedded on the CPU with a hashed word and character
+    n-gram vectorizer, so no model is loaded. Each subject/topic/difficulty
+    (and model) context has its own NumPy matrix of question vectors; a
+    lookup is one matrix-vector product over that context only. The
+    similarity only ranks candidates: a cached question is reused when it
+    has the same content words (plurals folded, filler dropped) and the
+    same numbers, symbols and numerals, and its cosine similarity reaches
+    `threshold`; while the model is unavailable, `fallback` accepts
+    `fallback_threshold` and any age.
+    Contexts and the questions within them are evicted least recently used
+    first, and answers expire after `ttl` seconds.
+    """
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, dim=SEMANTIC_CACHE_DIM,
+                 context_size=SEMANTIC_CACHE_CONTEXT_SIZE, max_contexts=SEMANTIC_CACHE_CONTEXTS,
+                 ttl=SEMANTIC_CACHE_TTL, fallback_threshold=SEMANTIC_CACHE_FALLBACK_THRESHOLD, enabled=True):
+        self.threshold = threshold
+        self.fallback_threshold = min(fallback_threshold, threshold)
+        self.dim = dim
+        self.context_size = context_size
+        self.max_contexts = max_contexts
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._partitions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _find(self, context, question, threshold, ttl):
+        words, literals = tokenize(question)
+        vector = embed(words, self.dim)
+        if vector is None:
+            return None
+        key = match_key(words, literals)
+        now = time.time()
+        with self._lock:
+            partition = self._partitions.get(context)
+            if partition is None:
+                return None
+            self._partitions.move_to_end(context)
+            for row, similarity in partition.nearest(vector, key):
+                entry = partition.entries[row]
+                if similarity < threshold:
+                    return None
+                if entry[0] == key and (ttl is None or entry[2] >= now - ttl):
+                    entry[3] = now
+                    return entry[1]
+        return None
+
+    def lookup(self, context, question):
+        # The cached answer to a close-enough question, or None
+        if not self.enabled:
+            return None
+        answer = self._find(context, question, self.threshold, self.ttl)
+        with self._lock:
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        get_metrics().inc('semantic_cache_lookups_total', result='miss' if answer is None else 'hit')
+        return answer
+
+    def fallback(self, context, question):
+        # A looser match, however old, for when the model can't answer
+        if not self.enabled:
+            return None
+        return self._find(context, question, self.fallback_threshold, None)
+
+    def add(self, context, question, answer):
+        if not self.enabled:
+            return
+        words, literals = tokenize(question)
+        vector = embed(words, self.dim)
+        if vector is None:
+            return  # nothing but filler words; too vague to match on
+        key = match_key(words, literals)
+        now = time.time()
+        with self._lock:
+            partition = self._partitions.get(context)
+            if partition is None:
+                partition = self._partitions[context] = _Partition(self.dim, self.context_size)
+                while len(self._partitions) > self.max_contexts:
+                    self._partitions.popitem(last=False)
+            self._partitions.move_to_end(context)
+            # A rephrasing of a question already cached replaces its answer
+            for row, _ in partition.nearest(vector, key):
+                if partition.entries[row][0] == key:
+                    partition.entries[row] = [key, answer, now, now]
+                    return
+            partition.put(vector, [key, answer, now, now], now, self.ttl)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'contexts': len(self._partitions),
+                'entries': sum(len(p.entries) for p in self._partitions.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_semantic_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = SemanticCache(
+                threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', SEMANTIC_CACHE_THRESHOLD)),
+                dim=int(os.getenv('SEMANTIC_CACHE_DIM', SEMANTIC_CACHE_DIM)),
+                context_size=int(os.getenv('SEMANTIC_CACHE_CONTEXT_SIZE', SEMANTIC_CACHE_CONTEXT_SIZE)),
+                max_contexts=int(os.getenv('SEMANTIC_CACHE_CONTEXTS', SEMANTIC_CACHE_CONTEXTS)),
+                ttl=float(os.getenv('SEMANTIC_CACHE_TTL', SEMANTIC_CACHE_TTL)),
+                fallback_threshold=float(os.getenv('SEMANTIC_CACHE_FALLBACK_THRESHOLD',
+                                                   SEMANTIC_CACHE_FALLBACK_THRESHOLD)),
+                enabled=os.getenv('SEMANTIC_CACHE', '1') == '1'
+            )
+        return _cache
@@ -0,0 +1,178 @@
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on Windows; cross-process coalescing is simply skipped there
+    fcntl = None
+
+
+def is_shared(error):
+    # Errors that belong to the caller rather than the call, like an
+    # admission rejection, set `shared = False`; callers that joined the
+    # flight retry instead of receiving them
+    return getattr(error, 'shared', True)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _StreamFlight:
+    def __init__(self):
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def subscribe(self):
+        # Replays the chunks produced so far, then follows the live stream
+        position = 0
+        while True:
+            with self.cond:
+                while position >= len(self.chunks) and not self.finished:
+                    self.cond.wait()
+                batch = self.chunks[position:]
+                position = len(self.chunks)
+                if not batch:
+                    if self.error is not None:
+                        raise self.error
+                    return
+            yield from batch
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into one upstream call.
+
+    The first caller for a key runs the function; callers arriving while it
+    is in flight wait for it and share its result or exception, unless
+    the exception is the leader's own (see `is_shared`). Streamed
+    calls are produced by a background thread into a shared buffer that
+    every caller reads from, so a late joiner gets the chunks produced so
+    far and then follows along.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._streams = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, fn):
+        while True:
+            with self._lock:
+                stream = self._streams.get(key)
+                flight = self._flights.get(key)
+                if stream is not None or flight is not None:
+                    self.followers += 1
+                    leader = False
+                else:
+                    flight = self._flights[key] = _Flight()
+                    self.leaders += 1
+                    leader = True
+            if leader:
+                break
+            try:
+                if stream is not None:
+                    return ''.join(stream.subscribe())
+                return flight.wait()
+            except Exception as e:
+                if is_shared(e):
+                    raise
+                # The leader's own failure; try again, as leader if need be
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def do_stream(self, key, fn):
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                stream = self._streams.get(key)
+                leader = flight is None and stream is None
+                if leader:
+                    stream = self._streams[key] = _StreamFlight()
+                    self.leaders += 1
+                    threading.Thread(target=self._produce, args=(key, stream, fn), daemon=True).start()
+                else:
+                    self.followers += 1
+            sent = False
+            try:
+                if flight is not None:
+                    yield flight.wait()
+                    return
+                for chunk in stream.subscribe():
+                    sent = True
+                    yield chunk
+                return
+            except Exception as e:
+                # A follower that hasn't received anything yet retries after
+                # the leader's own failure
+                if leader or sent or is_shared(e):
+                    raise
+
+    def _produce(self, key, stream, fn):
+        try:
+            for chunk in fn():
+                with stream.cond:
+                    stream.chunks.append(chunk)
+                    stream.cond.notify_all()
+        except Exception as e:
+            stream.error = e
+        finally:
+            with self._lock:
+                del self._streams[key]
+            with stream.cond:
+                stream.finished = True
+                stream.cond.notify_all()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'upstream_calls': self.leaders,
+                'coalesced_calls': self.followers,
+                'in_flight': len(self._flights) + len(self._streams)
+            }
+
+
+@contextmanager
+def process_lock(key, lock_dir=None):
+    # Serializes work on `key` across worker processes through an flock'd
+    # file in SINGLE_FLIGHT_LOCK_DIR; a no-op when that isn't configured
+    lock_dir = lock_dir or os.getenv('SINGLE_FLIGHT_LOCK_DIR')
+    if not lock_dir or fcntl is None:
+        yield
+        return
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, f"{key}.lock"), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+_single_flight = SingleFlight()
+
+
+def get_single_flight():
+    return _single_flight
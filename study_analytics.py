@@ -0,0 +1,123 @@
+import sqlite3
+import threading
+from datetime import datetime, date, timedelta
+
+from history_store import SqliteHistoryStore, get_store
+
+RECENT_ACTIVITY_SIZE = 5
+
+# strftime formats for the study time buckets; weeks start on Monday
+BUCKETS = {'day': '%Y-%m-%d', 'week': '%Y-W%W', 'month': '%Y-%m'}
+
+
+class StudyAnalytics:
+    """Per-user queries over the SQLite study history.
+
+    Every query is restricted to one user. Totals, time buckets, streaks
+    and topic trends are read from the per-day `daily_totals` rollup, and
+    recent activity, activity counts and scores from indexes on the event
+    log, so a query costs the same however large the whole log grows and
+    at most one row per day and topic for the user's own history.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(store.path, timeout=30, check_same_thread=False)
+
+    def _query(self, sql, params):
+        self.store.flush()
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def summary(self, user_id, recent_size=RECENT_ACTIVITY_SIZE):
+        # Same shape as StudyStatistics.snapshot(), for one user
+        subjects = self._query(
+            "SELECT subject, SUM(sessions), SUM(seconds) FROM daily_totals WHERE user_id = ? "
+            "GROUP BY subject ORDER BY 2 DESC", (user_id,))
+        activities = self._query(
+            "SELECT activity_type, COUNT(*) FROM events WHERE user_id = ? GROUP BY activity_type ORDER BY 2 DESC",
+            (user_id,))
+        recent = self._query(
+            "SELECT timestamp, subject, topic, difficulty, activity_type, duration FROM events "
+            "WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?", (user_id, recent_size))
+        return {
+            'sessions': sum(row[1] for row in subjects),
+            'total_time': sum(row[2] for row in subjects),
+            'subject_stats': {row[0]: row[1] for row in subjects},
+            'activity_stats': dict(activities),
+            'recent_activity': [{'timestamp': datetime.fromisoformat(row[0]), 'subject': row[1], 'topic': row[2],
+                                 'difficulty': row[3], 'activity_type': row[4], 'duration': row[5]}
+                                for row in recent]
+        }
+
+    def study_time(self, user_id, bucket='day', days=30):
+        # Sessions and seconds studied per day, week or month over the last `days` days
+        if bucket not in BUCKETS:
+            raise ValueError(f"Unknown bucket '{bucket}', expected one of: {', '.join(BUCKETS)}")
+        since = (date.today() - timedelta(days=days)).isoformat()
+        rows = self._query(
+            "SELECT strftime(?, day) AS bucket, SUM(sessions), SUM(seconds) FROM daily_totals "
+            "WHERE user_id = ? AND day >= ? GROUP BY bucket ORDER BY bucket",
+            (BUCKETS[bucket], user_id, since))
+        return [{'bucket': row[0], 'sessions': row[1], 'seconds': row[2]} for row in rows]
+
+    def streaks(self, user_id, today=None):
+        # Consecutive days with at least one session; the current streak
+        # still counts if the user hasn't studied yet today
+        days = [date.fromisoformat(row[0]) for row in self._query(
+            "SELECT DISTINCT day FROM daily_totals WHERE user_id = ? ORDER BY day", (user_id,))]
+        today = today or date.today()
+        longest = run = 0
+        previous = None
+        for day in days:
+            run = run + 1 if previous is not None and day - previous == timedelta(days=1) else 1
+            longest = max(longest, run)
+            previous = day
+        current = run if days and today - days[-1] <= timedelta(days=1) else 0
+        return {'current': current, 'longest': longest, 'active_days': len(days),
+                'last_active': days[-1].isoformat() if days else None}
+
+    def topic_trends(self, user_id, subject=None, bucket='week'):
+        # Per-topic sessions, time and average score per bucket
+        if bucket not in BUCKETS:
+            raise ValueError(f"Unknown bucket '{bucket}', expected one of: {', '.join(BUCKETS)}")
+        where = "user_id = ?" + (" AND subject = ?" if subject else "")
+        params = (BUCKETS[bucket], user_id) + ((subject,) if subject else ())
+        rows = self._query(
+            f"SELECT subject, topic, strftime(?, day) AS bucket, SUM(sessions), SUM(seconds), "
+            f"SUM(score_sum) / NULLIF(SUM(scored), 0) FROM daily_totals WHERE {where} "
+            f"GROUP BY subject, topic, bucket ORDER BY subject, topic, bucket", params)
+        trends = {}
+        for subject_name, topic, bucket_name, sessions, seconds, score in rows:
+            trends.setdefault(f"{subject_name} / {topic}", []).append(
+                {'bucket': bucket_name, 'sessions': sessions, 'seconds': seconds, 'average_score': score})
+        return trends
+
+    def score_history(self, user_id, subject=None, topic=None, limit=50):
+        # Most recent practice test scores, newest first
+        sql = "SELECT timestamp, subject, topic, score FROM events WHERE user_id = ? AND score IS NOT NULL"
+        params = [user_id]
+        if subject:
+            sql += " AND subject = ?"
+            params.append(subject)
+        if topic:
+            sql += " AND topic = ?"
+            params.append(topic)
+        rows = self._query(sql + " ORDER BY timestamp DESC LIMIT ?", params + [limit])
+        return [{'timestamp': row[0], 'subject': row[1], 'topic': row[2], 'score': row[3]} for row in rows]
+
+
+_analytics = None
+_analytics_lock = threading.Lock()
+
+
+def get_analytics():
+    # None unless the history is kept in SQLite; the JSONL log has no indexes
+    global _analytics
+    with _analytics_lock:
+        if _analytics is None:
+            store = get_store()
+            if isinstance(store, SqliteHistoryStore):
+                _analytics = StudyAnalytics(store)
+        return _analytics
@@ -0,0 +1,105 @@
+import sys
+import math
+import heapq
+import threading
+from collections import Counter
+from datetime import datetime
+
+RECENT_ACTIVITY_SIZE = 5
+
+
+class StudyStatistics:
+    """Running aggregates over the study history event log.
+
+    Totals, per-subject and per-activity counters and a bounded heap of the
+    most recent sessions are updated once per event, so serving the
+    statistics page costs the same no matter how long the history is.
+    `refresh()` folds in whatever was appended to the store since the last
+    call, including events written by other processes.
+    """
+
+    def __init__(self, store, recent_size=RECENT_ACTIVITY_SIZE):
+        self.store = store
+        self.recent_size = recent_size
+        self.sessions = 0
+        self.total_time = 0.0
+        self.subject_counts = Counter()
+        self.activity_counts = Counter()
+        self._recent = []
+        self._seq = 0
+        self._cursor = 0
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        self.sessions += 1
+        self.total_time += float(event['duration'] or 0)
+        if event['subject'] is not None:
+            self.subject_counts[event['subject']] += 1
+        if event['activity_type'] is not None:
+            self.activity_counts[event['activity_type']] += 1
+
+        # Min-heap keyed on timestamp keeps only the newest `recent_size` events
+        self._seq += 1
+        entry = (str(event['timestamp']), self._seq, event)
+        if len(self._recent) < self.recent_size:
+            heapq.heappush(self._recent, entry)
+        elif entry > self._recent[0]:
+            heapq.heapreplace(self._recent, entry)
+
+    def refresh(self):
+        self.store.flush()
+        with self._lock:
+            events, self._cursor = self.store.read_since(self._cursor)
+            for event in events:
+                self.record(event)
+
+    def snapshot(self):
+        self.refresh()
+        with self._lock:
+            recent = [dict(event, timestamp=datetime.fromisoformat(str(event['timestamp'])))
+                      for _, _, event in sorted(self._recent, reverse=True)]
+            return {
+                'sessions': self.sessions,
+                'total_time': self.total_time,
+                'subject_stats': dict(self.subject_counts.most_common()),
+                'activity_stats': dict(self.activity_counts.most_common()),
+                'recent_activity': recent
+            }
+
+
+def check_consistency(stats, history):
+    # Compare the running aggregates against a full recompute over the
+    # history DataFrame, the way /statistics used to calculate them
+    snapshot = stats.snapshot()
+    problems = []
+    if snapshot['sessions'] != len(history):
+        problems.append(f"sessions: {snapshot['sessions']} != {len(history)}")
+    expected_total = float(history['duration'].sum())
+    if not math.isclose(snapshot['total_time'], expected_total, rel_tol=1e-9, abs_tol=1e-6):
+        problems.append(f"total_time: {snapshot['total_time']} != {expected_total}")
+    for name, column in [('subject_stats', 'subject'), ('activity_stats', 'activity_type')]:
+        expected = history[column].value_counts().to_dict()
+        if snapshot[name] != expected:
+            problems.append(f"{name}: {snapshot[name]} != {expected}")
+    expected_recent = list(history.sort_values('timestamp', ascending=False).head(stats.recent_size)['timestamp'])
+    actual_recent = [activity['timestamp'] for activity in snapshot['recent_activity']]
+    if actual_recent != expected_recent:
+        problems.append(f"recent_activity: {actual_recent} != {expected_recent}")
+    return problems
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from history_store import get_store, HistoryProjection
+
+    load_dotenv()
+    if len(sys.argv) < 2 or sys.argv[1] != 'check':
+        print("Usage: python study_stats.py check")
+        sys.exit(1)
+    store = get_store()
+    problems = check_consistency(StudyStatistics(store), HistoryProjection(store).frame())
+    for problem in problems:
+        print(f"Mismatch in {problem}")
+    if problems:
+        sys.exit(1)
+    print("Statistics are consistent with a full recompute")
@@ -1,24 +1,51 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
-import google.generativeai as genai
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, Response, stream_with_context, g
 from dotenv import load_dotenv
 import os
-import pandas as pd
-from datetime import datetime
 import json
+import time
+import uuid
+from datetime import datetime
+from response_cache import cached_generate, cached_generate_stream, get_cache, cache_key, model_name_of
+from circuit_breaker import CircuitOpenError
+from admission import get_admission, AdmissionRejected
+from single_flight import get_single_flight
+from history_store import get_store, make_event
+from study_stats import StudyStatistics
+from study_analytics import get_analytics
+from llm_client import get_client
+from pregenerate import job_from_env, RateLimiter, PREGENERATE_INTERVAL, PREGENERATE_LOCK
+from batch import parse_job, run_from_env, BATCH_RATE
+from practice_tests import get_test_store, parse_questions, grade, top_up_bank, DEFAULT_DIFFICULTY
+from mastery import get_mastery_store
+from prompts import study_material_prompt, practice_test_prompt, chat_prompt, get_template, TEST_QUESTIONS
+from chat_memory import get_chat_store
+from semantic_cache import get_semantic_cache
+from fragments import get_fragment_cache, sanitize_html
+from metrics import get_metrics
 
 # Load environment variables
 load_dotenv()
 
 # Configure Gemini API
 api_key = os.getenv('GEMINI_API_KEY')
-if not api_key:
+if not api_key and os.getenv('LLM_BACKEND') != 'fake':
     raise ValueError("GEMINI_API_KEY not found in .env file")
 
-genai.configure(api_key=api_key)
-model = genai.GenerativeModel('gemini-1.5-pro')
+# Shared client with a concurrency cap, deadlines and retries around the model
+model = get_client()
+
+# Latency, token and outcome metrics, served at /metrics
+metrics = get_metrics()
+
+# Per-user rate limits and a fair, bounded queue in front of model calls
+admission = get_admission()
+
+# APP_ENV=production requires a configured SECRET_KEY and shares chat
+# sessions between worker processes
+PRODUCTION = os.getenv('APP_ENV') == 'production'
 
-app = Flask(__name__)
-app.secret_key = os.urandom(24)  # For session management
+# Stream model output to the browser as Server-Sent Events
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') == '1'
 
 # Subject areas and their topics
 SUBJECTS = {
@@ -27,119 +54,361 @@ SUBJECTS = {
     'Languages': ['English', 'Spanish', 'French', 'German'],
     'History': ['World History', 'American History', 'Ancient History', 'Modern History']
 }
+DIFFICULTIES = ['Beginner', 'Intermediate', 'Advanced']
+TEST_TIME_LIMIT = 3600  # longest time counted as spent answering one test
+
+# Largest job list accepted by /api/batch
+BATCH_MAX_JOBS = int(os.getenv('BATCH_MAX_JOBS', 500))
+# Calls-per-minute budget shared by every /api/batch request in this worker
+batch_limiter = RateLimiter(float(os.getenv('BATCH_RATE', BATCH_RATE)))
+
+# Study history is an append-only event log; statistics are maintained
+# incrementally as events are read from it
+history_store = get_store()
+study_stats = StudyStatistics(history_store)
+
+# Per-user statistics and analytics from the indexed SQLite history; None
+# with the JSONL backend, where /statistics falls back to global totals
+analytics = get_analytics()
+
+# Bounded per-session chat history so follow-up questions keep their context
+chat_store = get_chat_store()
+
+# Answers to earlier chat questions, reused for rephrasings of them
+semantic_cache = get_semantic_cache()
+
+# Sanitized, minified and precompressed model HTML, built once per response
+fragment_cache = get_fragment_cache()
+
+# Per-user, per-topic skill ratings updated from graded tests; they pick
+# the level when a form is left on Auto and the questions a test gets
+mastery = get_mastery_store()
+
+def record_session(subject, topic, difficulty, activity_type, duration, score=None):
+    history_store.append(make_event(subject, topic, difficulty, activity_type, duration,
+                                    user_id=session['user_id'], score=score))
+
+def resolve_difficulty(subject, topic, difficulty):
+    return mastery.resolve(session['user_id'], subject, topic, difficulty)
+
+def model_unavailable():
+    # True while the circuit breaker has suspended model calls
+    breaker = getattr(model, 'breaker', None)
+    return breaker is not None and breaker.is_open
+
+def admitted(priority):
+    # The model for this request, behind admission control; rate limited per
+    # session and per client address, since sessions cost nothing to mint
+    return admission.wrap(model, session['user_id'], priority, request.remote_addr)
+
+def stale_since(content):
+    # When fallback content was generated, or None for a fresh response
+    created = getattr(content, 'created', None)
+    return datetime.fromtimestamp(created).strftime('%Y-%m-%d %H:%M') if created else None
+
+def chat_fallback(context, subject, topic, difficulty, question):
+    # An answer to a similar earlier question, else the study material for
+    # the topic; None if neither was ever generated
+    answer = semantic_cache.fallback(context, question)
+    if answer is None:
+        answer = get_cache().fallback(study_material_prompt(subject, topic, difficulty).fallback_key)
+    if answer is not None:
+        metrics.inc('stale_responses_total', kind='chat')
+    return answer
+
+def sse_event(data, event=None):
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+def stream_events(chunks, done=None):
+    try:
+        for chunk in chunks:
+            yield sse_event({'chunk': chunk})
+        yield sse_event(done() if done else {}, event='done')
+    except Exception as e:
+        yield sse_event({'error': str(e)}, event='error')
+
+def primed(chunks):
+    # Pulls the first chunk now, so an admission rejection or an unavailable
+    # model gets its own status and Retry-After rather than a 200 with an
+    # error event
+    chunks = iter(chunks)
+    try:
+        first = next(chunks)
+    except StopIteration:
+        return iter(())
+    
+    def rest():
+        yield first
+        yield from chunks
+    return rest()
+
+def sse_response(chunks, done=None):
+    # `done` returns the data sent with the final event
+    return Response(stream_with_context(stream_events(chunks, done)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def send_fragment(fragment):
+    # Answer conditional requests with 304, everything else with the
+    # smallest precompressed body the client accepts. The ETag is weak
+    # because the gzip and brotli bodies share it.
+    if request.if_none_match.contains_weak(fragment.etag):
+        encoding = None
+        response = Response(status=304)
+    else:
+        encoding, body = fragment.encoded({e for e in ('br', 'gzip') if request.accept_encodings[e]})
+        response = Response(body, mimetype='text/html')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(fragment.etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    metrics.inc('fragment_responses_total', status=response.status_code, encoding=encoding or 'identity')
+    return response
+
+def when_done(chunks, callback):
+    # Pass streamed chunks through, then hand the full text to `callback`
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    callback(''.join(parts))
+
+def pregeneration_jobs():
+    # Every study material and practice test the forms can ask for
+    jobs = []
+    for subject, topics in SUBJECTS.items():
+        for topic in topics:
+            for difficulty in DIFFICULTIES:
+                jobs.append((f"Study Materials: {subject} / {topic} ({difficulty})",
+                             study_material_prompt(subject, topic, difficulty)))
+                jobs.append((f"Practice Test: {subject} / {topic} ({difficulty})",
+                             practice_test_prompt(subject, topic, difficulty), parse_questions))
+    return jobs
+
+def batch_prompt(job):
+    # Prompt and validator for a batch job; practice tests export the parsed questions
+    if job['kind'] == 'practice_test':
+        return practice_test_prompt(job['subject'], job['topic'], job['difficulty'] or DEFAULT_DIFFICULTY), parse_questions
+    return study_material_prompt(job['subject'], job['topic'], job['difficulty']), None
+
+# Background warm-up of the catalogue so the routes are served from the cache
+pregeneration = job_from_env(admission.wrap(model, None, 'batch'), pregeneration_jobs())
+
+# Routes are collected here and registered on every app built by create_app()
+app_routes = []
+
+def route(rule, **options):
+    def decorator(view):
+        app_routes.append((rule, view, options))
+        return view
+    return decorator
+
+def load_secret_key():
+    # Sessions have to survive restarts and be readable by every worker, so
+    # the key comes from SECRET_KEY or from a key file created once
+    secret_key = os.getenv('SECRET_KEY')
+    if secret_key:
+        return secret_key
+    if PRODUCTION:
+        raise ValueError("SECRET_KEY must be set in the .env file when APP_ENV=production")
+    path = os.getenv('SECRET_KEY_FILE', '.secret_key')
+    if not os.path.exists(path):
+        # Write to a temporary file and link it into place, so concurrent
+        # workers agree on whichever key got there first
+        temp_path = f"{path}.{os.getpid()}"
+        with open(temp_path, 'wb') as f:
+            f.write(os.urandom(24))
+        os.chmod(temp_path, 0o600)
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+def create_app():
+    app = Flask(__name__)
+    app.secret_key = load_secret_key()  # For session management
+    for rule, view, options in app_routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.before_request(start_request_timer)
+    app.before_request(assign_user)
+    app.after_request(record_request_metrics)
+    app.register_error_handler(CircuitOpenError, model_unavailable_response)
+    app.register_error_handler(AdmissionRejected, admission_rejected_response)
+    
+    if os.getenv('PREGENERATE') == '1':
+        pregeneration.start_scheduler(float(os.getenv('PREGENERATE_INTERVAL', PREGENERATE_INTERVAL)),
+                                      os.getenv('PREGENERATE_LOCK', PREGENERATE_LOCK))
+    return app
+
+def start_request_timer():
+    g.request_start = time.perf_counter()
 
-# Initialize or load study history
-if os.path.exists('study_history.csv'):
-    study_history = pd.read_csv('study_history.csv')
-    study_history['timestamp'] = pd.to_datetime(study_history['timestamp'])
-else:
-    study_history = pd.DataFrame(columns=['timestamp', 'subject', 'topic', 'difficulty', 'activity_type', 'duration'])
+def assign_user():
+    # Study history is kept per browser; the id lives in the session cookie
+    if 'user_id' not in session:
+        session['user_id'] = uuid.uuid4().hex
+        session.permanent = True
 
-@app.route('/')
+def model_unavailable_response(error):
+    # Nothing to fall back on while the breaker is open
+    retry_after = int(error.retry_after) + 1
+    return (jsonify({'error': 'The AI service is temporarily unavailable, please try again shortly',
+                     'retry_after': retry_after}),
+            503, {'Retry-After': str(retry_after)})
+
+def admission_rejected_response(error):
+    retry_after = int(error.retry_after) + 1
+    return (jsonify({'error': str(error), 'reason': error.reason, 'retry_after': retry_after}),
+            429, {'Retry-After': str(retry_after)})
+
+def record_request_metrics(response):
+    # Streamed responses are timed until their headers are sent; the model
+    # side of the stream is covered by the llm_* metrics
+    route = request.endpoint or 'unknown'
+    metrics.observe('http_request_duration_seconds', time.perf_counter() - g.request_start,
+                    route=route, method=request.method)
+    metrics.inc('http_requests_total', route=route, status=response.status_code)
+    return response
+
+@route('/')
 def index():
     return render_template('index.html', subjects=SUBJECTS)
 
-@app.route('/study_material', methods=['GET', 'POST'])
+@route('/study_material', methods=['GET', 'POST'])
 def study_material():
     if request.method == 'POST':
         subject = request.form.get('subject')
         topic = request.form.get('topic')
-        difficulty = request.form.get('difficulty')
+        difficulty = resolve_difficulty(subject, topic, request.form.get('difficulty'))
+        prompt = study_material_prompt(subject, topic, difficulty)
         
-        prompt = f"""You are an expert tutor in {subject}. Create comprehensive study material for {topic} at {difficulty} level.
-
-        Include the following sections:
-        1. Key Concepts: Explain the fundamental principles and theories
-        2. Important Formulas/Theorems: List and explain all relevant formulas or theorems
-        3. Step-by-Step Examples: Provide 3 detailed examples with full explanations
-        4. Practice Problems: Create 5 practice problems with varying difficulty
-        5. Common Mistakes: Highlight common misconceptions and how to avoid them
-        6. Study Tips: Provide specific strategies for mastering this topic
+        # The page is a shell; the browser loads the finished material from
+        # /study_material/content, which supports conditional requests
+        content_url = url_for('study_material_content', subject=subject, topic=topic, difficulty=difficulty)
         
-        Format the response in HTML with appropriate headings and styling."""
+        if (STREAM_RESPONSES and not model_unavailable()
+                and get_cache().age(cache_key(prompt, model_name_of(model))) is None):
+            # Not generated yet: let the browser pull the material from
+            # /study_material/stream, which records the session
+            stream_url = url_for('study_material_stream', subject=subject, topic=topic, difficulty=difficulty)
+            return render_template('study_material.html', stream_url=stream_url, content_url=content_url,
+                                   subject=subject, topic=topic)
         
-        response = model.generate_content(prompt)
+        start_time = time.perf_counter()
+        content = cached_generate(admitted('generation'), prompt)
         
         # Record study session
-        global study_history
-        study_history.loc[len(study_history)] = {
-            'timestamp': datetime.now(),
-            'subject': subject,
-            'topic': topic,
-            'difficulty': difficulty,
-            'activity_type': 'Study Materials',
-            'duration': 0
-        }
-        study_history.to_csv('study_history.csv', index=False)
+        record_session(subject, topic, difficulty, 'Study Materials', time.perf_counter() - start_time)
         
-        return render_template('study_material.html', content=response.text, subject=subject, topic=topic)
+        return render_template('study_material.html', content_url=content_url, subject=subject, topic=topic,
+                               stale=stale_since(content))
     
     return render_template('generate_material.html', subjects=SUBJECTS)
 
-@app.route('/practice_test', methods=['GET', 'POST'])
+@route('/study_material/content')
+def study_material_content():
+    subject = request.args.get('subject')
+    topic = request.args.get('topic')
+    difficulty = request.args.get('difficulty')
+    
+    if not all([subject, topic, difficulty]):
+        return jsonify({'error': 'Missing required parameters'}), 400
+    
+    content = cached_generate(admitted('generation'), study_material_prompt(subject, topic, difficulty))
+    response = send_fragment(fragment_cache.process(content))
+    if stale_since(content):
+        # Served from fallback content while the model is unavailable
+        response.headers['Warning'] = '110 - "Response is Stale"'
+        response.headers['X-Content-Stale'] = stale_since(content)
+    return response
+
+@route('/study_material/stream')
+def study_material_stream():
+    subject = request.args.get('subject')
+    topic = request.args.get('topic')
+    difficulty = request.args.get('difficulty')
+    
+    if not all([subject, topic, difficulty]):
+        return jsonify({'error': 'Missing required parameters'}), 400
+    
+    start_time = time.perf_counter()
+    prompt = study_material_prompt(subject, topic, difficulty)
+    
+    def record(content):
+        # Record study session once the whole material has been sent
+        record_session(subject, topic, difficulty, 'Study Materials', time.perf_counter() - start_time)
+    
+    if model_unavailable():
+        # Send the fallback material whole rather than opening a stream
+        content = cached_generate(admitted('generation'), prompt)
+        return sse_response(when_done([sanitize_html(content)], record), lambda: {'stale': stale_since(content)})
+    return sse_response(when_done(primed(cached_generate_stream(admitted('generation'), prompt)), record))
+
+@route('/practice_test', methods=['GET', 'POST'])
 def practice_test():
     if request.method == 'POST':
         subject = request.form.get('subject')
         topic = request.form.get('topic')
+        difficulty = resolve_difficulty(subject, topic, request.form.get('difficulty'))
         
-        prompt = f"""You are an expert exam creator for {subject}. Create a 5-question practice test for {topic}.
-
-        For each question:
-        1. Write a clear, concise question
-        2. Provide 4 multiple choice options (A, B, C, D)
-        3. Indicate the correct answer
-        4. Provide a detailed explanation of why the answer is correct
-        
-        Format the response in HTML with appropriate styling and a modern quiz layout.
-        Make sure to wrap each question in a div with class 'question' and include a form for submission.
-        Add a 'data-correct' attribute to the correct answer option."""
-        
-        response = model.generate_content(prompt)
+        # Tests come from the bank of validated questions, which grows by a
+        # question set per test until it holds several tests' worth
+        start_time = time.perf_counter()
+        store = get_test_store()
+        stale = stale_since(top_up_bank(store, admitted('generation'), subject, topic, difficulty))
+        # Of a sample of the bank, ask the questions rated nearest the
+        # user's skill that they haven't answered correctly before
+        candidates = store.sample(subject, topic, TEST_QUESTIONS * 4, difficulty)
+        questions = mastery.pick_questions(session['user_id'], subject, topic, candidates, TEST_QUESTIONS)
+        test_id, questions = store.create_test(subject, topic, questions, difficulty)
         
         # Record session
-        global study_history
-        study_history.loc[len(study_history)] = {
-            'timestamp': datetime.now(),
-            'subject': subject,
-            'topic': topic,
-            'difficulty': 'N/A',
-            'activity_type': 'Practice Test',
-            'duration': 0
-        }
-        study_history.to_csv('study_history.csv', index=False)
+        record_session(subject, topic, difficulty, 'Practice Test', time.perf_counter() - start_time)
         
-        return render_template('practice_test.html', content=response.text, subject=subject, topic=topic)
+        return render_template('practice_test.html', test_id=test_id, questions=questions, subject=subject,
+                               topic=topic, difficulty=difficulty, stale=stale)
     
     return render_template('generate_test.html', subjects=SUBJECTS)
 
-@app.route('/submit_test', methods=['POST'])
+@route('/submit_test', methods=['POST'])
 def submit_test():
-    answers = request.get_json()
-    score = 0
-    total_questions = len(answers)
-    results = []
-    
-    for question_id, selected_answer in answers.items():
-        correct_answer = request.form.get(f'correct_{question_id}')
-        is_correct = selected_answer == correct_answer
-        if is_correct:
-            score += 1
-        results.append({
-            'question_id': question_id,
-            'is_correct': is_correct,
-            'correct_answer': correct_answer
-        })
-    
-    percentage = (score / total_questions) * 100
-    
-    return jsonify({
-        'score': score,
-        'total': total_questions,
-        'percentage': percentage,
-        'results': results
-    })
-
-@app.route('/chat', methods=['GET', 'POST'])
+    data = request.get_json(silent=True) or {}
+    answers = (data.get('answers') or {}) if isinstance(data, dict) else None
+    # Checked before the test is claimed, so a bad request doesn't use it up
+    if not isinstance(answers, dict):
+        return jsonify({'error': 'Answers must be an object of question ids to options'}), 400
+    store = get_test_store()
+    test_id = str(data.get('test_id', ''))
+    test = store.take_test(test_id)
+    if test is None:
+        # A graded test's answers have been shown, so it can't count again
+        if store.get_test(test_id) is not None:
+            return jsonify({'error': 'This test has already been submitted'}), 409
+        return jsonify({'error': 'Unknown or expired test'}), 404
+    
+    # Grade against the answer key stored when the test was issued
+    result = grade(test['answer_key'], answers)
+    
+    # Record the score, with the time spent answering as the duration
+    duration = min(time.time() - test['created'], TEST_TIME_LIMIT)
+    record_session(test['subject'], test['topic'], test['difficulty'], 'Practice Test Result', duration,
+                   score=result['percentage'])
+    
+    # Every answer updates the user's skill and the question's rating
+    answers = [(key['hash'], key['difficulty'], graded['is_correct'])
+               for key, graded in zip(test['answer_key'].values(), result['results']) if 'hash' in key]
+    if answers:
+        result['mastery'] = mastery.record_answers(session['user_id'], test['subject'], test['topic'], answers)
+    
+    return jsonify(result)
+
+@route('/chat', methods=['GET', 'POST'])
 def chat():
     if request.method == 'POST':
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -153,62 +422,133 @@ def chat():
                 if not all([question, subject, topic, difficulty]):
                     return jsonify({'error': 'Missing required parameters'}), 400
                 
-                prompt = f"""You are an expert tutor in {subject}, specifically knowledgeable about {topic} at {difficulty} level.
+                # Earlier turns of this chat, trimmed to a fixed token budget
+                chat_id = (session.get('chat_context') or {}).get('chat_id')
+                history = chat_store.context(chat_id) if chat_id else ''
                 
-                User Question: {question}
+                start_time = time.perf_counter()
+                prompt = chat_prompt(subject, topic, difficulty, question, history)
                 
-                Provide a helpful, educational response that:
-                1. Directly addresses the user's question
-                2. Uses appropriate examples and analogies
-                3. Breaks down complex concepts into simpler parts
-                4. Encourages deeper understanding
-                5. Suggests related topics for further study
+                # A question close to one already answered in this context is
+                # answered from the semantic cache. Only questions without
+                # earlier turns qualify, since follow-ups depend on the chat.
+                context = (get_template('chat', 'html').version, model_name_of(model), subject, topic, difficulty)
+                cached = None if history else semantic_cache.lookup(context, question)
+                stale = False
+                if cached is None:
+                    try:
+                        response = admitted('chat').generate_content(prompt, stream=bool(data.get('stream')))
+                    except AdmissionRejected as e:
+                        return admission_rejected_response(e)
+                    except CircuitOpenError as e:
+                        # Model calls are suspended: answer from what was
+                        # generated before, marked as stale
+                        cached = chat_fallback(context, subject, topic, difficulty, question)
+                        if cached is None:
+                            return model_unavailable_response(e)
+                        stale = True
                 
-                Format your response in HTML with appropriate styling. Use:
-                - <p> tags for paragraphs
-                - <ul> or <ol> for lists
-                - <code> for code snippets
-                - <strong> for important points
-                - <em> for emphasis
-                - <blockquote> for quotes or important notes
+                final = {'stale': stale}
                 
-                Make the response engaging and easy to read."""
+                def finish(answer):
+                    # Record chat session and remember the turn; the client
+                    # swaps the streamed text for the sanitized answer
+                    final['html'] = sanitize_html(answer)
+                    record_session(subject, topic, difficulty, 'Chat', time.perf_counter() - start_time)
+                    if chat_id:
+                        chat_store.add_turn(chat_id, question, answer)
+                    if not history and cached is None:
+                        semantic_cache.add(context, question, answer)
                 
-                response = model.generate_content(prompt)
+                if data.get('stream'):
+                    # Answers that were generated for someone else are only
+                    # sent sanitized
+                    chunks = [sanitize_html(cached)] if cached is not None else (chunk.text for chunk in response)
+                    return sse_response(when_done(chunks, finish), lambda: final)
                 
-                # Record chat session
-                global study_history
-                study_history.loc[len(study_history)] = {
-                    'timestamp': datetime.now(),
-                    'subject': subject,
-                    'topic': topic,
-                    'difficulty': difficulty,
-                    'activity_type': 'Chat',
-                    'duration': 0
-                }
-                study_history.to_csv('study_history.csv', index=False)
-                
-                return jsonify({'response': response.text})
+                finish(cached if cached is not None else response.text)
+                return jsonify({'response': final['html'], 'stale': stale})
             except Exception as e:
                 return jsonify({'error': str(e)}), 500
         
         subject = request.form.get('subject')
         topic = request.form.get('topic')
-        difficulty = request.form.get('difficulty')
-        session['chat_context'] = {'subject': subject, 'topic': topic, 'difficulty': difficulty}
+        difficulty = resolve_difficulty(subject, topic, request.form.get('difficulty'))
+        session['chat_context'] = {'subject': subject, 'topic': topic, 'difficulty': difficulty,
+                                   'chat_id': uuid.uuid4().hex}
         return render_template('chat.html', subject=subject, topic=topic, difficulty=difficulty)
     
     return render_template('start_chat.html', subjects=SUBJECTS)
 
-@app.route('/statistics')
+@route('/api/batch', methods=['POST'])
+def api_batch():
+    data = request.get_json(silent=True) or {}
+    jobs = data.get('jobs')
+    if not isinstance(jobs, list) or not jobs:
+        return jsonify({'error': 'Expected a non-empty list of jobs'}), 400
+    if len(jobs) > BATCH_MAX_JOBS:
+        return jsonify({'error': f'At most {BATCH_MAX_JOBS} jobs per request'}), 400
+    try:
+        jobs = [parse_job(job) for job in jobs]
+        workers = int(data.get('workers') or 0)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Ids listed in `skip` (finished in an earlier call) are not run again;
+    # `workers` can lower the pool size but not raise it above BATCH_WORKERS.
+    # Jobs count against the caller's own rate limit, and all batch calls
+    # share one calls-per-minute budget.
+    batch = run_from_env(admitted('batch'), batch_prompt, limiter=batch_limiter)
+    if workers > 0:
+        batch.workers = min(workers, batch.workers)
+    
+    def results():
+        # One JSON line per job as it completes, then the throughput report
+        for result in batch.run(jobs, skip=set(data.get('skip') or [])):
+            yield json.dumps(result) + '\n'
+        yield json.dumps({'report': batch.report()}) + '\n'
+    
+    return Response(stream_with_context(results()), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no'})
+
+@route('/metrics')
+def metrics_endpoint():
+    cache_stats = get_cache().stats()
+    metrics.set_gauge('response_cache_entries', cache_stats['entries'])
+    metrics.set_gauge('response_cache_bytes', cache_stats['bytes'])
+    flight_stats = get_single_flight().stats()
+    metrics.set_gauge('single_flight_upstream_calls', flight_stats['upstream_calls'])
+    metrics.set_gauge('single_flight_coalesced_calls', flight_stats['coalesced_calls'])
+    metrics.set_gauge('fragment_cache_entries', len(fragment_cache))
+    metrics.set_gauge('fragment_cache_bytes', fragment_cache.total_bytes)
+    semantic_stats = semantic_cache.stats()
+    metrics.set_gauge('semantic_cache_entries', semantic_stats['entries'])
+    metrics.set_gauge('semantic_cache_contexts', semantic_stats['contexts'])
+    metrics.set_gauge('semantic_cache_hit_ratio', semantic_stats['hit_rate'])
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@route('/health')
+def health():
+    # 'degraded' while model calls are suspended and fallback content is served
+    breaker = getattr(model, 'breaker', None)
+    return jsonify({'status': 'degraded' if model_unavailable() else 'ok',
+                    'breaker': breaker.stats() if breaker else None,
+                    'admission': admission.stats() if admission.enabled else None})
+
+@route('/pregeneration')
+def pregeneration_status():
+    return jsonify(pregeneration.progress())
+
+@route('/statistics')
 def statistics():
-    if len(study_history) == 0:
+    stats = analytics.summary(session['user_id']) if analytics else study_stats.snapshot()
+    if stats['sessions'] == 0:
         return render_template('statistics.html', has_data=False)
     
-    total_time = study_history['duration'].sum()
-    subject_stats = study_history['subject'].value_counts().to_dict()
-    activity_stats = study_history['activity_type'].value_counts().to_dict()
-    recent_activity = study_history.sort_values('timestamp', ascending=False).head(5).to_dict('records')
+    total_time = stats['total_time']
+    subject_stats = stats['subject_stats']
+    activity_stats = stats['activity_stats']
+    recent_activity = stats['recent_activity']
     
     return render_template('statistics.html', 
                          has_data=True,
@@ -217,5 +557,43 @@ def statistics():
                          activity_stats=activity_stats,
                          recent_activity=recent_activity)
 
+def analytics_query(query):
+    # Run an analytics query for the current user and return it as JSON
+    if analytics is None:
+        return jsonify({'error': 'Analytics need HISTORY_BACKEND=sqlite'}), 501
+    try:
+        return jsonify(query(session['user_id']))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@route('/api/analytics/study_time')
+def analytics_study_time():
+    bucket = request.args.get('bucket', 'day')
+    days = request.args.get('days', 30, type=int)
+    return analytics_query(lambda user_id: analytics.study_time(user_id, bucket, days))
+
+@route('/api/analytics/streaks')
+def analytics_streaks():
+    return analytics_query(lambda user_id: analytics.streaks(user_id))
+
+@route('/api/analytics/topics')
+def analytics_topics():
+    subject = request.args.get('subject')
+    bucket = request.args.get('bucket', 'week')
+    return analytics_query(lambda user_id: analytics.topic_trends(user_id, subject, bucket))
+
+@route('/api/analytics/scores')
+def analytics_scores():
+    subject = request.args.get('subject')
+    topic = request.args.get('topic')
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    return analytics_query(lambda user_id: analytics.score_history(user_id, subject, topic, limit))
+
+@route('/api/mastery')
+def api_mastery():
+    # Skill per topic for the current user, or for one subject
+    return jsonify(mastery.skills(session['user_id'], request.args.get('subject')))
+
 if __name__ == '__main__':
-    app.run(debug=True) 
\ No newline at end of file
+    # Development server; see wsgi.py for running with several workers
+    create_app().run(debug=not PRODUCTION) 
\ No newline at end of file
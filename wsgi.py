@@ -0,0 +1,4 @@
+# Production entry point, e.g.: gunicorn -w 4 -b 0.0.0.0:8000 wsgi:app
+from web_app import create_app
+
+app = create_app()